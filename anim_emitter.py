@@ -0,0 +1,123 @@
+''' Emits converted enemies as asar source or a bank-ready binary: the instruction lists of anims.txt, then the spritemaps of the JSON in SNES format '''
+
+import argparse, json, struct
+from oam_gba_2_snes import write_atomic
+from spritemap_bin import encode_snes_spritemap
+
+def read_anims(fp):
+    '''Returns [(label, [operands of each dw])] from an anims.txt'''
+    anims = []
+    for (number, line) in enumerate(open(fp), 1):
+        line = line.split(';')[0].strip()
+        if not line:
+            continue
+        if line.endswith(':'):
+            anims.append((line[:-1], []))
+        elif line.startswith('dw ') and anims:
+            anims[-1][1].append([operand.strip() for operand in line[3:].split(',')])
+        else:
+            raise ValueError(f'{fp}:{number}: expected a label or a dw: {line}')
+    return anims
+
+def spritemap_asm(label, encoded):
+    (count,) = struct.unpack_from('<H', encoded)
+    lines = [f'{label}:', f'  dw ${count:04X}']
+    for offset in range(2, len(encoded), 5):
+        (x, y, attributes) = struct.unpack_from('<HBH', encoded, offset)
+        lines.append(f'  dw ${x:04X} : db ${y:02X} : dw ${attributes:04X}')
+    return '\n'.join(lines) + '\n'
+
+class Bank:
+    '''Lays out enemies one after another, storing each distinct spritemap once across all of them
+
+    address is the SNES address of the next enemy. Without it only assembler source can be made,
+    with spritemaps shared by label.'''
+
+    def __init__(self, address=None):
+        self.address = address
+        self.spritemaps = {}
+        self.labels = {}
+        self.reused = 0
+
+    def word(self, operand, frames):
+        '''Returns the value of a dw operand: a number, or the address in the bank of a label'''
+        if operand.startswith('$'):
+            value = int(operand[1:], 16)
+        elif operand.isdigit():
+            value = int(operand)
+        elif frames.get(operand, operand) in self.labels:
+            value = self.labels[frames.get(operand, operand)] & 0xFFFF
+        else:
+            raise ValueError(f'unknown label {operand}')
+        if value > 0xFFFF:
+            raise ValueError(f'{operand} does not fit in a word')
+        return value
+
+    def add(self, name, data, anims):
+        '''Returns (asm, binary) of an enemy, binary being None without an address'''
+        # spritemap name -> label of the identical spritemap it is emitted as
+        frames = {}
+        new = []
+        for spritemap in data['spritemaps']:
+            encoded = encode_snes_spritemap(spritemap['spritemap'], spritemap['name'])
+            if encoded not in self.spritemaps:
+                self.spritemaps[encoded] = spritemap['name']
+                new.append((spritemap['name'], encoded))
+            frames[spritemap['name']] = self.spritemaps[encoded]
+        self.reused += len(frames) - len(new)
+
+        asm = f'; {name}\n\n'
+        for (label, words) in anims:
+            asm += f'{label}:\n' + ''.join(f"  dw {','.join(frames.get(operand, operand) for operand in operands)}\n" for operands in words) + '\n'
+        for (label, encoded) in new:
+            asm += spritemap_asm(label, encoded) + '\n'
+        for (frame, label) in frames.items():
+            if frame != label:
+                asm += f'; {frame} is {label}\n'
+
+        if self.address is None:
+            return (asm, None)
+
+        sizes = [(label, 2*sum(len(operands) for operands in words)) for (label, words) in anims] + [(label, len(encoded)) for (label, encoded) in new]
+        address = self.address
+        for (label, size) in sizes:
+            if label in self.labels:
+                raise ValueError(f'{name}: {label} is already defined')
+            self.labels[label] = address
+            address += size
+        if address > (self.address | 0xFFFF) + 1:
+            raise ValueError(f'{name}: ${self.address:06X}-${address - 1:06X} crosses the end of the bank')
+
+        binary = b''
+        for (label, words) in anims:
+            binary += b''.join(struct.pack('<H', self.word(operand, frames)) for operands in words for operand in operands)
+        binary += b''.join(encoded for (label, encoded) in new)
+        self.address = address
+        return (asm, binary)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Writes sprites/<name>/<name>.asm for converted enemies, sharing identical spritemaps between them')
+    parser.add_argument('names', nargs='+', help='enemies in sprites/, in the order they go in the bank')
+    parser.add_argument('--base', type=lambda address: int(address.lstrip('$'), 16), default=None,
+                        help='SNES address of the first enemy, e.g. A28000; also writes <name>_bank.bin with pointers resolved, and <name>.sym')
+    args = parser.parse_args()
+
+    if args.base is not None and args.base & 0xFFFF < 0x8000:
+        parser.error(f'${args.base:06X} is not in ROM')
+
+    bank = Bank(args.base)
+    for name in args.names:
+        start = bank.address
+        with open(f'sprites/{name}/{name}.json') as f:
+            data = json.load(f)
+        (asm, binary) = bank.add(name, data, read_anims(f'sprites/{name}/anims.txt'))
+        write_atomic(f'sprites/{name}/{name}.asm', asm)
+
+        if binary is None:
+            print(f'{name}: {len(data["spritemaps"])} spritemaps')
+            continue
+        write_atomic(f'sprites/{name}/{name}_bank.bin', binary)
+        write_atomic(f'sprites/{name}/{name}.sym', ''.join(f'{address >> 16:02X}:{address & 0xFFFF:04X} {label}\n' for (label, address) in bank.labels.items() if start <= address < bank.address))
+        print(f'{name}: ${start:06X}-${bank.address - 1:06X}, {len(binary):#x} bytes')
+
+    print(f'{len(bank.spritemaps)} spritemaps stored, {bank.reused} reused')
@@ -0,0 +1,96 @@
+''' Streaming APNG writer for palette images: frames are compressed on a thread pool and written in order as they finish '''
+
+import struct, zlib
+from collections import deque
+import numpy as np
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+def chunk(tag, data=b''):
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+
+def compress_frame(pixels, level=6):
+    '''Compresses a [y, x] array of palette indices as PNG image data, without filtering'''
+    (height, width) = pixels.shape
+    rows = np.zeros((height, width + 1), dtype=np.uint8)
+    rows[:, 1:] = pixels
+    return zlib.compress(rows.tobytes(), level)
+
+class ApngWriter:
+    '''Writes an 8-bit palette APNG one frame at a time
+
+    Every frame covers the whole image and replaces the one before it. The number of frames has to be
+    known up front; with a single frame a plain PNG is written. At most max_pending frames are waiting
+    to be compressed at once.'''
+
+    def __init__(self, fp, width, height, palette, num_frames, pool=None, max_pending=2, compress_level=6):
+        self.file = open(fp, 'wb')
+        self.width = width
+        self.height = height
+        self.num_frames = num_frames
+        self.pool = pool
+        self.max_pending = max_pending
+        self.compress_level = compress_level
+        self.pending = deque()
+        self.frame = 0
+        self.sequence = 0
+
+        # palette is a flat list of RGBA values, as given to putpalette(palette, 'RGBA')
+        palette = np.asarray(palette, dtype=np.uint8).reshape(-1, 4)
+        alpha = palette[:, 3].tobytes().rstrip(b'\xff')
+
+        self.file.write(PNG_SIGNATURE)
+        self.file.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 3, 0, 0, 0)))
+        if num_frames > 1:
+            self.file.write(chunk(b'acTL', struct.pack('>II', num_frames, 0)))
+        self.file.write(chunk(b'PLTE', palette[:, :3].tobytes()))
+        if alpha:
+            self.file.write(chunk(b'tRNS', alpha))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+
+    def write_frame(self, pixels, duration):
+        '''Queues a [y, x] uint8 array shown for duration milliseconds'''
+        if pixels.shape != (self.height, self.width):
+            raise ValueError(f'Frame is {pixels.shape[1]}x{pixels.shape[0]}, expected {self.width}x{self.height}')
+        if self.pool is None:
+            self.pending.append((compress_frame(pixels, self.compress_level), duration))
+        else:
+            self.pending.append((self.pool.submit(compress_frame, pixels, self.compress_level), duration))
+
+        while len(self.pending) > self.max_pending:
+            self.flush_frame()
+
+    def flush_frame(self):
+        (data, duration) = self.pending.popleft()
+        if not isinstance(data, bytes):
+            data = data.result()
+
+        if self.num_frames > 1:
+            # delays are a fraction of a second, each part 16 bits
+            (numerator, denominator) = (duration, 1000) if duration <= 0xFFFF else (min(round(duration/10), 0xFFFF), 100)
+            self.file.write(chunk(b'fcTL', struct.pack('>IIIIIHHBB', self.sequence, self.width, self.height, 0, 0, numerator, denominator, 0, 0)))
+            self.sequence += 1
+
+        if self.frame == 0:
+            self.file.write(chunk(b'IDAT', data))
+        else:
+            self.file.write(chunk(b'fdAT', struct.pack('>I', self.sequence) + data))
+            self.sequence += 1
+        self.frame += 1
+
+    def close(self):
+        while self.pending:
+            self.flush_frame()
+        if self.frame != self.num_frames:
+            self.file.close()
+            raise ValueError(f'Wrote {self.frame} frames, expected {self.num_frames}')
+        self.file.write(chunk(b'IEND'))
+        self.file.close()
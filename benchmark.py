@@ -0,0 +1,152 @@
+''' Times the hot paths on a synthetic ROM (see synthetic_rom.py) with the pytest-benchmark suite in test_benchmark.py,
+failing when one is slower than its saved baseline '''
+
+import argparse, glob, json, os, shutil, subprocess, sys
+from PIL import Image
+import oam_gba_2_snes
+from decompressor import decomp_lz77, decomp_rle
+from gfx_4bpp import convert_to_4bpp, decode_4bpp_gba
+from labels import load_symbols
+from oam_gba_2_snes import ParseOam, build_gfx, extract_enemy, index_snes_gfx, read_manifest, remap_gba_2_snes_tile
+from oam import read_frame_table
+from rom import Rom, gba2hex
+from synthetic_rom import FIXTURE_VERSION, write_fixture
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_FIXTURE = os.path.join(SCRIPT_DIR, '.cache', 'benchmark_fixture')
+DEFAULT_SEED = 1234
+CASES = ['decomp_lz77', 'decomp_rle', 'ParseOam', 'extract_spritemaps', 'remap_gba_2_snes_tile', 'index_snes_gfx', 'convert_to_4bpp', 'exportAnimation']
+
+def read_stamp(directory):
+    '''Returns the {version, seed} prepare_fixture wrote to a directory, or None if it didn't write one'''
+    try:
+        with open(os.path.join(directory, 'fixture.json')) as f:
+            stamp = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return stamp if isinstance(stamp, dict) and set(stamp) == {'version', 'seed'} else None
+
+def prepare_fixture(directory, seed):
+    '''Writes the synthetic ROM to directory unless it is already there for this seed and FIXTURE_VERSION
+
+    Only a directory holding prepare_fixture's stamp is replaced, any other that isn't empty is refused.'''
+    expected = {'version': FIXTURE_VERSION, 'seed': seed}
+    if os.path.isdir(directory) and os.listdir(directory):
+        stamp = read_stamp(directory)
+        if stamp is None:
+            raise ValueError(f'{directory} is not empty and is not a benchmark fixture, not writing over it')
+        if stamp == expected:
+            return
+        shutil.rmtree(directory)
+    write_fixture(directory, seed)
+    stamp = os.path.join(directory, 'fixture.json')
+    with open(stamp, 'w') as f:
+        json.dump(expected, f)
+
+class Enemy:
+    '''An enemy of the fixture with everything its conversion needs, read before timing'''
+
+    def __init__(self, rom, entry):
+        (self.sprite_id, self.name, self.spritemap_start, done) = entry
+        gfx = decomp_lz77(rom, gba2hex(rom.read(4, 0x875EBF8 + (self.sprite_id - 0x10)*4)))[0]
+        self.gba_gfx = [tile.tobytes() for tile in decode_4bpp_gba(gfx)]
+        self.snes_fp = f'sprites/{self.name}/0x{self.sprite_id:02x}_sm.png'
+        self.snes_gfx = build_gfx(self.snes_fp)
+        self.snes_index = index_snes_gfx(self.snes_gfx)
+
+def benchmarks(rom, symbols, enemies, directory):
+    '''Returns {name: function} of the cases to time, run from the fixture directory'''
+    sprite_gfx = [gba2hex(pointer) for pointer in rom.u32(0x875EBF8 + (0x12 - 0x10)*4, 0xC6 - 0x12).tolist()]
+    tilemaps = [gba2hex(address) for (address, name) in symbols.match('sSyntheticTilemap*Rle')]
+    frames = {enemy.name: sorted({pointer for (address, name) in symbols.match(f"s{''.join(part.capitalize() for part in enemy.name.split('_'))}Oam_Anim*")
+                                  for (pointer, timer) in read_frame_table(rom, address).tolist()}) for enemy in enemies}
+    sheets = [Image.open(enemy.snes_fp) for enemy in enemies]
+    for sheet in sheets:
+        sheet.load()
+
+    def lz77():
+        for pointer in sprite_gfx:
+            decomp_lz77(rom, pointer)
+
+    def rle():
+        for address in tilemaps:
+            decomp_rle(rom, address)
+
+    def parse_oam():
+        for enemy in enemies:
+            for frame in frames[enemy.name]:
+                ParseOam(rom, frame, enemy.gba_gfx, enemy.snes_index, 0x200, 0x100)
+
+    def extract_spritemaps():
+        for enemy in enemies:
+            extract_enemy(rom, enemy.sprite_id, enemy.name, enemy.gba_gfx, enemy.snes_index, enemy.spritemap_start)
+
+    def remap():
+        for enemy in enemies:
+            for tile in range(0x200, 0x200 + len(enemy.gba_gfx)):
+                remap_gba_2_snes_tile(tile, enemy.gba_gfx, enemy.snes_index, 0x200, 0x100)
+                remap_gba_2_snes_tile(tile, enemy.gba_gfx, enemy.snes_index, 0x200, 0x100, True)
+
+    def index():
+        for enemy in enemies:
+            index_snes_gfx(enemy.snes_gfx)
+
+    def convert():
+        for sheet in sheets:
+            convert_to_4bpp(sheet)
+
+    def export_animation():
+        # the whole script, from a cold cache, only ever clearing the fixture's outputs
+        if read_stamp(directory) is None:
+            raise ValueError(f'{directory} is not a benchmark fixture')
+        shutil.rmtree(os.path.join(directory, '.cache'), ignore_errors=True)
+        shutil.rmtree(os.path.join(directory, 'animation_frames'), ignore_errors=True)
+        os.mkdir(os.path.join(directory, 'animation_frames'))
+        subprocess.run([sys.executable, os.path.join(SCRIPT_DIR, 'sprite_oam_to_apng.py')], cwd=directory, check=True, stdout=subprocess.DEVNULL)
+
+    return {
+        'decomp_lz77': lz77,
+        'decomp_rle': rle,
+        'ParseOam': parse_oam,
+        'extract_spritemaps': extract_spritemaps,
+        'remap_gba_2_snes_tile': remap,
+        'index_snes_gfx': index,
+        'convert_to_4bpp': convert,
+        'exportAnimation': export_animation,
+    }
+
+def load_cases(directory, seed):
+    '''Prepares the fixture and returns its benchmarks(), changing to the fixture directory they run from'''
+    prepare_fixture(directory, seed)
+    os.chdir(directory)
+    rom = Rom('mzm.gba')
+    symbols = load_symbols()
+    oam_gba_2_snes.all_labels = symbols
+    enemies = [Enemy(rom, entry) for entry in read_manifest('enemies.txt')]
+    return benchmarks(rom, symbols, enemies, directory)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Times the hot paths on a synthetic ROM against the saved pytest-benchmark baseline')
+    parser.add_argument('cases', nargs='*', help='only run these cases')
+    parser.add_argument('--fixture', default=DEFAULT_FIXTURE, help='where to write the synthetic ROM')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--save', action='store_true', help='save the results as the new baseline')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each case')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='how much slower than the baseline the fastest run may be (default 0.25, 25%%)')
+    args = parser.parse_args()
+    unknown = set(args.cases) - set(CASES)
+    if unknown:
+        parser.error(f'unknown cases: {", ".join(sorted(unknown))} (known: {", ".join(CASES)})')
+
+    # pytest-benchmark keeps a directory of runs per interpreter and machine, under one per fixture
+    storage = os.path.join(SCRIPT_DIR, '.benchmarks', f'fixture{FIXTURE_VERSION}_seed{args.seed}')
+    command = [sys.executable, '-m', 'pytest', os.path.join(SCRIPT_DIR, 'test_benchmark.py'), '-q', f'--benchmark-storage={storage}']
+    if args.cases:
+        command += ['-k', ' or '.join(args.cases)]
+    if args.save or not glob.glob(os.path.join(storage, '*', '*.json')):
+        command += ['--benchmark-save=baseline']
+    else:
+        command += ['--benchmark-compare', f'--benchmark-compare-fail=min:{args.tolerance:.0%}']
+
+    env = dict(os.environ, BENCHMARK_FIXTURE=os.path.abspath(args.fixture), BENCHMARK_SEED=str(args.seed), BENCHMARK_ROUNDS=str(args.repeat))
+    sys.exit(subprocess.run(command, env=env).returncode)
@@ -0,0 +1,114 @@
+import hashlib, json, os, pickle
+import profiling
+
+CACHE_DIR = '.cache'
+
+def file_hash(fp):
+    with open(fp, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+class Cache:
+    '''On-disk cache of pickled values keyed by the inputs they were computed from
+
+    Keys are tuples of plain values (ints, strings, bytes, hashes of input files); the entry name
+    is their SHA-1. When the cache grows past max_size, the least recently used entries are deleted.'''
+
+    def __init__(self, directory=os.path.join(CACHE_DIR, 'objects'), max_size=256 << 20):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, key):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest[2:])
+
+    def get(self, key, default=None):
+        fp = self.path(key)
+        try:
+            with open(fp, 'rb') as f:
+                value = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            self.misses += 1
+            profiling.count('cache misses')
+            return default
+        # the modification time is the last use, for eviction
+        os.utime(fp)
+        self.hits += 1
+        profiling.count('cache hits')
+        return value
+
+    def put(self, key, value):
+        fp = self.path(key)
+        os.makedirs(os.path.dirname(fp), exist_ok=True)
+        tmp = f'{fp}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, fp)
+        self.evict()
+
+    def get_or_compute(self, key, compute):
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def evict(self):
+        entries = []
+        total = 0
+        for (root, dirs, files) in os.walk(self.directory):
+            for name in files:
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, os.path.join(root, name)))
+                total += stat.st_size
+
+        for (mtime, size, fp) in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(fp)
+            except OSError:
+                pass
+            total -= size
+
+class BuildManifest:
+    '''Digest of the inputs each output file was last built from, to skip outputs that would not change'''
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.built = 0
+        self.skipped = 0
+        try:
+            with open(fp) as f:
+                self.digests = json.load(f)
+        except (OSError, ValueError):
+            self.digests = {}
+
+    def up_to_date(self, output, digest):
+        if self.digests.get(output) == digest and os.access(output, os.F_OK):
+            self.skipped += 1
+            return True
+        return False
+
+    def record(self, output, digest):
+        self.digests[output] = digest
+        self.built += 1
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.fp) or '.', exist_ok=True)
+        with open(self.fp + '.tmp', 'w') as f:
+            json.dump(self.digests, f, indent=1, sort_keys=True)
+        os.replace(self.fp + '.tmp', self.fp)
+
+def cached(cache, key, compute):
+    '''Returns compute(), through the cache unless it is None'''
+    if cache is None:
+        return compute()
+    return cache.get_or_compute(key, compute)
+
+default_cache = Cache()
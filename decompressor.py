@@ -1,26 +1,49 @@
+import mmap
+import profiling
+from cache import cached
+
 MIN_MATCH_SIZE = 3
 MAX_MATCH_SIZE = 18
 MAX_WINDOW_SIZE = 0x1000
 
+# Optional native backend exposing decomp_rle(buffer, addr) and decomp_lz77(buffer, addr)
+# with the same return values as the pure Python versions below
+try:
+    import _decompressor as native
+except ImportError:
+    native = None
+
+def rom_view(rom) -> memoryview:
+    '''Returns a memoryview of the whole ROM, given a Rom, an open file or a bytes-like object'''
+    if isinstance(getattr(rom, 'data', None), memoryview):
+        return rom.data
+    if hasattr(rom, 'fileno'):
+        return memoryview(mmap.mmap(rom.fileno(), 0, access=mmap.ACCESS_READ))
+    return memoryview(rom)
+
 # Modified from https://github.com/biosp4rk/mf-zm-info/blob/main/tools/compress.py
+@profiling.timed('decompression', lambda result: ('compressed bytes read', result[1]))
 def decomp_rle(rom, addr: int) -> (bytes, int):
-    rom.seek(addr)
+    data = rom_view(rom)
+    if native is not None:
+        return native.decomp_rle(data, addr)
+
+    src = addr
     passes = []
-    half = None
     # for each pass
     for p in range(2):
-        if p == 1:
-            half = len(passes)
-        num_bytes = int.from_bytes(rom.read(1), "little")
+        out = bytearray()
+        num_bytes = data[src]
+        src += 1
         while True:
-            amount = None
-            compare = None
             if num_bytes == 1:
-                amount = int.from_bytes(rom.read(1), "little")
+                amount = data[src]
+                src += 1
                 compare = 0x80
             else:
                 # num_bytes == 2
-                amount = int.from_bytes(rom.read(2), "big")
+                amount = data[src] << 8 | data[src + 1]
+                src += 2
                 compare = 0x8000
 
             if amount == 0:
@@ -29,73 +52,115 @@ def decomp_rle(rom, addr: int) -> (bytes, int):
             if (amount & compare) != 0:
                 # compressed
                 amount %= compare
-                val = int.from_bytes(rom.read(1), "little")
-                while amount > 0:
-                    passes.append(val)
-                    amount -= 1
+                out += bytes((data[src],)) * amount
+                src += 1
             else:
                 # uncompressed
-                while amount > 0:
-                    passes.append(int.from_bytes(rom.read(1), "little"))
-                    amount -= 1
-    
+                out += data[src:src + amount]
+                src += amount
+        passes.append(out)
+
     # each pass must be equal length
-    if len(passes) != half * 2:
+    if len(passes[0]) != len(passes[1]):
         raise ValueError()
-    
+
     # combine passes to get output
-    out_list = bytearray()
-    for i in range(half):
-        out_list.append(passes[i])
-        out_list.append(passes[half + i])
-    
+    output = bytearray(len(passes[0]) * 2)
+    output[0::2] = passes[0]
+    output[1::2] = passes[1]
+
     # return bytes and compressed size
-    comp_size = rom.tell() - addr
-    return bytes(out_list), comp_size
+    return bytes(output), src - addr
 
+def lz77_size(rom, addr: int) -> int:
+    '''Returns the decompressed size from an LZ77 header without decompressing'''
+    data = rom_view(rom)
+    if data[addr] != 0x10:
+        raise ValueError("Missing 0x10 flag")
+    return int.from_bytes(data[addr + 1:addr + 4], "little")
 
+@profiling.timed('decompression', lambda result: ('compressed bytes read', result[1]))
 def decomp_lz77(rom, addr: int) -> (bytes, int):
-    rom.seek(addr)
+    data = rom_view(rom)
+    if native is not None:
+        return native.decomp_lz77(data, addr)
+
     # check for 0x10 flag
-    if int.from_bytes(rom.read(1), "little") != 0x10:
+    if data[addr] != 0x10:
         raise ValueError("Missing 0x10 flag")
 
     # get length of decompressed data
-    remain = int.from_bytes(rom.read(3), "little")
-    output = bytearray([0] * remain)
+    size = int.from_bytes(data[addr + 1:addr + 4], "little")
+    output = bytearray(size)
 
     # check for valid data size
-    if remain < 32 or remain % 32 != 0:
+    if size < 32 or size % 32 != 0:
         raise ValueError("Invalid data size")
 
+    src = addr + 4
     dst = 0
 
     # decompress
-    while (True):
-        cflag = int.from_bytes(rom.read(1), "little")
+    while True:
+        cflag = data[src]
+        src += 1
 
-        for _ in range(8):
-            if (cflag & 0x80) == 0:
-                # uncompressed
-                output[dst] = int.from_bytes(rom.read(1), "little")
-                dst += 1
-                remain -= 1
-            else:
-                # compressed
-                val = int.from_bytes(rom.read(1), "little")
-                amount_to_copy = (val >> 4) + MIN_MATCH_SIZE
-                window = ((val & 0xF) << 8) + int.from_bytes(rom.read(1), "little") + 1
-                remain -= amount_to_copy
-                
-                for _ in range(amount_to_copy):
-                    output[dst] = output[dst - window]
+        if cflag == 0 and dst + 8 <= size:
+            # eight uncompressed bytes
+            output[dst:dst + 8] = data[src:src + 8]
+            src += 8
+            dst += 8
+        else:
+            for _ in range(8):
+                if (cflag & 0x80) == 0:
+                    # uncompressed
+                    output[dst] = data[src]
+                    src += 1
                     dst += 1
+                else:
+                    # compressed
+                    val = data[src]
+                    amount_to_copy = (val >> 4) + MIN_MATCH_SIZE
+                    window = ((val & 0xF) << 8 | data[src + 1]) + 1
+                    src += 2
+
+                    if dst + amount_to_copy > size:
+                        raise ValueError("Too many bytes copied at end")
+                    if window > dst:
+                        raise ValueError("Window points before start of data")
+
+                    start = dst - window
+                    if window >= amount_to_copy:
+                        output[dst:dst + amount_to_copy] = output[start:start + amount_to_copy]
+                    else:
+                        # overlapping copy repeats the window
+                        output[dst:dst + amount_to_copy] = (output[start:dst] * (amount_to_copy // window + 1))[:amount_to_copy]
+                    dst += amount_to_copy
+
+                if dst >= size:
+                    break
+                cflag <<= 1
+
+        if dst >= size:
+            # Round compressed size up to a multiple of 4
+            comp_size = (src + 3) // 4 * 4 - addr
+            return bytes(output), comp_size
+
+def decomp_lz77_cached(rom, addr: int, cache) -> (bytes, int):
+    '''decomp_lz77 from a Rom, cached by ROM hash and address'''
+    return cached(cache, ('lz77', rom.digest, addr), lambda: decomp_lz77(rom, addr))
+
+if __name__ == "__main__":
+    # Benchmark over every sprite graphics pointer
+    import sys, time
+    from rom import Rom, gba2hex
+
+    rom = Rom(sys.argv[1] if len(sys.argv) > 1 else "mzm.gba")
+    pointers = [gba2hex(pointer) for pointer in rom.u32(0x875EBF8+(0x12-0x10)*4, 0xC6-0x12).tolist()]
 
-            if remain <= 0:
-                if remain < 0:
-                    raise ValueError("Too many bytes copied at end")
-                # Round compressed size up to a multiple of 4
-                rom.seek((rom.tell() + 3) // 4 * 4)
-                comp_size = rom.tell() - addr
-                return bytes(output), comp_size
-            cflag <<= 1
+    for backend in [None, native] if native is not None else [None]:
+        native = backend
+        start = time.perf_counter()
+        total = sum(len(decomp_lz77(rom, pointer)[0]) for pointer in pointers)
+        elapsed = time.perf_counter() - start
+        print(f"{'native' if backend else 'python'}: {len(pointers)} graphics, {total:#x} bytes in {elapsed*1000:.1f} ms ({total/elapsed/0x100000:.1f} MiB/s)")
@@ -0,0 +1,137 @@
+''' Reports the tiles and spritemaps converted enemies could share with each other and with the common sprite tiles '''
+
+import argparse, base64, glob, json, os
+from gfx_4bpp import decode_4bpp_snes
+from oam_gba_2_snes import build_gfx, entry_flip
+from spritemap_bin import encode_snes_spritemap
+from vram_packer import SHEET_WIDTH, canonical_tile
+
+BLANK = bytes(0x40)
+
+def used_tiles(data):
+    '''Returns the indices of the sheet tiles drawn by the spritemaps of editor JSON'''
+    sheet_size = len(base64.b64decode(data['gfx'])) // 0x20
+    used = set()
+    for spritemap in data['spritemaps']:
+        for entry in spritemap['spritemap']:
+            idx = entry['tile'] - data['gfx_offset']
+            used.update(i for i in ((idx, idx + 1, idx + SHEET_WIDTH, idx + SHEET_WIDTH + 1) if entry['big'] else (idx,)) if 0 <= i < sheet_size)
+    return sorted(used)
+
+def frame_key(data, sheet, spritemap):
+    '''Hashable key of what a spritemap draws, independent of where its tiles are in the sheet'''
+    key = []
+    for entry in spritemap['spritemap']:
+        idx = entry['tile'] - data['gfx_offset']
+        tiles = (idx, idx + 1, idx + SHEET_WIDTH, idx + SHEET_WIDTH + 1) if entry['big'] else (idx,)
+        if not all(0 <= i < len(sheet) for i in tiles):
+            return None
+        key.append((entry['x'], entry['y'], entry['palette'], entry['bg_priority'], entry_flip(entry), entry['big'], b''.join(sheet[i] for i in tiles)))
+    return tuple(key)
+
+class DedupIndex:
+    '''Hash index of flip-canonical tiles and spritemaps over every enemy loaded
+
+    Each lookup is a dict access, so adding an enemy costs the same however many came before.'''
+
+    def __init__(self):
+        # canonical tile -> {owner: number of its tiles}, common sheets included
+        self.tiles = {}
+        self.common = set()
+        # encoded spritemap -> [(enemy, frame)], and frame_key -> [(enemy, frame)]
+        self.spritemaps = {}
+        self.frames = {}
+        self.enemies = []
+
+    def add_common(self, name, tiles):
+        for tile in tiles:
+            if tile != BLANK:
+                (canonical, flip) = canonical_tile(tile)
+                self.common.add(canonical)
+                counts = self.tiles.setdefault(canonical, {})
+                counts[name] = counts.get(name, 0) + 1
+
+    def add_enemy(self, name, data):
+        self.enemies.append(name)
+        sheet = [tile.tobytes() for tile in decode_4bpp_snes(base64.b64decode(data['gfx']))]
+        for idx in used_tiles(data):
+            if sheet[idx] != BLANK:
+                (canonical, flip) = canonical_tile(sheet[idx])
+                counts = self.tiles.setdefault(canonical, {})
+                counts[name] = counts.get(name, 0) + 1
+
+        for spritemap in data['spritemaps']:
+            owner = (name, spritemap['name'])
+            self.spritemaps.setdefault(encode_snes_spritemap(spritemap['spritemap'], spritemap['name']), []).append(owner)
+            key = frame_key(data, sheet, spritemap)
+            if key is not None:
+                self.frames.setdefault(key, []).append(owner)
+
+    def summary(self):
+        '''Returns {statistic: value} of what sharing would save'''
+        enemies = set(self.enemies)
+        stored = sum(count for counts in self.tiles.values() for (owner, count) in counts.items() if owner in enemies)
+        distinct = sum(1 for (tile, counts) in self.tiles.items() if tile not in self.common and enemies.intersection(counts))
+        in_common = sum(count for (tile, counts) in self.tiles.items() if tile in self.common for (owner, count) in counts.items() if owner in enemies)
+        spritemap_bytes = sum(len(encoded)*len(owners) for (encoded, owners) in self.spritemaps.items())
+
+        return {
+            'enemies': len(self.enemies),
+            'enemy tiles': stored,
+            'distinct tiles not in the common sheets': distinct,
+            'tiles shared between enemies': sum(1 for counts in self.tiles.values() if len(enemies.intersection(counts)) > 1),
+            'enemy tiles also in the common sheets': in_common,
+            'tile ROM bytes saved': (stored - distinct - in_common)*0x20,
+            'VRAM bytes saved using the common sheets': in_common*0x20,
+            'spritemaps': sum(len(owners) for owners in self.spritemaps.values()),
+            'distinct spritemaps': len(self.spritemaps),
+            'spritemap ROM bytes saved': spritemap_bytes - sum(len(encoded) for encoded in self.spritemaps),
+            'frames drawing the same thing as another': sum(len(owners) - 1 for owners in self.frames.values()),
+        }
+
+    def shared_tiles(self):
+        '''Returns [(owners, count)] of the tiles used by more than one enemy or by an enemy and a common sheet'''
+        shared = {}
+        for counts in self.tiles.values():
+            owners = tuple(sorted(counts))
+            if len(owners) > 1 and set(self.enemies).intersection(owners):
+                shared[owners] = shared.get(owners, 0) + 1
+        return sorted(shared.items(), key=lambda item: -item[1])
+
+    def shared_frames(self):
+        '''Returns the groups of frames drawing the same thing, from more than one enemy first'''
+        groups = [owners for owners in self.frames.values() if len(owners) > 1]
+        return sorted(groups, key=lambda owners: (-len({enemy for (enemy, frame) in owners}), -len(owners)))
+
+def load_enemies(names=None):
+    '''Yields (name, editor JSON) of enemies in sprites/, all of them by default'''
+    for name in names or sorted(os.listdir('sprites')):
+        fp = f'sprites/{name}/{name}.json'
+        if os.path.exists(fp):
+            with open(fp) as f:
+                yield (name, json.load(f))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Reports tiles and spritemaps converted enemies could share')
+    parser.add_argument('names', nargs='*', help='enemies in sprites/ (default: all of them)')
+    parser.add_argument('--common', nargs='*', default=sorted(glob.glob('common_sprite_tiles/*.png') + glob.glob('beams/*.png')),
+                        help='sheets always in VRAM (default: common_sprite_tiles/ and beams/)')
+    parser.add_argument('--limit', type=int, default=20, help='how many shared tile groups and frames to list')
+    args = parser.parse_args()
+
+    index = DedupIndex()
+    for fp in args.common:
+        index.add_common(fp, build_gfx(fp))
+    for (name, data) in load_enemies(args.names):
+        index.add_enemy(name, data)
+
+    for (statistic, value) in index.summary().items():
+        print(f'{statistic}: {value:#x}' if 'bytes' in statistic else f'{statistic}: {value}')
+
+    print('\nshared tiles:')
+    for (owners, count) in index.shared_tiles()[:args.limit]:
+        print(f'  {count} tiles: {", ".join(owners)}')
+
+    print('\nshared frames:')
+    for owners in index.shared_frames()[:args.limit]:
+        print(f'  {", ".join(f"{enemy}/{frame}" for (enemy, frame) in owners)}')
@@ -0,0 +1,79 @@
+''' Whole-sheet 4bpp tile codecs, vectorized from the per-tile versions in SpriteSomething (https://github.com/Artheau/SpriteSomething) '''
+
+from PIL import Image
+import numpy as np
+
+def as_bytes_array(raw):
+    if isinstance(raw, np.ndarray):
+        return raw.astype(np.uint8, copy=False).ravel()
+    if isinstance(raw, (list, tuple)):
+        return np.array(raw, dtype=np.uint8)
+    return np.frombuffer(raw, dtype=np.uint8)
+
+def decode_4bpp_gba(raw, palette=0):
+    '''Converts GBA 4bpp tile data to an (N, 8, 8) array of pixels, indexed [tile, y, x]'''
+    packed = as_bytes_array(raw)
+    packed = packed[:len(packed)//0x20*0x20].reshape(-1, 0x20)
+
+    tiles = np.empty((len(packed), 0x40), dtype=np.uint8)
+    tiles[:, 0::2] = packed & 0xF
+    tiles[:, 1::2] = packed >> 4
+    if palette:
+        tiles |= palette
+
+    return tiles.reshape(-1, 8, 8)
+
+def encode_4bpp_snes(tiles):
+    '''Converts an (N, 8, 8) array of pixels to SNES 4bpp tile data'''
+    tiles = np.asarray(tiles, dtype=np.uint8).reshape(-1, 8, 8)
+
+    # [tile, y, x, bit] -> [tile, y, bitplane]
+    tile_bits = np.unpackbits(tiles[..., np.newaxis], axis=3, bitorder='little')
+    bitplanes = np.packbits(tile_bits, axis=2, bitorder='big')[:, :, 0, :]
+
+    output = np.empty((len(tiles), 2, 8, 2), dtype=np.uint8)
+    output[:, 0] = bitplanes[:, :, 0:2]
+    output[:, 1] = bitplanes[:, :, 2:4]
+    return bytearray(output.tobytes())
+
+def decode_4bpp_snes(raw):
+    '''Converts SNES 4bpp tile data to an (N, 8, 8) array of pixels, indexed [tile, y, x]'''
+    packed = as_bytes_array(raw)
+    packed = packed[:len(packed)//0x20*0x20].reshape(-1, 2, 8, 2)
+
+    # [tile, y, bitplane] -> [tile, y, x, bit]
+    bitplanes = np.concatenate([packed[:, 0], packed[:, 1]], axis=2)
+    tile_bits = np.unpackbits(bitplanes[:, :, np.newaxis, :], axis=2, bitorder='big')
+    return np.packbits(tile_bits, axis=3, bitorder='little')[..., 0]
+
+def tiles_to_pixels(tiles, width=0x20):
+    '''Lays out an (N, 8, 8) array of tiles in rows of `width` tiles'''
+    tiles = np.asarray(tiles, dtype=np.uint8)
+    rows = -(-len(tiles) // width)
+    if rows*width != len(tiles):
+        tiles = np.concatenate([tiles, np.zeros((rows*width - len(tiles), 8, 8), dtype=np.uint8)])
+
+    return tiles.reshape(rows, width, 8, 8).swapaxes(1, 2).reshape(rows*8, width*8)
+
+def tiles_to_image(tiles, width=0x20):
+    return Image.fromarray(tiles_to_pixels(tiles, width), 'P')
+
+def image_to_tiles(image: Image):
+    '''Splits an image into an (N, 8, 8) array of tiles, row by row'''
+    pixels = np.asarray(image, dtype=np.uint8)
+    (height, width) = pixels.shape[:2]
+    if height % 8 or width % 8:
+        pixels = np.pad(pixels, ((0, -height % 8), (0, -width % 8)))
+        (height, width) = pixels.shape
+
+    return pixels.reshape(height//8, 8, width//8, 8).swapaxes(1, 2).reshape(-1, 8, 8)
+
+def convert_to_4bpp(image: Image):
+    '''Converts an image to SNES 4bpp tiles as bytearray'''
+    if image.mode not in ('P', 'PA'):
+        raise AssertionError('Mode must be "P"')
+
+    if image.mode == 'PA':
+        image = image.getchannel('P')
+
+    return encode_4bpp_snes(image_to_tiles(image))
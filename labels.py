@@ -1,20 +1,138 @@
+import bisect, fnmatch, hashlib, os, pickle
+from array import array
+import profiling
+from cache import CACHE_DIR, file_hash
+
+class SymbolTable:
+    '''Symbols from the linker map, sorted by address
+
+    Symbols sharing an address keep their order in the map.'''
+
+    def __init__(self, addresses, names):
+        order = sorted(range(len(addresses)), key=addresses.__getitem__)
+        self.addresses = array('I', [addresses[i] for i in order])
+        self.names = [names[i] for i in order]
+        # SHA-1 of the map this was parsed from, if known
+        self.digest = None
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def __iter__(self):
+        return zip(self.addresses, self.names)
+
+    def __contains__(self, address):
+        i = bisect.bisect_left(self.addresses, address)
+        return i < len(self.addresses) and self.addresses[i] == address
+
+    def __getitem__(self, address):
+        '''Returns the name at an address, the last one in the map if there are several'''
+        i = bisect.bisect_right(self.addresses, address) - 1
+        if i < 0 or self.addresses[i] != address:
+            raise KeyError(address)
+        return self.names[i]
+
+    def get(self, address, default=None):
+        try:
+            return self[address]
+        except KeyError:
+            return default
+
+    def preceding(self, address):
+        '''Returns (address, name) of the nearest symbol at or before an address'''
+        i = bisect.bisect_right(self.addresses, address) - 1
+        if i < 0:
+            return None
+        return (self.addresses[i], self.names[i])
+
+    def range(self, start, end):
+        '''Returns (address, name) of every symbol with start <= address < end'''
+        i = bisect.bisect_left(self.addresses, start)
+        j = bisect.bisect_left(self.addresses, end)
+        return list(zip(self.addresses[i:j], self.names[i:j]))
+
+    def match(self, pattern, start=0, end=1 << 32):
+        '''Returns (address, name) of every symbol in [start, end) whose name matches a shell-style pattern'''
+        return [(address, name) for (address, name) in self.range(start, end) if fnmatch.fnmatchcase(name, pattern)]
+
+def map_symbols(fp="mzm_us.map"):
+    '''Yields (address as written in the map, name) of each symbol line of a linker map'''
+    with open(fp) as labelsFile:
+        for line in labelsFile:
+            line = line.splitlines()[0]
+            if line.startswith("                0x02") or line.startswith("                0x03"):
+                split = line.split()
+                if len(split) == 4:
+                    yield (split[0], split[1])
+            if line.startswith("                0x08"):
+                split = line.split()
+                if len(split) == 2:
+                    yield (split[0], split[1])
+
+@profiling.timed('map parsing')
+def parse_map(fp="mzm_us.map"):
+    addresses = []
+    names = []
+    for (address, name) in map_symbols(fp):
+        addresses.append(int(address, 16))
+        names.append(name)
+
+    return SymbolTable(addresses, names)
+
+def load_symbols(fp="mzm_us.map"):
+    '''Returns the symbol table of a linker map, cached until the map changes'''
+    stat = os.stat(fp)
+    # named after the whole path, so maps of the same name in different directories don't share an entry
+    path = os.path.abspath(fp)
+    cache_fp = os.path.join(CACHE_DIR, f'{os.path.basename(fp)}.{hashlib.sha1(path.encode()).hexdigest()[:12]}.symbols')
+
+    cached = None
+    if os.access(cache_fp, os.R_OK):
+        try:
+            with open(cache_fp, 'rb') as f:
+                cached = pickle.load(f)
+        except (pickle.UnpicklingError, EOFError, ValueError):
+            cached = None
+
+    if cached is not None and (cached['mtime'], cached['size']) == (stat.st_mtime_ns, stat.st_size):
+        digest = cached['sha1']
+    else:
+        # touched or replaced: only reparse if the contents changed
+        digest = file_hash(fp)
+        if cached is None or cached['sha1'] != digest:
+            cached = None
+
+    if cached is not None:
+        table = SymbolTable.__new__(SymbolTable)
+        table.addresses = array('I')
+        table.addresses.frombytes(cached['addresses'])
+        table.names = cached['names'].split('\n') if table.addresses else []
+    else:
+        table = parse_map(fp)
+    table.digest = digest
+
+    if cached is None or cached['mtime'] != stat.st_mtime_ns:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp = f'{cache_fp}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump({
+                'mtime': stat.st_mtime_ns,
+                'size': stat.st_size,
+                'sha1': digest,
+                'addresses': table.addresses.tobytes(),
+                'names': '\n'.join(table.names)
+            }, f)
+        os.replace(tmp, cache_fp)
+
+    return table
+
 def extract_labels(string=False):
-    labelsFile = open("mzm_us.map")
-    labels = {}
+    if string:
+        # keyed by the address text of the map, which the symbol table doesn't keep
+        return dict(map_symbols())
 
-    line = labelsFile.readline()
-    while line != '':
-        line = line.splitlines()[0]
-        if line.startswith("                0x02") or line.startswith("                0x03"):
-            split = line.split()
-            if len(split) == 4:
-                labels[split[0] if string else int(split[0], 16)] = split[1]
-        if line.startswith("                0x08"):
-            split = line.split()
-            if len(split) == 2:
-                labels[split[0] if string else int(split[0], 16)] = split[1]
-        line = labelsFile.readline()
-
-    labelsFile.close()
+    labels = {}
+    for (address, name) in load_symbols():
+        labels[address] = name
 
     return labels
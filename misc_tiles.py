@@ -2,81 +2,131 @@
 # Also uses modified code from SpriteSomething: https://github.com/Artheau/SpriteSomething
 # Also modified from H A M's Super Metroid OAM extractor: https://github.com/H-A-M-G-E-R/nspc-track-disassembler/blob/main/enemy%20spritemap%20extractor.py
 
-from PIL import Image
-import numpy as np
-
-gba2hex = lambda address: address & 0x1FFFFFF
-hex2gba = lambda address: address & 0x1FFFFFF | 0x8000000
-
-def romRead(n = 1, address = None):
-    if address is not None:
-        prevAddress = rom.tell()
-        rom.seek(gba2hex(address))
-
-    ret = int.from_bytes(rom.read(n), 'little')
-    if address is not None:
-        rom.seek(prevAddress)
-        
-    return ret
-
-def romSeek(address):
-    return rom.seek(gba2hex(address))
-
-def romTell():
-    return hex2gba(rom.tell())
-
-tile_dimensions = [[(8,8),(16,16),(32,32),(64,64)],[(16,8),(32,8),(32,16),(64,32)],[(8,16),(8,32),(16,32),(32,64)]]
-
-''' Modified From SpriteSomething (https://github.com/Artheau/SpriteSomething) '''
-def image_from_raw_data(raw, width=0x20):
-    raveled = np.concatenate([np.concatenate([convert_4bpp_tile_gba(raw[(i+j)*0x20:(i+j+1)*0x20], 0) for i in range(width)], 1) for j in range(0, len(raw)//0x20, width)], 0)
-    return Image.fromarray(raveled, 'P')
-
-def convert_4bpp_tile_gba(raw_tile, palette):
-    tile = np.zeros(64, dtype=np.uint8)
-
-    for i in range(32):
-        tile[i*2] = raw_tile[i] & 0xF | palette
-        tile[i*2+1] = raw_tile[i] >> 4 | palette
-
-    return tile.reshape(8, 8)
-
-def extract_tiles(tilesAddr, paletteAddr, size, name, width=32):
-    romSeek(paletteAddr)
-    palette555 = [romRead(2) for i in range(16)]
-
-    paletteRgb = [0]*(3*16)
-    for i in range(16):
-        paletteRgb[i*3] = (palette555[i] & 0x1F) << 3
-        paletteRgb[i*3+1] = (palette555[i] >> 5 & 0x1F) << 3
-        paletteRgb[i*3+2] = (palette555[i] >> 10 & 0x1F) << 3
-
-    romSeek(tilesAddr)
-    tiles = [romRead() for j in range(0x20*size)]
-
-    image = image_from_raw_data(tiles, width)
-    image.putpalette(paletteRgb, 'RGB')
-    image.save(name)
-
-rom = open("mzm.gba", 'rb')
-
-#extract_tiles(0x832BAC8, 0x832BA08, 0x20*0xE, 'common_tiles_2.png')
-'''
-extract_tiles(0x832BAC8, 0x832BA08+0x20, 0x20*0xE, 'common_tiles_3.png')
-extract_tiles(0x832BAC8, 0x832BA08+0x40, 0x20*0xE, 'common_tiles_4.png')
-extract_tiles(0x832BAC8, 0x832BA08+0xA0, 0x20*0xE, 'common_tiles_7.png')
-'''
-'''
-extract_tiles(0x83271A8, 0x83270E8, 0x40, 'normal_beam.png', 16)
-extract_tiles(0x8327B90, 0x83270E8+0x20, 0x40, 'long_beam.png', 16)
-extract_tiles(0x8328500, 0x83270E8+0x40, 0x40, 'ice_beam.png', 16)
-extract_tiles(0x8328F34, 0x83270E8+0x60, 0x40, 'wave_beam.png', 16)
-extract_tiles(0x8329ED4, 0x83270E8+0x80, 0x40, 'plasma_beam.png', 16)
-'''
-#extract_tiles(0x832B078, 0x83270E8+0xA0, 0x40, 'pistol.png', 16)
-#extract_tiles(0x83362A8, 0x832BA08+0x40, 0x1C0, 'pistol_charge_gauge.png', 8)
-'''
-extract_tiles(0x8322468, 0x083239a8+5*0x20, 0x80, 'mecha_ridley_missile.png')
-extract_tiles(0x8322468, 0x083239a8+1*0x20, 0x80, 'mecha_ridley_fireball.png')
-'''
-extract_tiles(0x8323468, 0x083239a8, 6*7, 'mecha_ridley_destroyed.png', 6)
+import argparse, hashlib, os, sys
+from concurrent.futures import ProcessPoolExecutor
+from cache import CACHE_DIR, BuildManifest, default_cache
+from decompressor import decomp_lz77_cached
+from gfx_4bpp import decode_4bpp_gba, tiles_to_image
+from rom import Rom, bgr555_to_rgb, gba2hex
+
+# next to the scripts, so they run from any directory
+DEFAULT_JOB_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tiles.txt')
+
+def tiles_image(gfx, palette555, width=32):
+    image = tiles_to_image(decode_4bpp_gba(gfx), width)
+    image.putpalette(bgr555_to_rgb(palette555).ravel().tolist(), 'RGB')
+    return image
+
+def extract_tiles(rom, tilesAddr, paletteAddr, size, name, width=32):
+    tiles_image(rom.view(tilesAddr, 0x20*size), rom.u16(paletteAddr, 16), width).save(name)
+
+def read_jobs(fp=DEFAULT_JOB_FILE):
+    '''Returns (tiles, palette, size, width, format, output) for each line of a tile job file'''
+    jobs = []
+    for line in open(fp):
+        fields = line.split('#')[0].split()
+        if not fields:
+            continue
+        if len(fields) != 6:
+            raise ValueError(f'{fp}: expected tiles palette size width format output: {line.strip()}')
+        (tiles, palette, size, width, compression, output) = fields
+        if compression not in ('raw', 'lz77'):
+            raise ValueError(f'{fp}: unknown format {compression}: {line.strip()}')
+        if size == '-' and compression == 'raw':
+            raise ValueError(f'{fp}: raw graphics need a size: {line.strip()}')
+        jobs.append((tiles, palette, None if size == '-' else int(size, 0), int(width), compression, output))
+    return jobs
+
+def resolve(rom, address):
+    '''Returns an address from a job file, [address] meaning the pointer stored at address'''
+    if address.startswith('['):
+        return rom.read(4, int(address[1:-1], 16))
+    return int(address, 16)
+
+def read_job(rom, job, cache=default_cache):
+    '''Returns the 4bpp graphics and BGR555 palette of a job'''
+    (tiles, palette, size, width, compression, output) = job
+    tilesAddr = resolve(rom, tiles)
+
+    if compression == 'lz77':
+        gfx = decomp_lz77_cached(rom, gba2hex(tilesAddr), cache)[0]
+        if size is not None:
+            gfx = gfx[:0x20*size]
+        # one palette row per 64 tiles
+        colours = max(len(gfx)//0x800, 1)*16
+    else:
+        gfx = rom.view(tilesAddr, 0x20*size)
+        colours = 16
+
+    return (gfx, rom.u16(resolve(rom, palette), colours))
+
+def init_worker(rom_path):
+    global rom
+    rom = Rom(rom_path)
+
+def extract_worker(job, previous, force, cache):
+    '''Returns (status, digest) of a job, status being built, unchanged or hand-made'''
+    output = job[5]
+    (gfx, palette555) = read_job(rom, job, cache)
+    digest = hashlib.sha1(repr(job).encode() + bytes(gfx) + palette555.tobytes()).hexdigest()
+
+    if os.access(output, os.F_OK) and not force:
+        if previous is None:
+            return ('hand-made', digest)
+        if previous == digest:
+            return ('unchanged', digest)
+
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    # per process, so a server and a command line run writing the same sheet never share a temporary file
+    tmp = f'{output}.{os.getpid()}.tmp'
+    try:
+        tiles_image(gfx, palette555, job[3]).save(tmp, format='PNG')
+        os.replace(tmp, output)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return ('built', digest)
+
+def run_jobs(jobs, workers=None, rom_path='mzm.gba', force=False, cache=default_cache):
+    '''Runs tile jobs on a process pool, skipping outputs whose graphics and palette have not changed'''
+    manifest = BuildManifest(os.path.join(CACHE_DIR, 'tiles.manifest.json'))
+    errors = []
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(rom_path,)) as executor:
+        futures = [(job[5], executor.submit(extract_worker, job, manifest.digests.get(job[5]), force, cache)) for job in jobs]
+        for (output, future) in futures:
+            try:
+                (status, digest) = future.result()
+            except Exception as e:
+                errors.append(f'{output}: {type(e).__name__}: {e}')
+                print(errors[-1], file=sys.stderr)
+                continue
+
+            if status == 'built':
+                manifest.record(output, digest)
+            elif status == 'unchanged':
+                manifest.skipped += 1
+            else:
+                print(f'{output} was not made by misc_tiles.py, not overwriting it (use --force)', file=sys.stderr)
+
+    manifest.save()
+    print(f'{manifest.built} sheets built, {manifest.skipped} up to date')
+    return errors
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Extracts the tile sheets listed in a job file')
+    parser.add_argument('outputs', nargs='*', help='only run jobs whose output starts with one of these, e.g. beams/')
+    parser.add_argument('--job-file', default=DEFAULT_JOB_FILE)
+    parser.add_argument('--rom', default='mzm.gba')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='worker processes (default: CPU count)')
+    parser.add_argument('--force', action='store_true', help='rebuild every output, including ones made by hand')
+    parser.add_argument('--no-cache', dest='cache', action='store_false', help='decompress graphics instead of using .cache/objects')
+    args = parser.parse_args()
+
+    jobs = read_jobs(args.job_file)
+    if args.outputs:
+        jobs = [job for job in jobs if job[5].startswith(tuple(args.outputs))]
+
+    if run_jobs(jobs, args.jobs, args.rom, args.force, default_cache if args.cache else None):
+        sys.exit(1)
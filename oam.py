@@ -0,0 +1,182 @@
+''' GBA OAM entries, decoded and split for a whole spritemap at once. Documented at https://www.coranac.com/tonc/text/regobj.htm '''
+
+from typing import NamedTuple
+import numpy as np
+from rom import gba2hex
+
+tile_dimensions = [[(8,8),(16,16),(32,32),(64,64)],[(16,8),(32,8),(32,16),(64,32)],[(8,16),(8,32),(16,32),(32,64)]]
+# [shape, size] -> (width, height)
+OBJ_DIMENSIONS = np.array(tile_dimensions, dtype=np.int16)
+
+# decode_spritemap output, one record per OAM entry
+OAM_DTYPE = np.dtype([
+    ('x', 'i2'), ('y', 'i2'), ('shape', 'u1'), ('size', 'u1'), ('tile', 'i2'),
+    ('palette', 'i1'), ('bg_priority', 'u1'), ('h_flip', '?'), ('v_flip', '?')
+])
+
+# split_spritemap output, in the field order of the spritemap editor's JSON
+SPRITEMAP_DTYPE = np.dtype([
+    ('x', 'i2'), ('y', 'i2'), ('tile', 'i2'), ('palette', 'i1'),
+    ('bg_priority', 'u1'), ('h_flip', '?'), ('v_flip', '?'), ('big', '?')
+])
+
+class OamEntry(NamedTuple):
+    '''An 8x8 or 16x16 spritemap entry as in the spritemap editor's JSON'''
+    x: int
+    y: int
+    tile: int
+    palette: int
+    bg_priority: int
+    h_flip: bool
+    v_flip: bool
+    big: bool
+
+def decode_spritemap(attributes):
+    '''Decodes an (N, 3) array of OAM attributes to an OAM_DTYPE record array'''
+    attributes = np.asarray(attributes, dtype=np.uint16).reshape(-1, 3).astype(np.int32)
+    (attr0, attr1, attr2) = attributes.T
+
+    entries = np.empty(len(attributes), dtype=OAM_DTYPE)
+    entries['x'] = (attr1 & 0x1FF) - (attr1 & 0x100)*2
+    entries['y'] = (attr0 & 0xFF) - (attr0 & 0x80)*2
+    entries['shape'] = attr0 >> 0xE
+    entries['size'] = attr1 >> 0xE
+    entries['tile'] = attr2 & 0x3FF
+    entries['palette'] = (attr2 >> 0xC & 0xF) - 8
+    entries['bg_priority'] = attr2 >> 0xA & 0x3
+    entries['h_flip'] = attr1 & 0x1000 != 0
+    entries['v_flip'] = attr1 & 0x2000 != 0
+    return entries
+
+def read_spritemap(rom, addr):
+    '''Reads and decodes a spritemap: a u16 count followed by count OAM attribute triples'''
+    count = rom.read(2, addr)
+    return decode_spritemap(rom.u16(addr + 2, count*3))
+
+def read_spritemaps(rom, addresses):
+    '''Reads and decodes many spritemaps at once
+
+    Returns (entries, offsets), the entries of spritemap i being entries[offsets[i]:offsets[i+1]].'''
+    starts = np.array([gba2hex(address) for address in addresses], dtype=np.int64)
+    if np.any(starts % 2):
+        raise ValueError('Spritemaps must be halfword aligned')
+    words = rom.u16(0x8000000, len(rom)//2)
+    starts //= 2
+
+    counts = words[starts].astype(np.int64)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    entry = np.arange(offsets[-1]) - np.repeat(offsets[:-1], counts)
+    first_word = np.repeat(starts + 1, counts) + 3*entry
+    return (decode_spritemap(words[first_word[:, np.newaxis] + np.arange(3)]), offsets)
+
+def read_frame_table(rom, addr):
+    '''Returns the (spritemap pointer, timer) entries of an animation as an (N, 2) array, up to the null pointer ending it'''
+    tables = []
+    chunk = 16
+    while True:
+        count = min(chunk, (len(rom) - gba2hex(addr)) // 8)
+        if count <= 0:
+            break
+        entries = rom.u32(addr, count*2).reshape(-1, 2)
+        end = np.flatnonzero(entries[:, 0] == 0)
+        if len(end):
+            tables.append(entries[:end[0]])
+            break
+        tables.append(entries)
+        addr += count*8
+        chunk *= 2
+
+    return np.concatenate(tables) if tables else np.zeros((0, 2), dtype=np.uint32)
+
+def piece_layout(entries):
+    '''Returns (width, height, piece size, columns, rows) of decoded entries'''
+    (width, height) = OBJ_DIMENSIONS[entries['shape'], entries['size']].T
+    piece = np.where((width % 16 == 0) & (height % 16 == 0), 16, 8)
+    return (width, height, piece, width // piece, height // piece)
+
+def split_spritemap(entries):
+    '''Splits decoded entries into 16x16 pieces, or 8x8 ones when a side isn't a multiple of 16
+
+    Returns a SPRITEMAP_DTYPE record array with the pieces of each entry in turn, column by column.'''
+    (width, height, piece, columns, rows) = piece_layout(entries)
+    counts = columns * rows
+
+    source = np.repeat(np.arange(len(entries)), counts)
+    k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    (width, height, piece, rows) = (width[source], height[source], piece[source], rows[source])
+    (column, row) = (k // rows, k % rows)
+    entries = entries[source]
+
+    pieces = np.empty(len(entries), dtype=SPRITEMAP_DTYPE)
+    pieces['x'] = entries['x'] + np.where(entries['h_flip'], width - piece - column*piece, column*piece)
+    pieces['y'] = entries['y'] + np.where(entries['v_flip'], height - piece - row*piece, row*piece)
+    pieces['tile'] = entries['tile'] + column*(piece//8) + row*(piece*4)
+    for field in ('palette', 'bg_priority', 'h_flip', 'v_flip'):
+        pieces[field] = entries[field]
+    pieces['big'] = piece == 16
+    return pieces
+
+def split_spritemaps(entries, offsets):
+    '''split_spritemap on the output of read_spritemaps, returning (pieces, offsets) the same way'''
+    (width, height, piece, columns, rows) = piece_layout(entries)
+    piece_offsets = np.concatenate([[0], np.cumsum(columns * rows)])[offsets]
+    return (split_spritemap(entries), piece_offsets)
+
+def spritemap_entries(pieces):
+    '''Returns a SPRITEMAP_DTYPE record array as a list of OamEntry'''
+    return [OamEntry._make(piece) for piece in pieces.tolist()]
+
+if __name__ == "__main__":
+    # Benchmark over every OAM frame table in the symbols, against reading each attribute on its own
+    import sys, time
+    from labels import load_symbols
+    from rom import Rom
+
+    def read_spritemap_scalar(rom, addr):
+        entries = []
+        for i in range(rom.read(2, addr)):
+            attributes = [rom.read(2, addr + 2 + 6*i + 2*j) for j in range(3)]
+            entries.append(((attributes[1] & 0x1FF) - (attributes[1] & 0x100)*2, (attributes[0] & 0xFF) - (attributes[0] & 0x80)*2,
+                            attributes[0] >> 0xE, attributes[1] >> 0xE, attributes[2] & 0x3FF, (attributes[2] >> 0xC & 0xF) - 8,
+                            attributes[2] >> 0xA & 0x3, attributes[1] & 0x1000 != 0, attributes[1] & 0x2000 != 0))
+        return entries
+
+    def read_frame_table_scalar(rom, addr):
+        frames = []
+        while rom.read(4, addr) != 0:
+            frames.append((rom.read(4, addr), rom.read(4, addr + 4)))
+            addr += 8
+        return frames
+
+    rom = Rom(sys.argv[1] if len(sys.argv) > 1 else "mzm.gba")
+    symbols = load_symbols(sys.argv[2] if len(sys.argv) > 2 else "mzm_us.map")
+    tables = [address for (address, name) in symbols.match('*[Oo][Aa][Mm]*', 0x8000000, 0xA000000) if address % 4 == 0]
+
+    frames = set()
+    for address in tables:
+        frames.update(pointer for (pointer, timer) in read_frame_table(rom, address).tolist() if 0x8000000 <= pointer < 0xA000000 and rom.read(2, pointer) <= 128)
+    frames = sorted(frames)
+    entry_count = sum(rom.read(2, frame) for frame in frames)
+
+    def read_all_scalar():
+        for address in tables:
+            read_frame_table_scalar(rom, address)
+        for frame in frames:
+            read_spritemap_scalar(rom, frame)
+
+    def read_all_per_frame():
+        for address in tables:
+            read_frame_table(rom, address)
+        for frame in frames:
+            read_spritemap(rom, frame)
+
+    def read_all_batch():
+        for address in tables:
+            read_frame_table(rom, address)
+        read_spritemaps(rom, frames)
+
+    for (name, read_all) in [('scalar', read_all_scalar), ('numpy per frame', read_all_per_frame), ('numpy batch', read_all_batch)]:
+        start = time.perf_counter()
+        read_all()
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {len(tables)} frame tables, {len(frames)} frames, {entry_count} entries in {elapsed*1000:.1f} ms")
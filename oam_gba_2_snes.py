@@ -1,109 +1,196 @@
 # Requires a ZM rom (mzm.gba) and symbols (mzm_us.map) from the decomp (https://github.com/metroidret/mzm).
 
-import base64, copy, json, sys
-from labels import extract_labels
+import argparse, base64, json, os, sys
+import profiling
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from cache import cached, default_cache, file_hash
+from labels import load_symbols
 from PIL import Image
 import numpy as np
-from decompressor import decomp_lz77
-
-gba2hex = lambda address: address & 0x1FFFFFF
-hex2gba = lambda address: address & 0x1FFFFFF | 0x8000000
-
-def romRead(n = 1, address = None):
-    if address is not None:
-        prevAddress = rom.tell()
-        rom.seek(gba2hex(address))
-
-    ret = int.from_bytes(rom.read(n), 'little')
-    if address is not None:
-        rom.seek(prevAddress)
-        
-    return ret
-
-def romSeek(address):
-    return rom.seek(gba2hex(address))
-
-def romTell():
-    return hex2gba(rom.tell())
-
-tile_dimensions = [[(8,8),(16,16),(32,32),(64,64)],[(16,8),(32,8),(32,16),(64,32)],[(8,16),(8,32),(16,32),(32,64)]]
-
-def remap_gba_2_snes_tile(tile, gba_gfx, snes_gfx, gba_gfx_offset, snes_gfx_offset, big=False):
+from decompressor import lz77_size
+from gfx_4bpp import convert_to_4bpp, image_to_tiles
+from oam import read_frame_table, read_spritemap, read_spritemaps, split_spritemap, split_spritemaps, spritemap_entries
+from rom import Rom, bgr555_to_rgb, gba2hex
+from spritemap_bin import json_to_binary
+from xref import pointer_index
+
+# bump when the conversion output changes, to invalidate cached spritemaps
+SPRITEMAP_CACHE_VERSION = 3
+
+H_FLIP = 1
+V_FLIP = 2
+
+def flip_tile(tile: bytes, flip):
+    '''Flips 64 bytes of 8x8 tile data'''
+    rows = [tile[i:i+8] for i in range(0, 64, 8)]
+    if flip & H_FLIP:
+        rows = [row[::-1] for row in rows]
+    if flip & V_FLIP:
+        rows.reverse()
+    return b''.join(rows)
+
+def flip_quad(quad, flip):
+    '''Flips a 16x16 region given as its top-left, top-right, bottom-left and bottom-right tiles'''
+    (tl, tr, bl, br) = [flip_tile(tile, flip) for tile in quad]
+    if flip & H_FLIP:
+        (tl, tr, bl, br) = (tr, tl, br, bl)
+    if flip & V_FLIP:
+        (tl, tr, bl, br) = (bl, br, tl, tr)
+    return (tl, tr, bl, br)
+
+def index_snes_gfx(snes_gfx, flips=True):
+    '''Hashes SNES tiles and 16x16 regions so GBA tiles can be remapped without scanning the sheet
+
+    Every flip variant of a tile is a key, mapping to (index, flip) where flip is the H_FLIP/V_FLIP
+    bits to XOR into the entry so that the SNES tile is drawn as the GBA one.'''
+    tiles = {}
+    quads = {}
+
+    snes_quads = [(idx, (snes_gfx[idx], snes_gfx[idx + 1], snes_gfx[idx + 0x10], snes_gfx[idx + 0x11]))
+                  for idx in range(len(snes_gfx) - 0x11) if idx & 0xF != 0xF]
+
+    # exact matches take priority over flipped ones, and the first occurrence wins, like list.index
+    for flip in ((0, H_FLIP, V_FLIP, H_FLIP | V_FLIP) if flips else (0,)):
+        for idx, tile in enumerate(snes_gfx):
+            tiles.setdefault(flip_tile(tile, flip), (idx, flip))
+        for idx, quad in snes_quads:
+            quads.setdefault(b''.join(flip_quad(quad, flip)), (idx, flip))
+
+    return (tiles, quads)
+
+def remap_gba_2_snes_tile(tile, gba_gfx, snes_index, gba_gfx_offset, snes_gfx_offset, big=False):
+    '''Returns (SNES tile index, flip bits to XOR into the entry)'''
+    (snes_tiles, snes_quads) = snes_index
     try:
         if big:
-            for idx in range(len(snes_gfx) - 0x11):
-                if idx & 0xF != 0xF:
-                    if gba_gfx[tile - gba_gfx_offset] == snes_gfx[idx]:
-                        if gba_gfx[tile + 1 - gba_gfx_offset] == snes_gfx[idx + 1]:
-                            if gba_gfx[tile + 0x20 - gba_gfx_offset] == snes_gfx[idx + 0x10]:
-                                if gba_gfx[tile + 0x21 - gba_gfx_offset] == snes_gfx[idx + 0x11]:
-                                    return idx + snes_gfx_offset
+            if snes_quads:
+                quad = gba_gfx[tile - gba_gfx_offset] + gba_gfx[tile + 1 - gba_gfx_offset] + gba_gfx[tile + 0x20 - gba_gfx_offset] + gba_gfx[tile + 0x21 - gba_gfx_offset]
+                if quad in snes_quads:
+                    (idx, flip) = snes_quads[quad]
+                    return (idx + snes_gfx_offset, flip)
             # failed to match 16x16 region, split into four 8x8 tiles
-            return -1
+            if profiling.enabled:
+                profiling.count('16x16 match failures')
+            return (-1, 0)
         else:
-            if gba_gfx[tile - gba_gfx_offset] == [0]*64:
+            if gba_gfx[tile - gba_gfx_offset] == bytes(0x40):
                 # blank tile
-                return -2
-            if gba_gfx[tile - gba_gfx_offset] in snes_gfx:
-                return snes_gfx.index(gba_gfx[tile - gba_gfx_offset]) + snes_gfx_offset
+                return (-2, 0)
+            if gba_gfx[tile - gba_gfx_offset] in snes_tiles:
+                (idx, flip) = snes_tiles[gba_gfx[tile - gba_gfx_offset]]
+                return (idx + snes_gfx_offset, flip)
     except:
         pass
-    return snes_gfx_offset
-
-def build_gfx(fp):
-    image = Image.open(fp)
-    out = []
-    for y in range(0, image.height, 8):
-        for x in range(0, image.width, 8):
-            out.append([pixel & 0xF for pixel in image.crop((x, y, x + 8, y + 8)).getdata()])
-    return out
-
-# Documented at https://www.coranac.com/tonc/text/regobj.htm
-def decode_spritemap_entry(entry):
-    return {
-        'x': (entry[1] & 0x1FF) - (0x200 if (entry[1] & 0x1FF) >= 0x100 else 0),
-        'y': (entry[0] & 0xFF) - (0x100 if (entry[0] & 0xFF) >= 0x80 else 0),
-        'shape': entry[0] >> 0xE,
-        'size': entry[1] >> 0xE,
-        'tile': entry[2] & 0x3FF,
-        'palette': (entry[2] >> 0xC & 0xF) - 8,
-        'bg_priority': entry[2] >> 0xA & 0x3,
-        'h_flip': entry[1] & 0x1000 == 0x1000,
-        'v_flip': entry[1] & 0x2000 == 0x2000
-    }
-
-def split_spritemap_entry(entry: dict):
-    split_entries = []
-    (width, height) = tile_dimensions[entry['shape']][entry['size']]
-    split_tile_size = 16 if width % 16 == 0 and height % 16 == 0 else 8
-
-    for x in range(width//split_tile_size):
-        for y in range(height//split_tile_size):
-            split_entry = copy.copy(entry)
-            split_entry['x'] += abs(x*split_tile_size-(width-split_tile_size if split_entry['h_flip'] else 0))
-            split_entry['y'] += abs(y*split_tile_size-(height-split_tile_size if split_entry['v_flip'] else 0))
-            split_entry['tile'] += x*(split_tile_size//8) + y*(split_tile_size*4)
-            split_entry['big'] = split_tile_size == 16
-            split_entry.pop('shape')
-            split_entry.pop('size')
-            split_entries.append(split_entry)
-
-    return split_entries
-
-def extract_generic(rom, pal_ptr, pal_count, spritemap_start, name, gba_gfx, snes_gfx, gba_gfx_offset, snes_gfx_offset):
-    romSeek(pal_ptr)
-    palette555 = [romRead(2) for i in range(16*pal_count)]
-    palette888 = [int.from_bytes([
-        255,                         # A
-        (color555 & 0x1F) << 3,      # R
-        (color555 >> 5 & 0x1F) << 3, # G
-        (color555 >> 10 & 0x1F) << 3 # B
-    ], 'big') for color555 in palette555]
-
-    romSeek(spritemap_start)
-    spritemaps = extract_spritemaps(gba_gfx, snes_gfx, gba_gfx_offset, snes_gfx_offset)
-
-    return {
+    if profiling.enabled:
+        profiling.count('unmatched tiles')
+    return (snes_gfx_offset, 0)
+
+def apply_flip(entry, flip):
+    '''Returns an OamEntry with flip bits XORed in'''
+    if flip:
+        entry = entry._replace(h_flip=entry.h_flip ^ (flip & H_FLIP != 0), v_flip=entry.v_flip ^ (flip & V_FLIP != 0))
+    return entry
+
+def entry_flip(entry):
+    return (H_FLIP if entry['h_flip'] else 0) | (V_FLIP if entry['v_flip'] else 0)
+
+def entry_size(entry):
+    return 16 if entry['big'] else 8
+
+def overlaps(a, b):
+    return a['x'] < b['x'] + entry_size(b) and b['x'] < a['x'] + entry_size(a) and a['y'] < b['y'] + entry_size(b) and b['y'] < a['y'] + entry_size(a)
+
+def max_sprites_per_line(spritemap):
+    '''Returns the most entries of a spritemap drawn on one scanline'''
+    lines = Counter(y for entry in spritemap for y in range(entry['y'], entry['y'] + entry_size(entry)))
+    return max(lines.values(), default=0)
+
+def quad_members(spritemap, cells, x, y, snes_gfx, snes_gfx_offset):
+    '''Returns (indices, displayed 16x16 region) of the 8x8 entries drawing the region at x, y, or None'''
+    members = []
+    quad = b''
+    for (dx, dy) in ((0, 0), (8, 0), (0, 8), (8, 8)):
+        indices = cells.get((x + dx, y + dy), [])
+        if len(indices) > 1:
+            return None
+        if not indices:
+            # no entry there, so the region has to be blank there
+            quad += bytes(0x40)
+            continue
+        entry = spritemap[indices[0]]
+        idx = entry['tile'] - snes_gfx_offset
+        if not 0 <= idx < len(snes_gfx):
+            return None
+        members.append(indices[0])
+        quad += flip_tile(snes_gfx[idx], entry_flip(entry))
+
+    first = spritemap[members[0]] if members else None
+    if len(members) < 2 or any((spritemap[i]['palette'], spritemap[i]['bg_priority']) != (first['palette'], first['bg_priority']) for i in members):
+        return None
+    return (sorted(members), quad)
+
+def keeps_order(spritemap, members, position):
+    '''Whether drawing all members at position keeps every overlapping entry above or below them as before'''
+    for i in members:
+        for k in range(min(i, position) + 1, max(i, position)):
+            if k not in members and overlaps(spritemap[k], spritemap[i]):
+                return False
+    return True
+
+def merge_spritemap(spritemap, snes_gfx, snes_quads, snes_gfx_offset):
+    '''Replaces 8x8 entries drawing a 16x16 region of the SNES sheet with one 16x16 entry
+
+    Groups with the most entries are merged first. A group takes the place of its first or last
+    entry, and only if that doesn't change which entries are drawn over it.'''
+    spritemap = list(spritemap)
+    while True:
+        cells = {}
+        for (i, entry) in enumerate(spritemap):
+            if not entry['big']:
+                cells.setdefault((entry['x'], entry['y']), []).append(i)
+
+        best = None
+        for (x, y) in dict.fromkeys((x - dx, y - dy) for (x, y) in cells for dx in (0, 8) for dy in (0, 8)):
+            group = quad_members(spritemap, cells, x, y, snes_gfx, snes_gfx_offset)
+            if group is None or group[1] not in snes_quads or (best is not None and len(group[0]) <= len(best[0])):
+                continue
+            (members, quad) = group
+            for position in (members[0], members[-1]):
+                if keeps_order(spritemap, members, position):
+                    (idx, flip) = snes_quads[quad]
+                    first = spritemap[members[0]]
+                    best = (members, position, dict(first, x=x, y=y, tile=idx + snes_gfx_offset, h_flip=flip & H_FLIP != 0, v_flip=flip & V_FLIP != 0, big=True))
+                    break
+
+        if best is None:
+            return spritemap
+        (members, position, merged) = best
+        spritemap = [merged if i == position else entry for (i, entry) in enumerate(spritemap) if i == position or i not in members]
+
+def merge_spritemaps(spritemaps, snes_gfx, snes_quads, snes_gfx_offset):
+    '''Merges the entries of every spritemap of the JSON in place
+
+    Returns (name, entries before, entries after, max sprites per scanline before, after) for each.'''
+    stats = []
+    for spritemap in spritemaps:
+        before = spritemap['spritemap']
+        after = merge_spritemap(before, snes_gfx, snes_quads, snes_gfx_offset)
+        stats.append((spritemap['name'], len(before), len(after), max_sprites_per_line(before), max_sprites_per_line(after)))
+        spritemap['spritemap'] = after
+    return stats
+
+def build_gfx(fp, cache=None):
+    '''Returns the tiles of an image as 64 bytes of pixels each'''
+    return cached(cache, ('build_gfx', file_hash(fp)), lambda: [tile.tobytes() for tile in image_to_tiles(Image.open(fp)) & 0xF])
+
+def extract_generic(rom, pal_ptr, pal_count, spritemap_start, name, gba_gfx, snes_index, gba_gfx_offset, snes_gfx_offset):
+    paletteRgb = bgr555_to_rgb(rom.u16(pal_ptr, 16*pal_count)).astype(np.uint32)
+    palette888 = (0xFF000000 | paletteRgb[:, 0] << 16 | paletteRgb[:, 1] << 8 | paletteRgb[:, 2]).tolist() # ARGB
+
+    (spritemaps, anim_asm) = extract_spritemaps(rom, spritemap_start, gba_gfx, snes_index, gba_gfx_offset, snes_gfx_offset)
+
+    return ({
         'game': 'sm',
         'name': name,
         'gfx': "",
@@ -113,108 +200,72 @@ def extract_generic(rom, pal_ptr, pal_count, spritemap_start, name, gba_gfx, sne
         'spritemaps': spritemaps,
         'ext_hitboxes': [],
         'ext_spritemaps': []
-    }
+    }, anim_asm)
 
-def ParseOam(gba_gfx, snes_gfx, gba_gfx_offset, snes_gfx_offset):
-    count = romRead(2)
-    spritemap = []
-    if count != 0:
-        for i in range(count):
-            spritemap.extend(split_spritemap_entry(decode_spritemap_entry([romRead(2) for j in range(3)])))
+def ParseOam(rom, addr, gba_gfx, snes_index, gba_gfx_offset, snes_gfx_offset):
+    return remap_spritemap(split_spritemap(read_spritemap(rom, addr)), gba_gfx, snes_index, gba_gfx_offset, snes_gfx_offset)
+
+def remap_spritemap(pieces, gba_gfx, snes_index, gba_gfx_offset, snes_gfx_offset):
+    '''Remaps split spritemap pieces to SNES tiles, returning them as dicts for the JSON'''
+    def remap(tile, big):
+        if profiling.enabled:
+            profiling.count('tiles remapped')
+        return remap_gba_2_snes_tile(tile, gba_gfx, snes_index, gba_gfx_offset, snes_gfx_offset, big)
 
-    spritemap2 = []
-    for entry in spritemap:
-        remapped_tile_idx = remap_gba_2_snes_tile(entry['tile'], gba_gfx, snes_gfx, gba_gfx_offset, snes_gfx_offset, entry['big'])
+    spritemap = []
+    for entry in spritemap_entries(pieces):
+        (remapped_tile_idx, flip) = remap(entry.tile, entry.big)
         if remapped_tile_idx >= 0:
-            entry['tile'] = remapped_tile_idx
-            spritemap2.append(entry)
+            spritemap.append(apply_flip(entry._replace(tile=remapped_tile_idx), flip))
         elif remapped_tile_idx == -1:
             # Split into four 8x8 tiles
-            tile0 = copy.copy(entry)
-            tile0['big'] = False
-            if entry['h_flip']:
-                tile0['x'] += 8
-            if entry['v_flip']:
-                tile0['y'] += 8
-            tile0['tile'] = remap_gba_2_snes_tile(tile0['tile'], gba_gfx, snes_gfx, gba_gfx_offset, snes_gfx_offset, False)
-
-            tile1 = copy.copy(entry)
-            tile1['big'] = False
-            tile1['tile'] += 1
-            if not entry['h_flip']:
-                tile1['x'] += 8
-            if entry['v_flip']:
-                tile1['y'] += 8
-            tile1['tile'] = remap_gba_2_snes_tile(tile1['tile'], gba_gfx, snes_gfx, gba_gfx_offset, snes_gfx_offset, False)
-
-            tile2 = copy.copy(entry)
-            tile2['big'] = False
-            tile2['tile'] += 0x20
-            if entry['h_flip']:
-                tile2['x'] += 8
-            if not entry['v_flip']:
-                tile2['y'] += 8
-            tile2['tile'] = remap_gba_2_snes_tile(tile2['tile'], gba_gfx, snes_gfx, gba_gfx_offset, snes_gfx_offset, False)
-
-            tile3 = copy.copy(entry)
-            tile3['big'] = False
-            tile3['tile'] += 0x21
-            if not entry['h_flip']:
-                tile3['x'] += 8
-            if not entry['v_flip']:
-                tile3['y'] += 8
-            tile3['tile'] = remap_gba_2_snes_tile(tile3['tile'], gba_gfx, snes_gfx, gba_gfx_offset, snes_gfx_offset, False)
-
-            # Delete blank tiles
-            if tile0['tile'] != -2:
-                spritemap2.append(tile0)
-            if tile1['tile'] != -2:
-                spritemap2.append(tile1)
-            if tile2['tile'] != -2:
-                spritemap2.append(tile2)
-            if tile3['tile'] != -2:
-                spritemap2.append(tile3)
-
-    return spritemap2
-
-def ParseFrameData():
-    frameData = []
-    while True:
-        pFrame = romRead(4)
-        timer = romRead(4)
-        if pFrame == 0:
-            break
-        frameData.append((pFrame, timer))
+            for (dx, dy, offset) in ((0, 0, 0), (8, 0, 1), (0, 8, 0x20), (8, 8, 0x21)):
+                (tile, flip) = remap(entry.tile + offset, False)
+                # Delete blank tiles
+                if tile != -2:
+                    x = entry.x + (8 - dx if entry.h_flip else dx)
+                    y = entry.y + (8 - dy if entry.v_flip else dy)
+                    spritemap.append(apply_flip(entry._replace(x=x, y=y, tile=tile, big=False), flip))
+
+    return [entry._asdict() for entry in spritemap]
 
-    return frameData
+def ParseFrameData(rom, addr):
+    return [tuple(entry) for entry in read_frame_table(rom, addr).tolist()]
 
-def extract_spritemaps(gba_gfx, snes_gfx, gba_gfx_offset, snes_gfx_offset):
+def extract_spritemaps(rom, spritemap_start, gba_gfx, snes_index, gba_gfx_offset, snes_gfx_offset):
     frames = []
+    frame_set = set()
     spritemaps_dict = {}
     namedFrames = {}
 
     anim_asm = ""
 
-    while True:
-        currentAddr = romTell()
-        if currentAddr % 4 != 0:
-            rom.read(4 - (currentAddr % 4)) # align
-        pointer = romRead(4)
-        if pointer in spritemaps_dict:
-            romSeek(romTell()-4)
-            break
-        romSeek(currentAddr)
-        frames.append(currentAddr)
-        spritemaps_dict[currentAddr] = ParseOam(gba_gfx, snes_gfx, gba_gfx_offset, snes_gfx_offset)
+    with profiling.stage('OAM parsing'):
+        currentAddr = spritemap_start
+        while True:
+            # frames end where the (aligned) animation data pointing to them starts
+            anim_addr = (currentAddr + 3) // 4 * 4
+            pointer = rom.read(4, anim_addr)
+            if pointer in frame_set:
+                break
+            frames.append(currentAddr)
+            frame_set.add(currentAddr)
+            currentAddr += 2 + 6*rom.read(2, currentAddr)
+
+        # decoded and split together, then remapped frame by frame
+        (pieces, offsets) = split_spritemaps(*read_spritemaps(rom, frames))
+    profiling.count('OAM entries read', len(pieces))
+
+    with profiling.stage('tile remapping'):
+        for (i, addr) in enumerate(frames):
+            spritemaps_dict[addr] = remap_spritemap(pieces[offsets[i]:offsets[i+1]], gba_gfx, snes_index, gba_gfx_offset, snes_gfx_offset)
 
     while True:
-        anim_addr = romTell()
-        pointer = romRead(4)
-        romSeek(anim_addr)
+        pointer = rom.read(4, anim_addr)
         if pointer not in spritemaps_dict:
             break
 
-        anim = ParseFrameData()
+        anim = ParseFrameData(rom, anim_addr)
         for i in range(len(anim)):
             if anim[i][0] not in namedFrames:
                 namedFrames[anim[i][0]] = f"{all_labels[anim_addr]}_Frame{i}"
@@ -223,6 +274,7 @@ def extract_spritemaps(gba_gfx, snes_gfx, gba_gfx_offset, snes_gfx_offset):
         for (p_oam, timer) in anim:
             anim_asm += f"  dw {timer},{namedFrames[p_oam]}\n"
         anim_asm += f"  dw $80ED,{all_labels[anim_addr]}\n\n"
+        anim_addr += 8*(len(anim) + 1)
 
     output = []
     for addr in frames:
@@ -231,100 +283,169 @@ def extract_spritemaps(gba_gfx, snes_gfx, gba_gfx_offset, snes_gfx_offset):
             "spritemap": spritemaps_dict[addr]
         })
 
-    print(anim_asm)
-
-    return output
+    return (output, anim_asm)
 
-def extract_enemy(rom, sprite_id, name, gba_gfx, snes_gfx, spritemap_start=None):
-    pal_ptr = romRead(4, 0x875EEF0+(sprite_id-0x10)*4)
-    gfx_ptr = romRead(4, 0x875EBF8+(sprite_id-0x10)*4)
+def extract_enemy(rom, sprite_id, name, gba_gfx, snes_index, spritemap_start=None):
+    pal_ptr = rom.read(4, 0x875EEF0+(sprite_id-0x10)*4)
+    gfx_ptr = rom.read(4, 0x875EBF8+(sprite_id-0x10)*4)
 
     # get row count based on decompressed gfx height
-    row_count = len(decomp_lz77(rom, gfx_ptr & 0x1FFFFFF)[0]) // 0x800
+    row_count = lz77_size(rom, gba2hex(gfx_ptr)) // 0x800
 
     if spritemap_start == None:
-        spritemap_start = pal_ptr+0x20*row_count # doesn't work for a few enemies
-
-    return extract_generic(rom, pal_ptr, row_count, spritemap_start, name, gba_gfx, snes_gfx, 0x200, 0x100)
-
-def convert_to_4bpp(image: Image):
-    '''Converts an image to SNES 4bpp tiles as bytearray'''
-    if image.mode not in ('P', 'PA'):
-        raise AssertionError('Mode must be "P"')
-
-    output = bytearray()
-
-    for y in range(0, image.height, 8):
-        for x in range(0, image.width, 8):
-            tile = image.crop([x, y, x+8, y+8])
-            output.extend(convert_indexed_tile_to_bitplanes(tile.getdata()))
-
-    return output
-
-def convert_indexed_tile_to_bitplanes(indexed_tile):
-    # this should literally just be the inverse of
-    #  convert_tile_from_bitplanes(), and so it was written in this way
-    fixed_bits = np.array(indexed_tile, dtype=np.uint8).reshape(8, 8, 1)
-    tile_bits = np.unpackbits(fixed_bits, axis=2, bitorder='little')
-    tile = np.packbits(tile_bits, axis=1, bitorder='big')
-
-    low_bitplanes = np.ravel(tile[:, 0, 0:2])
-    high_bitplanes = np.ravel(tile[:, 0, 2:4])
-    return np.append(low_bitplanes, high_bitplanes)
-
-def export_sprite_oam(sprite_id, name, spritemap_start=None):
-    gba_gfx = build_gfx(f'sprite_tiles_original/0x{sprite_id:02x}.png')
-    snes_gfx = build_gfx(f'sprites/{name}/0x{sprite_id:02x}_sm.png')
+        # found from the frame tables, so padding after the palette doesn't matter
+        spritemap_start = pointer_index(rom).spritemap_start(pal_ptr+0x20*row_count)
+    if spritemap_start == None:
+        spritemap_start = pal_ptr+0x20*row_count
 
-    data = extract_enemy(rom, sprite_id, f'{name}', gba_gfx, snes_gfx, spritemap_start)
-    image = Image.open(f'sprites/{name}/0x{sprite_id:02x}_sm.png')
-    data['gfx'] =  str(base64.b64encode(convert_to_4bpp(image)), 'utf8')
+    return extract_generic(rom, pal_ptr, row_count, spritemap_start, name, gba_gfx, snes_index, 0x200, 0x100)
 
-    json.dump(data, open(f'sprites/{name}/{name}.json', 'w'), indent=1)
+def write_atomic(fp, text):
+    '''Writes text or bytes through a temporary file so readers never see the file half-written'''
+    # per process, so workers writing the same file never share a temporary one
+    tmp = f'{fp}.{os.getpid()}.tmp'
+    try:
+        with open(tmp, 'wb' if isinstance(text, bytes) else 'w') as f:
+            f.write(text)
+        os.replace(tmp, fp)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def export_sprite_oam(rom, sprite_id, name, spritemap_start=None, flips=True, cache=default_cache, merge=True, binary=False):
+    '''Writes the JSON and anims.txt of an enemy, and the binary container if asked, returning the merge_spritemaps stats'''
+    gba_fp = f'sprite_tiles_original/0x{sprite_id:02x}.png'
+    snes_fp = f'sprites/{name}/0x{sprite_id:02x}_sm.png'
+
+    def convert():
+        with profiling.stage('tile sheet loading'):
+            gba_gfx = build_gfx(gba_fp, cache)
+            snes_gfx = build_gfx(snes_fp, cache)
+        with profiling.stage('tile indexing'):
+            snes_index = index_snes_gfx(snes_gfx, flips)
+        (data, anim_asm) = extract_enemy(rom, sprite_id, f'{name}', gba_gfx, snes_index, spritemap_start)
+        if merge:
+            with profiling.stage('merging'):
+                stats = merge_spritemaps(data['spritemaps'], snes_gfx, snes_index[1], data['gfx_offset'])
+        else:
+            stats = [(spritemap['name'], len(spritemap['spritemap']), len(spritemap['spritemap']), max_sprites_per_line(spritemap['spritemap']), max_sprites_per_line(spritemap['spritemap'])) for spritemap in data['spritemaps']]
+        return (data, anim_asm, stats)
+
+    if cache is not None and getattr(all_labels, 'digest', None) is not None:
+        # only reconverted when the ROM, symbols, tile sheets or options change
+        key = ('export_sprite_oam', SPRITEMAP_CACHE_VERSION, rom.digest, all_labels.digest, sprite_id, name, spritemap_start, flips, merge, file_hash(gba_fp), file_hash(snes_fp))
+        (data, anim_asm, stats) = cache.get_or_compute(key, convert)
+    else:
+        (data, anim_asm, stats) = convert()
+    with profiling.stage('bitplane encoding'):
+        data['gfx'] = cached(cache, ('convert_to_4bpp', file_hash(snes_fp)), lambda: str(base64.b64encode(convert_to_4bpp(Image.open(snes_fp))), 'utf8'))
+
+    with profiling.stage('JSON writing'):
+        # encoded first, so fields the container can't hold fail before either file is written
+        container = json_to_binary(data) if binary else None
+        write_atomic(f'sprites/{name}/{name}.json', json.dumps(data, indent=1))
+        if container is not None:
+            write_atomic(f'sprites/{name}/{name}.bin', container)
+        write_atomic(f'sprites/{name}/anims.txt', anim_asm.rstrip('\n') + '\n')
+    return stats
+
+def read_manifest(fp='enemies.txt'):
+    '''Returns (sprite_id, name, spritemap_start, done) for each line of an enemy manifest'''
+    entries = []
+    for line in open(fp):
+        fields = line.split('#')[0].split()
+        if not fields:
+            continue
+        done = 'done' in fields[2:]
+        extra = [field for field in fields[2:] if field != 'done']
+        entries.append((int(fields[0], 16), fields[1], int(extra[0], 16) if extra else None, done))
+    return entries
+
+def init_worker(labels, rom_path, profile=False):
+    global rom, all_labels
+    rom = Rom(rom_path)
+    all_labels = labels
+    if profile:
+        profiling.enable()
+
+def export_worker(entry, flips, cache, merge, binary):
+    '''Returns (error, merge stats, profiling snapshot), the first or second being None'''
+    (sprite_id, name, spritemap_start, done) = entry
+    with profiling.group(name):
+        try:
+            result = (None, export_sprite_oam(rom, sprite_id, name, spritemap_start, flips, cache, merge, binary))
+        except Exception as e:
+            result = (f'{name}: {type(e).__name__}: {e}', None)
+    return result + (profiling.snapshot() if profiling.enabled else None,)
+
+def print_merge_stats(name, stats, frames=False):
+    if frames:
+        for (frame, before, after, line_before, line_after) in stats:
+            print(f'  {frame}: {before} -> {after} entries, {line_before} -> {line_after} per scanline')
+    before = sum(stat[1] for stat in stats)
+    after = sum(stat[2] for stat in stats)
+    line_before = max((stat[3] for stat in stats), default=0)
+    line_after = max((stat[4] for stat in stats), default=0)
+    print(f'converted {name}: {before} -> {after} OAM entries, at most {line_before} -> {line_after} per scanline')
+
+def export_batch(entries, jobs=None, rom_path='mzm.gba', flips=True, cache=default_cache, merge=True, report=False, binary=False):
+    '''Converts manifest entries on a process pool, each worker with its own mapping of the ROM'''
+    labels = load_symbols()
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(labels, rom_path, profiling.enabled)) as executor:
+        futures = [(entry[1], executor.submit(export_worker, entry, flips, cache, merge, binary)) for entry in entries]
+        errors = []
+        for (name, future) in futures:
+            (error, stats, recorded) = future.result()
+            if recorded is not None:
+                profiling.merge(recorded)
+            if error is None:
+                print_merge_stats(name, stats, report)
+            else:
+                print(error, file=sys.stderr)
+                errors.append(error)
+    return errors
 
 if __name__ == "__main__":
-    rom = open('mzm.gba', 'rb')
-    all_labels = extract_labels()
-
-    #export_sprite_oam(0x12, 'zoomer')
-    #export_sprite_oam(0x14, 'zeela') done
-    #export_sprite_oam(0x16, 'ripper', 0x82CC014) done
-    #export_sprite_oam(0x18, 'zeb', 0x82CCA00) done
-    #export_sprite_oam(0x1f, 'skree', 0x82CD30C) done
-    #export_sprite_oam(0x21, 'morph_ball') done
-    #export_sprite_oam(0x32, 'sova')
-    #export_sprite_oam(0x34, 'multiviola') done
-    #export_sprite_oam(0x37, 'geruta') done
-    #export_sprite_oam(0x38, 'squeept') done
-    #export_sprite_oam(0x3b, 'dragon') done
-    #export_sprite_oam(0x3f, 'reo', 0x82CE010) done
-    #export_sprite_oam(0x45, 'skultera') done
-    #export_sprite_oam(0x46, 'dessgeega') done
-    #export_sprite_oam(0x48, 'waver') done
-    #export_sprite_oam(0x50, 'elevator') done
-    #export_sprite_oam(0x51, 'space_pirate')
-    #export_sprite_oam(0x57, 'gamet') done
-    #export_sprite_oam(0x5b, 'zebbo', 0x82E7068) done
-    #export_sprite_oam(0x60, 'piston') done
-    #export_sprite_oam(0x64, 'metroid', 0x82EDA28) done
-    #export_sprite_oam(0x66, 'rinka', 0x82EE508) done
-    #export_sprite_oam(0x67, 'polyp') done
-    #export_sprite_oam(0x68, 'viola', 0x82EF758) done
-    #export_sprite_oam(0x6b, 'holtz') done
-    #export_sprite_oam(0x71, 'ripper2') done
-    #export_sprite_oam(0x72, 'mella') done
-    #export_sprite_oam(0x77, 'acid_worm')
-    #export_sprite_oam(0x79, 'sidehopper') done
-    #export_sprite_oam(0x7a, 'geega', 0x82FDA20) done
-    #export_sprite_oam(0x86, 'imago')
-    #export_sprite_oam(0x93, 'baristute') done
-    #export_sprite_oam(0x98, 'security_laser')
-
-    '''gba_gfx = build_gfx(f'wip/common_tiles_3.png')
-    snes_gfx = build_gfx(f'common_sprite_tiles/common_sprite_tiles_vram_layout.png')
+    parser = argparse.ArgumentParser(description='Converts ZM enemy spritemaps to SM spritemap editor JSON')
+    parser.add_argument('names', nargs='*', help='enemies from the manifest to convert (default: every entry not marked done)')
+    parser.add_argument('--all', action='store_true', help='also convert entries marked done')
+    parser.add_argument('--manifest', default='enemies.txt')
+    parser.add_argument('--rom', default='mzm.gba')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='worker processes (default: CPU count)')
+    parser.add_argument('--no-flips', dest='flips', action='store_false', help='only match SNES tiles exactly, not flipped')
+    parser.add_argument('--no-cache', dest='cache', action='store_false', help='recompute everything instead of using .cache/objects')
+    parser.add_argument('--no-merge', dest='merge', action='store_false', help="don't merge 8x8 entries back into 16x16 ones")
+    parser.add_argument('--binary', action='store_true', help='also write <name>.bin, see spritemap_bin.py')
+    parser.add_argument('--report', action='store_true', help='print entry counts and sprites per scanline of every frame')
+    parser.add_argument('--profile', nargs='?', const='', default=None, metavar='TRACE',
+                        help='print time per stage and counters per enemy, and write a Chrome trace to TRACE if given')
+    args = parser.parse_args()
+    if args.profile is not None:
+        profiling.enable()
+
+    entries = read_manifest(args.manifest)
+    if args.names:
+        unknown = set(args.names) - {entry[1] for entry in entries}
+        if unknown:
+            parser.error(f'not in {args.manifest}: {", ".join(sorted(unknown))}')
+        entries = [entry for entry in entries if entry[1] in args.names]
+    elif not args.all:
+        entries = [entry for entry in entries if not entry[3]]
+
+    errors = export_batch(entries, args.jobs, args.rom, args.flips, default_cache if args.cache else None, args.merge, args.report, args.binary)
+    if args.profile is not None:
+        profiling.report(args.profile)
+    if errors:
+        sys.exit(1)
+
+    '''rom = Rom('mzm.gba')
+    all_labels = load_symbols()
+    gba_gfx = build_gfx(f'wip/common_tiles_3.png')
+    snes_index = index_snes_gfx(build_gfx(f'common_sprite_tiles/common_sprite_tiles_vram_layout.png'))
 
     for i, p_oam in enumerate([0x08339aa8, 0x08339ee4, 0x0833bd34, 0x0833cbe0]):
-        data = extract_generic(rom, 0x0832ba08, 1, p_oam, f'particles{i}', gba_gfx, snes_gfx, 0x40, 0)
+        (data, anim_asm) = extract_generic(rom, 0x0832ba08, 1, p_oam, f'particles{i}', gba_gfx, snes_index, 0x40, 0)
         image = Image.open(f'common_sprite_tiles/common_sprite_tiles_vram_layout.png')
         data['gfx'] =  str(base64.b64encode(convert_to_4bpp(image)), 'utf8')
 
@@ -0,0 +1,149 @@
+''' Optional stage timers and counters, reported as a table per enemy and as a Chrome trace (chrome://tracing, ui.perfetto.dev)
+
+Nothing is recorded until enable() is called; until then a stage is a shared no-op context manager
+and a counter is one check of `enabled`.'''
+
+import functools, json, os, threading, time
+
+enabled = False
+# what stages and counters are attributed to, usually the enemy being converted
+current_group = ''
+
+# (group, stage) -> [calls, seconds], (group, counter) -> count, and Chrome trace events
+stages = {}
+counters = {}
+events = []
+lock = threading.Lock()
+
+def enable():
+    global enabled
+    enabled = True
+
+class Stage:
+    '''Times a with block, the time counting toward every stage it is nested in'''
+    __slots__ = ('name', 'group', 'start')
+
+    def __init__(self, name, group=None):
+        self.name = name
+        self.group = group
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        end = time.perf_counter()
+        group_name = current_group if self.group is None else self.group
+        with lock:
+            totals = stages.setdefault((group_name, self.name), [0, 0.0])
+            totals[0] += 1
+            totals[1] += end - self.start
+            events.append({'name': self.name, 'cat': group_name or '-', 'ph': 'X', 'ts': self.start*1e6, 'dur': (end - self.start)*1e6,
+                           'pid': os.getpid(), 'tid': threading.get_ident(), 'args': {'group': group_name}})
+
+class NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+NULL_STAGE = NullStage()
+
+def stage(name, group=None):
+    '''Returns a context manager timing a stage, attributed to group or else the current group'''
+    return Stage(name, group) if enabled else NULL_STAGE
+
+def timed(name, counter=None):
+    '''Decorator timing each call of a function as a stage
+
+    counter, if given, returns a (counter, amount) to add from the function's return value.'''
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with Stage(name):
+                result = function(*args, **kwargs)
+            if counter is not None:
+                count(*counter(result))
+            return result
+        return wrapper
+    return decorate
+
+def count(name, amount=1, group=None):
+    if enabled:
+        key = (current_group if group is None else group, name)
+        with lock:
+            counters[key] = counters.get(key, 0) + amount
+
+class group:
+    '''Attributes stages and counters in a with block to a group, such as an enemy'''
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        global current_group
+        (self.previous, current_group) = (current_group, self.name)
+        return self
+
+    def __exit__(self, *args):
+        global current_group
+        current_group = self.previous
+
+def snapshot(reset=True):
+    '''Returns what has been recorded, to send from a worker process to merge() in the parent'''
+    with lock:
+        recorded = {'stages': list(stages.items()), 'counters': list(counters.items()), 'events': list(events)}
+        if reset:
+            stages.clear()
+            counters.clear()
+            events.clear()
+    return recorded
+
+def merge(recorded):
+    with lock:
+        for (key, (calls, seconds)) in recorded['stages']:
+            totals = stages.setdefault(key, [0, 0.0])
+            totals[0] += calls
+            totals[1] += seconds
+        for (key, amount) in recorded['counters']:
+            counters[key] = counters.get(key, 0) + amount
+        events.extend(recorded['events'])
+
+def summary():
+    '''Returns a table of milliseconds per stage and counts per counter, a row per group and a total'''
+    stage_names = list(dict.fromkeys(name for (group_name, name) in stages))
+    counter_names = list(dict.fromkeys(name for (group_name, name) in counters))
+    groups = sorted({group_name for (group_name, name) in stages} | {group_name for (group_name, name) in counters})
+
+    header = ['group'] + [f'{name} (ms)' for name in stage_names] + counter_names
+    rows = []
+    for group_name in groups + [None]:
+        def total(table, name, value):
+            return sum(value(entry) for ((g, n), entry) in table.items() if n == name and (group_name is None or g == group_name))
+        rows.append(['total' if group_name is None else group_name or '-']
+                    + [f'{total(stages, name, lambda entry: entry[1])*1000:.1f}' for name in stage_names]
+                    + [str(total(counters, name, lambda entry: entry)) for name in counter_names])
+
+    widths = [max(len(row[i]) for row in [header] + rows) for i in range(len(header))]
+    lines = ['  '.join(cell.ljust(width) if i == 0 else cell.rjust(width) for (i, (cell, width)) in enumerate(zip(row, widths))) for row in [header] + rows]
+    lines.insert(1, '-'*len(lines[0]))
+    lines.insert(len(lines) - 1, '-'*len(lines[0]))
+    return '\n'.join(lines)
+
+def write_trace(fp):
+    '''Writes the recorded stages as Chrome trace events, with the counters as the trace's metadata'''
+    with lock:
+        trace = {'traceEvents': events, 'displayTimeUnit': 'ms',
+                 'otherData': {f'{group_name or "-"}: {name}': amount for ((group_name, name), amount) in counters.items()}}
+        with open(fp, 'w') as f:
+            json.dump(trace, f)
+
+def report(trace_fp=None):
+    '''Prints the summary table, and writes the trace if given a file'''
+    print(summary())
+    if trace_fp:
+        write_trace(trace_fp)
+        print(f'wrote {trace_fp}')
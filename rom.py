@@ -0,0 +1,68 @@
+import hashlib, mmap
+import numpy as np
+
+gba2hex = lambda address: address & 0x1FFFFFF
+hex2gba = lambda address: address & 0x1FFFFFF | 0x8000000
+
+class Rom:
+    '''Read-only memory-mapped ROM addressed by GBA address
+
+    Nothing here keeps a read position, so one Rom can be shared between threads.'''
+
+    def __init__(self, path='mzm.gba'):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.data = memoryview(self.mmap)
+        self._digest = None
+
+    @property
+    def digest(self):
+        '''SHA-1 of the ROM contents, for cache keys'''
+        if self._digest is None:
+            self._digest = hashlib.sha1(self.data).hexdigest()
+        return self._digest
+
+    def __len__(self):
+        return len(self.data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        try:
+            self.data.release()
+            self.mmap.close()
+        except BufferError:
+            # arrays from u16/u32 still point into the map, it gets closed once they are freed
+            pass
+
+    def view(self, address, size) -> memoryview:
+        '''Returns `size` bytes at `address` without copying'''
+        return self.data[gba2hex(address):gba2hex(address) + size]
+
+    def read(self, n, address) -> int:
+        '''Reads an n-byte little-endian integer'''
+        return int.from_bytes(self.data[gba2hex(address):gba2hex(address) + n], 'little')
+
+    def u8(self, address, count) -> np.ndarray:
+        return np.frombuffer(self.mmap, dtype=np.uint8, count=count, offset=gba2hex(address))
+
+    def u16(self, address, count) -> np.ndarray:
+        return np.frombuffer(self.mmap, dtype='<u2', count=count, offset=gba2hex(address))
+
+    def u32(self, address, count) -> np.ndarray:
+        return np.frombuffer(self.mmap, dtype='<u4', count=count, offset=gba2hex(address))
+
+def bgr555_to_rgb(palette555) -> np.ndarray:
+    '''Converts BGR555 colours to an (N, 3) array of RGB888'''
+    palette555 = np.asarray(palette555, dtype=np.uint16)
+    return (np.stack([palette555, palette555 >> 5, palette555 >> 10], axis=1) & 0x1F).astype(np.uint8) << 3
+
+def rgb_to_bgr555(rgb) -> np.ndarray:
+    '''Converts an (N, 3) array of RGB888 to BGR555, dropping the low 3 bits of each channel'''
+    rgb = np.asarray(rgb, dtype=np.uint16).reshape(-1, 3) >> 3
+    return rgb[:, 0] | rgb[:, 1] << 5 | rgb[:, 2] << 10
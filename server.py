@@ -0,0 +1,269 @@
+''' Keeps the ROM, symbols and caches loaded in worker processes and converts on request over a local socket
+
+Requests and responses are JSON, one per line: {"id": 1, "method": "export", "params": {"name": "zoomer"}}
+is answered with {"id": 1, "result": ...} or {"id": 1, "error": "..."}.'''
+
+import argparse, asyncio, base64, io, json, os, sys, time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import misc_tiles
+import oam_gba_2_snes
+from cache import CACHE_DIR, BuildManifest, default_cache
+from decompressor import decomp_lz77_cached
+from gfx_4bpp import decode_4bpp_gba
+from labels import load_symbols
+from oam_gba_2_snes import export_worker, read_manifest
+from rom import bgr555_to_rgb, gba2hex
+from sprite_oam_to_apng import FrameCache, max_height, max_width, to_image
+from xref import release_index
+
+DEFAULT_SOCKET = os.path.join(CACHE_DIR, 'server.sock')
+
+# per worker: sprite_id -> (FrameCache, RGBA palette) of the enemy's graphics, cleared when the ROM changes
+frame_caches = {}
+# per worker: the ROM and map paths, and the (inode, size, mtime) of each when last loaded
+paths = None
+loaded = None
+
+def file_version(fp):
+    stat = os.stat(fp)
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+def init_worker(rom_path, map_path):
+    global paths
+    paths = (rom_path, map_path)
+    refresh_worker()
+
+def refresh_worker():
+    '''Opens the ROM and loads the symbols again if either file changed since the last job, dropping frames drawn from the old ROM'''
+    global loaded
+    version = tuple(file_version(fp) for fp in paths)
+    if version != loaded:
+        (rom_path, map_path) = paths
+        if loaded is not None:
+            # nothing may keep the old mapping alive once the new ROM is open
+            release_index(oam_gba_2_snes.rom)
+            oam_gba_2_snes.rom.close()
+        oam_gba_2_snes.init_worker(load_symbols(map_path), rom_path)
+        # one mapping of the ROM for every job
+        misc_tiles.rom = oam_gba_2_snes.rom
+        frame_caches.clear()
+        loaded = version
+
+def warm_worker():
+    return os.getpid()
+
+def export_job(*args):
+    refresh_worker()
+    return export_worker(*args)
+
+def extract_job(*args):
+    refresh_worker()
+    return misc_tiles.extract_worker(*args)
+
+def enemy_frames(sprite_id, cache):
+    '''Returns the FrameCache and RGBA palette of an enemy, its graphics decompressed once per worker'''
+    if sprite_id not in frame_caches:
+        rom = oam_gba_2_snes.rom
+        pGfx = rom.read(4, 0x875EBF8+(sprite_id-0x10)*4)
+        pPal = rom.read(4, 0x875EEF0+(sprite_id-0x10)*4)
+        gfx = decomp_lz77_cached(rom, gba2hex(pGfx), cache)[0]
+        rows = max(len(gfx)//0x800, 1)
+
+        paletteRgba = np.zeros((256, 4), dtype=np.uint8)
+        paletteRgba[0x80:0x80+16*rows, :3] = bgr555_to_rgb(rom.u16(pPal, 16*rows))
+        paletteRgba[0x80:0x80+16*rows, 3] = 255
+        # enemy tiles are loaded after the 0x200 common ones
+        tiles = bytearray(0x20*0x200) + gfx + bytearray(max(0x20*0x200 - len(gfx), 0))
+        frame_caches[sprite_id] = (FrameCache(decode_4bpp_gba(tiles), f'0x{sprite_id:02x}'), paletteRgba.ravel().tolist())
+    return frame_caches[sprite_id]
+
+def render_worker(sprite_id, spritemapAddr, cache):
+    '''Returns a spritemap drawn with an enemy's graphics as base64 PNG, the same as in animation_frames/'''
+    refresh_worker()
+    (frames, pal) = enemy_frames(sprite_id, cache)
+    rom = oam_gba_2_snes.rom
+    canvas = frames.render(rom, spritemapAddr, rom.read(2, spritemapAddr))
+    image = to_image(canvas, -max_width(canvas), -max_height(canvas), max_width(canvas), max_height(canvas))
+    image.putpalette(pal, 'RGBA')
+    png = io.BytesIO()
+    image.save(png, format='PNG')
+    return {'png': str(base64.b64encode(png.getvalue()), 'utf8'), 'width': image.width, 'height': image.height}
+
+def hex_param(value):
+    '''Returns a request parameter given as a number or as a hex string'''
+    return int(value, 16) if isinstance(value, str) else value
+
+class Server:
+    '''Answers requests on an asyncio stream server, running conversions on a process pool'''
+
+    def __init__(self, executor, manifest_fp='enemies.txt', cache=default_cache):
+        self.executor = executor
+        self.manifest_fp = manifest_fp
+        self.cache = cache
+        self.tile_manifest = BuildManifest(os.path.join(CACHE_DIR, 'tiles.manifest.json'))
+        self.started = time.time()
+        self.requests = 0
+        self.stopped = asyncio.Event()
+        # connection task -> reader, ended on shutdown
+        self.connections = {}
+        self.methods = {'export': self.export, 'render': self.render, 'tiles': self.tiles, 'status': self.status, 'shutdown': self.shutdown}
+
+    def run(self, function, *args):
+        return asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    def entry(self, params):
+        '''Returns the manifest entry named by params, read again for each request so edits apply'''
+        entries = read_manifest(self.manifest_fp)
+        sprite_id = hex_param(params.get('sprite_id'))
+        for entry in entries:
+            if entry[1] == params.get('name') or entry[0] == sprite_id:
+                return entry
+        raise ValueError(f'not in {self.manifest_fp}: {params.get("name", params.get("sprite_id"))}')
+
+    async def export(self, params):
+        '''Converts an enemy as oam_gba_2_snes.py does, returning the merge stats of its frames'''
+        entry = self.entry(params)
+        cache = self.cache if params.get('cache', True) else None
+        (error, stats, recorded) = await self.run(export_job, entry, params.get('flips', True), cache, params.get('merge', True), params.get('binary', False))
+        if error is not None:
+            raise RuntimeError(error)
+        return {'name': entry[1], 'json': f'sprites/{entry[1]}/{entry[1]}.json',
+                'frames': [{'name': name, 'entries': [before, after], 'per_scanline': [line_before, line_after]} for (name, before, after, line_before, line_after) in stats]}
+
+    async def render(self, params):
+        '''Draws the spritemap at params['address'] with the graphics of an enemy'''
+        sprite_id = self.entry(params)[0] if 'name' in params else hex_param(params['sprite_id'])
+        return await self.run(render_worker, sprite_id, hex_param(params['address']), self.cache)
+
+    async def tiles(self, params):
+        '''Runs the jobs of tiles.txt whose output starts with one of params['outputs'], as misc_tiles.py does'''
+        jobs = misc_tiles.read_jobs(params.get('job_file', misc_tiles.DEFAULT_JOB_FILE))
+        if params.get('outputs'):
+            jobs = [job for job in jobs if job[5].startswith(tuple(params['outputs']))]
+        force = params.get('force', False)
+        results = await asyncio.gather(*(self.run(extract_job, job, self.tile_manifest.digests.get(job[5]), force, self.cache) for job in jobs),
+                                       return_exceptions=True)
+
+        outputs = {}
+        for (job, result) in zip(jobs, results):
+            if isinstance(result, Exception):
+                outputs[job[5]] = f'{type(result).__name__}: {result}'
+                continue
+            (status, digest) = result
+            if status == 'built':
+                self.tile_manifest.record(job[5], digest)
+            outputs[job[5]] = status
+        self.tile_manifest.save()
+        return outputs
+
+    async def status(self, params):
+        return {'pid': os.getpid(), 'uptime': time.time() - self.started, 'requests': self.requests}
+
+    async def shutdown(self, params):
+        self.stopped.set()
+        return {}
+
+    async def answer(self, line):
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get('id')
+            method = self.methods.get(request.get('method'))
+            if method is None:
+                raise ValueError(f'unknown method {request.get("method")!r} (known: {", ".join(self.methods)})')
+            self.requests += 1
+            return {'id': request_id, 'result': await method(request.get('params', {}))}
+        except Exception as e:
+            return {'id': request_id, 'error': f'{type(e).__name__}: {e}'}
+
+    async def handle(self, reader, writer):
+        '''Answers each line of a connection, several requests at once being answered as they finish'''
+        lock = asyncio.Lock()
+
+        async def reply(line):
+            response = await self.answer(line)
+            async with lock:
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+
+        self.connections[asyncio.current_task()] = reader
+        pending = set()
+        try:
+            while line := await reader.readline():
+                if line.strip():
+                    task = asyncio.create_task(reply(line))
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+            await asyncio.gather(*pending)
+        except ConnectionError:
+            pass
+        finally:
+            del self.connections[asyncio.current_task()]
+            writer.close()
+
+    async def close(self):
+        '''Closes every connection after its requests are answered'''
+        for reader in list(self.connections.values()):
+            reader.feed_eof()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+
+async def serve(args):
+    jobs = args.jobs or os.cpu_count()
+    # parsed once here so the workers, which load the ROM and symbols themselves, read the map from the cache
+    load_symbols(args.map)
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(args.rom, args.map)) as executor:
+        server = Server(executor, args.manifest, default_cache if args.cache else None)
+        # start every worker now rather than on the first requests
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(executor, warm_worker) for _ in range(jobs)))
+
+        if args.port is not None:
+            listener = await asyncio.start_server(server.handle, '127.0.0.1', args.port)
+            where = f'127.0.0.1:{args.port}'
+        else:
+            if os.path.exists(args.socket):
+                os.remove(args.socket)
+            os.makedirs(os.path.dirname(args.socket) or '.', exist_ok=True)
+            listener = await asyncio.start_unix_server(server.handle, args.socket)
+            where = args.socket
+        print(f'listening on {where} with {jobs} workers', flush=True)
+
+        async with listener:
+            await server.stopped.wait()
+            listener.close()
+            await server.close()
+        if args.port is None:
+            os.remove(args.socket)
+
+async def call(args, method, params):
+    '''Sends one request to a running server and returns its response'''
+    if args.port is not None:
+        (reader, writer) = await asyncio.open_connection('127.0.0.1', args.port)
+    else:
+        (reader, writer) = await asyncio.open_unix_connection(args.socket)
+    writer.write(json.dumps({'id': 1, 'method': method, 'params': params}).encode() + b'\n')
+    await writer.drain()
+    response = json.loads(await reader.readline())
+    writer.close()
+    return response
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serves conversions, frame rendering and tile sheet extraction over a local socket')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help=f'Unix socket to listen on (default: {DEFAULT_SOCKET})')
+    parser.add_argument('--port', type=int, default=None, help='listen on this localhost TCP port instead')
+    parser.add_argument('--manifest', default='enemies.txt')
+    parser.add_argument('--rom', default='mzm.gba')
+    parser.add_argument('--map', default='mzm_us.map')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='worker processes (default: CPU count)')
+    parser.add_argument('--no-cache', dest='cache', action='store_false', help='recompute everything instead of using .cache/objects')
+    parser.add_argument('--call', nargs='+', metavar=('METHOD', 'PARAMS'), help='send a request to a running server, e.g. --call export \'{"name": "zoomer"}\'')
+    args = parser.parse_args()
+
+    if args.call:
+        response = asyncio.run(call(args, args.call[0], json.loads(args.call[1]) if len(args.call) > 1 else {}))
+        print(json.dumps(response, indent=1))
+        if 'error' in response:
+            sys.exit(1)
+    else:
+        asyncio.run(serve(args))
@@ -0,0 +1,285 @@
+''' Compresses converted sheets in Super Metroid's decompression format, with an optimal (shortest path) or a greedy parse
+
+A header byte CCCLLLLL is command C with length L+1; C=7 marks a 2-byte header 111CCCLL LLLLLLLL
+with a 10-bit length, and 0xFF ends the data.'''
+
+import argparse, base64, json, os, time
+import numpy as np
+
+(DIRECT, BYTE_FILL, WORD_FILL, SIGMA_FILL, DICTIONARY, DICTIONARY_XOR, RELATIVE, RELATIVE_XOR) = range(8)
+COMMAND_NAMES = ['direct', 'byte fill', 'word fill', 'sigma fill', 'dictionary', 'dictionary xor', 'relative', 'relative xor']
+END = 0xFF
+MAX_LENGTH = 0x400
+# relative xor always has a 2-byte header, which must not be 0xFF
+MAX_RELATIVE_XOR_LENGTH = 0x300
+MAX_OFFSET = 0xFF
+MAX_ADDRESS = 0xFFFF
+# operand bytes after the header, direct copy having its length instead
+OPERAND_SIZES = [0, 1, 2, 1, 2, 2, 1, 1]
+HASH_SIZE = 3
+XOR = bytes(b ^ 0xFF for b in range(0x100))
+
+# Rough CPU cycles of the decompression routine, (per command, per byte), counted from its loops
+# rather than measured, with 2-byte headers costing EXTENDED_CYCLES more
+CYCLES = [(60, 24), (66, 14), (72, 18), (66, 18), (90, 30), (90, 36), (84, 30), (84, 36)]
+EXTENDED_CYCLES = 24
+# CPU cycles per frame at 2.68 MHz and 60 Hz
+FRAME_CYCLES = 44_670
+
+def header_size(command, length):
+    return 1 if length <= 32 and command != RELATIVE_XOR else 2
+
+def encode_header(command, length):
+    if header_size(command, length) == 1:
+        return bytes((command << 5 | length - 1,))
+    return bytes((0xE0 | command << 2 | (length - 1) >> 8, (length - 1) & 0xFF))
+
+def read_commands(data, offset=0) -> ([(int, int, bytes)], int):
+    '''Returns the (command, length, operand) of compressed data and its size, including the end byte'''
+    commands = []
+    src = offset
+    while data[src] != END:
+        command = data[src] >> 5
+        length = (data[src] & 0x1F) + 1
+        src += 1
+        if command == 7:
+            command = data[src - 1] >> 2 & 7
+            length = ((data[src - 1] & 3) << 8 | data[src]) + 1
+            src += 1
+        size = length if command == DIRECT else OPERAND_SIZES[command]
+        commands.append((command, length, bytes(data[src:src + size])))
+        src += size
+    return (commands, src + 1 - offset)
+
+def decompress(data, offset=0) -> (bytes, int):
+    '''Returns the decompressed bytes and the compressed size'''
+    (commands, size) = read_commands(data, offset)
+    out = bytearray()
+    for (command, length, operand) in commands:
+        if command == DIRECT:
+            out += operand
+        elif command == BYTE_FILL:
+            out += operand * length
+        elif command == WORD_FILL:
+            out += (operand * (length // 2 + 1))[:length]
+        elif command == SIGMA_FILL:
+            out += bytes((operand[0] + k) & 0xFF for k in range(length))
+        else:
+            if command in (DICTIONARY, DICTIONARY_XOR):
+                src = int.from_bytes(operand, 'little')
+            else:
+                src = len(out) - operand[0]
+            if not 0 <= src < len(out):
+                raise ValueError(f'{COMMAND_NAMES[command]} copy from {src:#x} at {len(out):#x}')
+            xor = command in (DICTIONARY_XOR, RELATIVE_XOR)
+            if src + length <= len(out):
+                copied = out[src:src + length]
+                out += copied.translate(XOR) if xor else copied
+            else:
+                # overlapping copies read bytes written by the same command
+                for k in range(length):
+                    out.append(out[src + k] ^ 0xFF if xor else out[src + k])
+    return (bytes(out), size)
+
+def estimate_cycles(commands):
+    '''Returns the rough CPU cycles the SNES takes to decompress a list of read_commands'''
+    total = 0
+    for (command, length, operand) in commands:
+        (per_command, per_byte) = CYCLES[command]
+        total += per_command + per_byte*length + (EXTENDED_CYCLES if header_size(command, length) == 2 else 0)
+    return total
+
+def fill_lengths(data):
+    '''Returns the longest byte, word and sigma fill at each position of data'''
+    n = len(data)
+    (byte, word, sigma) = ([1]*(n + 1), [min(2, n - i) for i in range(n + 1)], [1]*(n + 1))
+    for i in range(n - 2, -1, -1):
+        if data[i + 1] == data[i]:
+            byte[i] = byte[i + 1] + 1
+        if data[i + 1] == (data[i] + 1) & 0xFF:
+            sigma[i] = sigma[i + 1] + 1
+        if i + 2 < n and data[i + 2] == data[i]:
+            word[i] = word[i + 1] + 1
+    return (byte, word, sigma)
+
+def match_length(source, data, src, dst, limit):
+    '''Returns how many bytes of data from dst equal source from src, up to limit'''
+    length = 0
+    while length < limit:
+        step = min(32, limit - length)
+        if source[src + length:src + length + step] != data[dst + length:dst + length + step]:
+            while source[src + length] == data[dst + length]:
+                length += 1
+            return length
+        length += step
+    return length
+
+class MatchFinder:
+    '''Hash chains of HASH_SIZE bytes over the data before a position, for plain and inverted copies'''
+
+    def __init__(self, data, depth=None):
+        self.data = data
+        self.inverted = data.translate(XOR)
+        self.depth = depth
+        self.chains = {}
+        self.hashed = 0
+
+    def find(self, i):
+        '''Returns [(command, length, operand)] of the longest copy of each kind at i'''
+        data = self.data
+        while self.hashed < i:
+            self.chains.setdefault(data[self.hashed:self.hashed + HASH_SIZE], []).append(self.hashed)
+            self.hashed += 1
+
+        found = []
+        limit = min(MAX_LENGTH, len(data) - i)
+        if limit < HASH_SIZE:
+            return found
+        for (source, key, dictionary, relative) in [(data, data[i:i + HASH_SIZE], DICTIONARY, RELATIVE),
+                                                     (self.inverted, self.inverted[i:i + HASH_SIZE], DICTIONARY_XOR, RELATIVE_XOR)]:
+            relative_limit = min(limit, MAX_RELATIVE_XOR_LENGTH) if relative == RELATIVE_XOR else limit
+            (best, best_src, near, near_src) = (0, 0, 0, 0)
+            chain = self.chains.get(key, [])
+            for src in reversed(chain if self.depth is None else chain[-self.depth:]):
+                if src > MAX_ADDRESS and i - src > MAX_OFFSET:
+                    continue
+                # a copy longer than the best so far must match at its end
+                beat = best if i - src > MAX_OFFSET else min(best, near)
+                if 0 < beat < limit and source[src + beat] != data[i + beat]:
+                    continue
+                length = match_length(source, data, src, i, limit)
+                if i - src <= MAX_OFFSET and length > near:
+                    (near, near_src) = (min(length, relative_limit), src)
+                if src <= MAX_ADDRESS and length > best:
+                    (best, best_src) = (length, src)
+                if best == limit and (near == relative_limit or i - src >= MAX_OFFSET):
+                    break
+            if best >= HASH_SIZE:
+                found.append((dictionary, best, best_src.to_bytes(2, 'little')))
+            if near >= HASH_SIZE:
+                found.append((relative, near, bytes((i - near_src,))))
+        return found
+
+def candidates(data, i, fills, finder):
+    '''Returns [(command, longest length, operand)] of the commands besides direct copy that can start at i'''
+    (byte, word, sigma) = fills
+    found = finder.find(i)
+    if byte[i] >= 2:
+        found.append((BYTE_FILL, min(byte[i], MAX_LENGTH), data[i:i + 1]))
+    if word[i] >= 3:
+        found.append((WORD_FILL, min(word[i], MAX_LENGTH), data[i:i + 2]))
+    if sigma[i] >= 2:
+        found.append((SIGMA_FILL, min(sigma[i], MAX_LENGTH), data[i:i + 1]))
+    return found
+
+def parse_optimal(data, depth=None):
+    '''Returns the [(command, length, operand)] of the fewest compressed bytes, by shortest path from the end'''
+    n = len(data)
+    finder = MatchFinder(data, depth)
+    fills = fill_lengths(data)
+    # cost[i]: fewest bytes compressing data[i:], and literal[j] = cost[j] + j for direct copies ending at j
+    cost = np.zeros(n + 1, dtype=np.int64)
+    literal = np.zeros(n + 1, dtype=np.int64)
+    literal[n] = n
+    choices = [None]*n
+
+    # hash chains are built front to back, so find every candidate before the backward pass
+    found = [candidates(data, i, fills, finder) for i in range(n)]
+    for i in range(n - 1, -1, -1):
+        best = None
+        for (command, longest, operand) in [(DIRECT, min(MAX_LENGTH, n - i), None)] + found[i]:
+            size = OPERAND_SIZES[command]
+            for (first, last) in [(1, min(longest, 32)), (33, longest)]:
+                if first > last:
+                    continue
+                if command == DIRECT:
+                    window = literal[i + first:i + last + 1]
+                    k = int(np.argmin(window))
+                    total = int(window[k]) - i + header_size(command, first + k)
+                else:
+                    window = cost[i + first:i + last + 1]
+                    k = int(np.argmin(window))
+                    total = int(window[k]) + size + header_size(command, first + k)
+                if best is None or total < best[0]:
+                    best = (total, command, first + k, operand)
+        (cost[i], command, length, operand) = best
+        literal[i] = cost[i] + i
+        choices[i] = (command, length, operand)
+
+    commands = []
+    i = 0
+    while i < n:
+        (command, length, operand) = choices[i]
+        commands.append((command, length, data[i:i + length] if command == DIRECT else operand))
+        i += length
+    return commands
+
+def parse_greedy(data, depth=16):
+    '''Returns [(command, length, operand)] taking the command saving the most bytes at each position'''
+    n = len(data)
+    finder = MatchFinder(data, depth)
+    fills = fill_lengths(data)
+    commands = []
+    start = 0
+    i = 0
+    while i < n:
+        best = (0, None)
+        for (command, length, operand) in candidates(data, i, fills, finder):
+            saved = length - OPERAND_SIZES[command] - header_size(command, length)
+            if saved > best[0]:
+                best = (saved, (command, length, operand))
+        if best[1] is None:
+            i += 1
+            if i - start == MAX_LENGTH:
+                commands.append((DIRECT, i - start, data[start:i]))
+                start = i
+            continue
+        if start < i:
+            commands.append((DIRECT, i - start, data[start:i]))
+        commands.append(best[1])
+        i += best[1][1]
+        start = i
+    if start < n:
+        commands.append((DIRECT, n - start, data[start:n]))
+    return commands
+
+def encode_commands(commands):
+    return b''.join(encode_header(command, length) + operand for (command, length, operand) in commands) + bytes((END,))
+
+def compress(data, optimal=True, verify=True) -> bytes:
+    '''Compresses data, optimally or greedily, checking that it decompresses back unless verify is False'''
+    data = bytes(data)
+    compressed = encode_commands(parse_optimal(data) if optimal else parse_greedy(data))
+    if verify:
+        (decompressed, size) = decompress(compressed)
+        if decompressed != data or size != len(compressed):
+            raise ValueError('compressed data does not decompress to the input')
+    return compressed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compresses the sheets of converted enemies in Super Metroid's format and reports the ratio and decompression time")
+    parser.add_argument('names', nargs='*', help='enemies in sprites/ (default: all of them)')
+    parser.add_argument('--greedy', action='store_true', help='greedy parse, faster but larger than the optimal one')
+    parser.add_argument('--write', action='store_true', help='write sprites/<name>/<name>_gfx.bin')
+    args = parser.parse_args()
+
+    (total_size, total_compressed, total_cycles) = (0, 0, 0)
+    for name in args.names or sorted(os.listdir('sprites')):
+        fp = f'sprites/{name}/{name}.json'
+        if not os.path.exists(fp):
+            continue
+        with open(fp) as f:
+            gfx = base64.b64decode(json.load(f)['gfx'])
+
+        start = time.perf_counter()
+        compressed = compress(gfx, not args.greedy)
+        elapsed = time.perf_counter() - start
+        cycles = estimate_cycles(read_commands(compressed)[0])
+        print(f'{name}: {len(gfx):#x} -> {len(compressed):#x} bytes ({len(compressed)/len(gfx):.1%}), ~{cycles} cycles ({cycles/FRAME_CYCLES:.1f} frames), compressed in {elapsed*1000:.0f} ms')
+        if args.write:
+            with open(f'sprites/{name}/{name}_gfx.bin', 'wb') as f:
+                f.write(compressed)
+        (total_size, total_compressed, total_cycles) = (total_size + len(gfx), total_compressed + len(compressed), total_cycles + cycles)
+
+    if total_size:
+        print(f'total: {total_size:#x} -> {total_compressed:#x} bytes ({total_compressed/total_size:.1%}), ~{total_cycles} cycles ({total_cycles/FRAME_CYCLES:.1f} frames)')
@@ -4,312 +4,469 @@
 
 from PIL import Image
 import numpy as np
-import os
-from decompressor import decomp_lz77
+import argparse, hashlib, os
+from collections import OrderedDict
+import profiling
+from concurrent.futures import ThreadPoolExecutor
+from apng import ApngWriter
+from cache import CACHE_DIR, BuildManifest, default_cache
+from decompressor import decomp_lz77_cached
+from gfx_4bpp import decode_4bpp_gba
+from labels import load_symbols
+from oam import OBJ_DIMENSIONS, decode_spritemap, read_frame_table, tile_dimensions
+from rom import Rom, bgr555_to_rgb, gba2hex
+
+# Part of every output's digest in the build manifest, bump it when rendering changes
+RENDER_VERSION = 1
+
+CANVAS_WIDTH = 512
+CANVAS_HEIGHT = 256
+# canvases a FrameCache keeps, older ones being drawn again when needed
+MAX_CANVASES = 64
+
+class Canvas:
+    '''Sprite pixels around the sprite's origin, stored as a [y, x] array with the origin at (origin_x, origin_y)'''
+
+    def __init__(self, pixels=None, mask=None, origin_x=CANVAS_WIDTH//2, origin_y=CANVAS_HEIGHT//2):
+        self.pixels = np.zeros((CANVAS_HEIGHT, CANVAS_WIDTH), dtype=np.uint8) if pixels is None else pixels
+        self.mask = np.zeros(self.pixels.shape, dtype=bool) if mask is None else mask
+        self.origin_x = origin_x
+        self.origin_y = origin_y
+
+    def blit(self, x, y, image):
+        '''Draws an image over the canvas with its top left at (x, y), colour 0 of each palette is transparent'''
+        (height, width) = image.shape
+        left = x + self.origin_x
+        top = y + self.origin_y
+
+        # clip to the canvas
+        x0, y0 = max(left, 0), max(top, 0)
+        x1, y1 = min(left + width, self.pixels.shape[1]), min(top + height, self.pixels.shape[0])
+        if x0 >= x1 or y0 >= y1:
+            return
+        image = image[y0-top:y1-top, x0-left:x1-left]
+
+        opaque = image & 0xF != 0
+        self.pixels[y0:y1, x0:x1] = np.where(opaque, image, self.pixels[y0:y1, x0:x1])
+        self.mask[y0:y1, x0:x1] |= opaque
+
+    def bbox(self):
+        '''Returns (left, top, right, bottom) of the opaque pixels relative to the origin, or None if there are none'''
+        columns = np.nonzero(self.mask.any(axis=0))[0]
+        if len(columns) == 0:
+            return None
+        rows = np.nonzero(self.mask.any(axis=1))[0]
+        return (int(columns[0]) - self.origin_x, int(rows[0]) - self.origin_y, int(columns[-1]) + 1 - self.origin_x, int(rows[-1]) + 1 - self.origin_y)
+
+    def cropped(self):
+        '''Returns a copy of the canvas trimmed to its opaque pixels'''
+        bbox = self.bbox()
+        if bbox is None:
+            return Canvas(np.zeros((0, 0), dtype=np.uint8), None, 0, 0)
+        (left, top, right, bottom) = bbox
+        rows = slice(top + self.origin_y, bottom + self.origin_y)
+        columns = slice(left + self.origin_x, right + self.origin_x)
+        return Canvas(self.pixels[rows, columns].copy(), self.mask[rows, columns].copy(), -left, -top)
+
+def decode_object(entry):
+    '''Returns (x_offset, y_offset, width, height, h_flip, v_flip, index, palette) of an entry of a decoded spritemap'''
+    (x_offset, y_offset, shape, size, index, palette, bg_priority, h_flip, v_flip) = entry
+
+    # grab tile dimensions depending on shape and size
+    (width, height) = tile_dimensions[shape][size]
+
+    # palette rows 8..F, as the upper nibble of the colour index
+    return (x_offset, y_offset, width, height, h_flip, v_flip, index, (palette + 8) << 4)
+
+def object_tiles(index, width, height):
+    # the object's tiles are laid out in rows of 32 in VRAM
+    return index + np.arange(width//8) + 32*np.arange(height//8)[:, np.newaxis]
 
-gba2hex = lambda address: address & 0x1FFFFFF
-hex2gba = lambda address: address & 0x1FFFFFF | 0x8000000
-
-def romRead(n = 1, address = None):
-    if address is not None:
-        prevAddress = rom.tell()
-        rom.seek(gba2hex(address))
+''' Modified From SpriteSomething (https://github.com/Artheau/SpriteSomething) '''
+def canvas_from_raw_data(spritemap, tiles):
+    # expects:
+    #  a spritemap decoded by oam.decode_spritemap
+    #  the decoded tiles of the writes to the DMA
 
-    ret = int.from_bytes(rom.read(n), 'little')
-    if address is not None:
-        rom.seek(prevAddress)
-        
-    return ret
+    canvas = Canvas()
 
-def romSeek(address):
-    return rom.seek(gba2hex(address))
+    for entry in reversed(spritemap.tolist()):
+        (x_offset, y_offset, width, height, h_flip, v_flip, index, palette) = decode_object(entry)
 
-def romTell():
-    return hex2gba(rom.tell())
+        image = tiles[object_tiles(index, width, height)].swapaxes(1, 2).reshape(height, width) | palette
+        if h_flip:
+            image = image[:, ::-1]
+        if v_flip:
+            image = image[::-1]
 
-tile_dimensions = [[(8,8),(16,16),(32,32),(64,64)],[(16,8),(32,8),(32,16),(64,32)],[(8,16),(8,32),(16,32),(32,64)]]
-
-''' Modified From SpriteSomething (https://github.com/Artheau/SpriteSomething) '''
-def canvas_from_raw_data(tilemaps, DMA_writes):
-    # expects:
-    #  a list of tilemaps in the 3 2-byte format: essentially [
-    #                                                        Y position + shape,
-    #                                                        X position + flip + size,
-    #                                                        index + palette
-    #                                                       ]
-    #  a dictionary consisting of writes to the DMA and what should be there
-
-    canvas = {}
-
-    for tilemap in reversed(tilemaps):
-        # tilemap[0] contains Y offset and shape
-        y_offset = (tilemap[0] & 0x7F) - (tilemap[0] & 0x80)
-        shape = tilemap[0] >> 0xE
-
-        # tilemap[1] contains X offset, flip and size
-        x_offset = (tilemap[1] & 0xFF) - (tilemap[1] & 0x100)
-        v_flip = tilemap[1] & (1 << 0xD)
-        h_flip = tilemap[1] & (1 << 0xC)
-        size = tilemap[1] >> 0xE
-
-        # tilemap[2] contains tile index and palette
-        index = tilemap[2] & 0x3FF
-        palette = tilemap[2] >> 0x8 & 0xF0
-
-        # grab tile dimensions depending on shape and size
-        width = tile_dimensions[shape][size][0]
-        height = tile_dimensions[shape][size][1]
-
-        def draw_tile_to_canvas(new_x_offset, new_y_offset, new_index):
-            tile_to_write = convert_4bpp_tile_gba(DMA_writes[new_index*0x20:new_index*0x20+0x20], palette)
-            if h_flip:
-                tile_to_write = np.flipud(tile_to_write)
-            if v_flip:
-                tile_to_write = np.fliplr(tile_to_write)
-            for (i, j), value in np.ndenumerate(tile_to_write):
-                if value & 0xF != 0:  # if not transparent
-                    canvas[(new_x_offset + i, new_y_offset + j)] = int(value)
-
-        for x in range(width//8):
-            for y in range(height//8):
-                draw_tile_to_canvas(x_offset+abs(x*8-(width-8 if h_flip else 0)), y_offset+abs(y*8-(height-8 if v_flip else 0)), index+x+y*32)
+        canvas.blit(x_offset, y_offset, image)
 
     return canvas
 
-def max_width(canvas):
-    if canvas.keys():
-        x_min = min([x for (x, y) in canvas.keys()])
-        x_max = max([x for (x, y) in canvas.keys()]) + 1
+def tile_bounds(tiles):
+    '''Returns an (N, 4) array of the (left, top, right, bottom) of each tile's opaque pixels, all 0 for blank tiles'''
+    opaque = tiles & 0xF != 0
+    columns = opaque.any(axis=1)
+    rows = opaque.any(axis=2)
+    bounds = np.stack([columns.argmax(axis=1), rows.argmax(axis=1), 8 - columns[:, ::-1].argmax(axis=1), 8 - rows[:, ::-1].argmax(axis=1)], axis=1)
+    bounds[~columns.any(axis=1)] = 0
+    return bounds
+
+def on_canvas(spritemap):
+    '''Returns whether every object of a decoded spritemap is within the canvas'''
+    (width, height) = OBJ_DIMENSIONS[spritemap['shape'], spritemap['size']].T
+    return bool(np.all((spritemap['x'] >= -CANVAS_WIDTH//2) & (spritemap['x'] + width <= CANVAS_WIDTH//2) &
+                       (spritemap['y'] >= -CANVAS_HEIGHT//2) & (spritemap['y'] + height <= CANVAS_HEIGHT//2)))
+
+def spritemap_bounds(spritemap, bounds):
+    '''Returns what canvas_from_raw_data(spritemap, tiles).bbox() would, from the tile_bounds of the tiles
+
+    Only exact when the spritemap is on_canvas.'''
+    lefts, tops, rights, bottoms = [], [], [], []
+
+    for entry in spritemap.tolist():
+        (x_offset, y_offset, width, height, h_flip, v_flip, index, palette) = decode_object(entry)
+
+        tile_bbox = bounds[object_tiles(index, width, height)]
+        (left, top, right, bottom) = np.moveaxis(tile_bbox, 2, 0)
+        opaque = right != 0
+        left = left + 8*np.arange(width//8)
+        right = right + 8*np.arange(width//8)
+        top = top + 8*np.arange(height//8)[:, np.newaxis]
+        bottom = bottom + 8*np.arange(height//8)[:, np.newaxis]
+        if h_flip:
+            (left, right) = (width - right, width - left)
+        if v_flip:
+            (top, bottom) = (height - bottom, height - top)
+
+        lefts.append(left[opaque] + x_offset)
+        tops.append(top[opaque] + y_offset)
+        rights.append(right[opaque] + x_offset)
+        bottoms.append(bottom[opaque] + y_offset)
+
+    if not any(len(left) for left in lefts):
+        return None
+    return (int(np.concatenate(lefts).min()), int(np.concatenate(tops).min()), int(np.concatenate(rights).max()), int(np.concatenate(bottoms).max()))
 
-        return max(abs(x_min), abs(x_max))
-    else:
+def max_width(canvas):
+    bbox = canvas.bbox()
+    if bbox is None:
         return 1
+    return int(max(abs(bbox[0]), abs(bbox[2])))
 
 def max_height(canvas):
-    if canvas.keys():
-        y_min = min([y for (x, y) in canvas.keys()])
-        y_max = max([y for (x, y) in canvas.keys()]) + 1
-
-        return max(abs(y_min), abs(y_max))
-    else:
+    bbox = canvas.bbox()
+    if bbox is None:
         return 1
+    return int(max(abs(bbox[1]), abs(bbox[3])))
 
-def to_image(canvas, left, top, right, bottom):
-    # Returns an image cropped by a bounding box
-    image = Image.new("P", (right-left, bottom-top), 0)
-    if canvas.keys():
-        pixels = image.load()
-
-        for (i, j), value in canvas.items():
-            pixels[(i-left, j-top)] = value
+def crop(canvas, left, top, right, bottom):
+    # Returns the pixels in a bounding box
+    pixels = np.zeros((bottom-top, right-left), dtype=np.uint8)
 
-    return image
+    # only the part of the box that is on the canvas
+    (height, width) = canvas.pixels.shape
+    x0, y0 = max(left, -canvas.origin_x), max(top, -canvas.origin_y)
+    x1, y1 = min(right, width - canvas.origin_x), min(bottom, height - canvas.origin_y)
+    if x0 < x1 and y0 < y1:
+        pixels[y0-top:y1-top, x0-left:x1-left] = canvas.pixels[y0+canvas.origin_y:y1+canvas.origin_y, x0+canvas.origin_x:x1+canvas.origin_x]
 
+    return pixels
 
-def convert_4bpp_tile_gba(raw_tile, palette):
-    tile = np.zeros(64, dtype=np.uint8)
-
-    for i in range(32):
-        tile[i*2] = raw_tile[i] & 0xF | palette
-        tile[i*2+1] = raw_tile[i] >> 4 | palette
-
-    returnvalue = tile.reshape(8, 8)
-    returnvalue = returnvalue.swapaxes(0, 1)
-    return returnvalue
-
-def exportAnimation(gfx, pal, pAnim, fileName, animated=True):
-    canvases = []
-    durations = []
-    width = 0
-    height = 0
-    duplicate_spritemaps = set()
-
-    romSeek(pAnim)
-    while True:
-        spritemapAddr = romRead(4)
-        duration = romRead(4)
+def to_image(canvas, left, top, right, bottom):
+    # Returns an image cropped by a bounding box
+    return Image.fromarray(crop(canvas, left, top, right, bottom), 'P')
+
+
+class FrameCache:
+    '''Spritemaps rendered with one set of decoded tiles, keyed by spritemap address
+
+    Only the max_canvases most recently used canvases are kept, and release() drops them all once
+    the set's last animation is written.'''
+
+    def __init__(self, tiles, name='', max_canvases=MAX_CANVASES):
+        self.tiles = tiles
+        self.name = name
+        self.max_canvases = max_canvases
+        self.canvases = OrderedDict()
+        self.bounds = None
+        self.extents = {}
+        self.digests = {}
+        self.rendered = 0
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, rom, spritemapAddr, count):
+        canvas = self.canvases.get(spritemapAddr)
+        if canvas is not None:
+            self.hits += 1
+            self.canvases.move_to_end(spritemapAddr)
+            return canvas
+
+        self.misses += 1
+        profiling.count('frames rendered', group=self.name)
+        with profiling.stage('rendering', self.name):
+            canvas = canvas_from_raw_data(decode_spritemap(rom.u16(spritemapAddr + 2, count*3)), self.tiles).cropped()
+        self.rendered += 1
+        self.canvases[spritemapAddr] = canvas
+        if len(self.canvases) > self.max_canvases:
+            self.canvases.popitem(last=False)
+        return canvas
+
+    def release(self):
+        '''Drops the canvases and everything else computed from the tiles, keeping the counts'''
+        self.canvases.clear()
+        self.bounds = None
+        self.extents.clear()
+        self.digests.clear()
+
+    def digest(self, rom, spritemapAddr, count):
+        '''Returns a hash of the OAM and tiles a spritemap is drawn from'''
+        if spritemapAddr not in self.digests:
+            oam = rom.u16(spritemapAddr + 2, count*3)
+            inputs = hashlib.sha1(oam.tobytes())
+            for entry in decode_spritemap(oam).tolist():
+                (x_offset, y_offset, width, height, h_flip, v_flip, index, palette) = decode_object(entry)
+                inputs.update(self.tiles[object_tiles(index, width, height)].tobytes())
+            self.digests[spritemapAddr] = inputs.hexdigest()
+        return self.digests[spritemapAddr]
+
+    def extent(self, rom, spritemapAddr, count):
+        '''Returns (max_width, max_height) of a spritemap without drawing it'''
+        if spritemapAddr not in self.extents:
+            if self.bounds is None:
+                self.bounds = tile_bounds(self.tiles)
+            spritemap = decode_spritemap(rom.u16(spritemapAddr + 2, count*3))
+            if on_canvas(spritemap):
+                bbox = spritemap_bounds(spritemap, self.bounds)
+            else:
+                # partly clipped off the canvas, draw it to see what is left
+                bbox = self.render(rom, spritemapAddr, count).bbox()
+            if bbox is None:
+                self.extents[spritemapAddr] = (1, 1)
+            else:
+                self.extents[spritemapAddr] = (max(abs(bbox[0]), abs(bbox[2])), max(abs(bbox[1]), abs(bbox[3])))
+        return self.extents[spritemapAddr]
+
+def particle_beam(name):
+    '''Returns the beam whose graphics a particle animation is drawn with'''
+    if 'NormalBeam' in name:
+        return 'NormalBeam'
+    elif 'LongBeam' in name:
+        return 'LongBeam'
+    elif 'IceBeam' in name:
+        return 'IceBeam'
+    elif 'WaveBeam' in name:
+        return 'WaveBeam'
+    elif 'PlasmaBeam' in name or 'FullBeam' in name:
+        return 'PlasmaBeam'
+    elif 'Pistol' in name:
+        return 'Pistol'
+    else:
+        return 'NormalBeam'
+
+def print_frame_cache_stats(frame_caches):
+    print(f"{'graphics':<40} {'frames':>6} {'hits':>6} {'misses':>6} {'hit rate':>8}")
+    for frames in frame_caches:
+        total = frames.hits + frames.misses
+        if total:
+            print(f"{frames.name:<40} {frames.rendered:>6} {frames.hits:>6} {frames.misses:>6} {frames.hits/total:>8.1%}")
+    hits = sum(frames.hits for frames in frame_caches)
+    misses = sum(frames.misses for frames in frame_caches)
+    if hits + misses:
+        print(f"{'total':<40} {misses:>6} {hits:>6} {misses:>6} {hits/(hits+misses):>8.1%}")
+
+def read_animation(rom, pAnim):
+    '''Returns the (spritemapAddr, count, duration) of each frame of an animation, up to the first invalid one'''
+    animation = []
+
+    for (spritemapAddr, duration) in read_frame_table(rom, pAnim).tolist():
         if spritemapAddr < 0x8000000 or spritemapAddr >= 0xa000000 or duration == 0 or duration > 255:
             break
-        durations.append(duration*17) # ceil(1000/60)
-        currentAddr = rom.tell()
-        romSeek(spritemapAddr)
-
-        spritemap = []
-        for i in range(romRead(2)):
-            spritemap.append([romRead(2), romRead(2), romRead(2)])
 
-        if len(spritemap) > 128:
+        count = rom.read(2, spritemapAddr)
+        if count > 128:
             break
 
-        romSeek(currentAddr)
+        animation.append((spritemapAddr, count, duration*17)) # ceil(1000/60)
 
-        canvas = canvas_from_raw_data(spritemap, gfx)
+    return animation
 
-        if not animated:
+def exportAnimation(rom, frames, pal, pAnim, fileName, animated=True, pool=None, manifest=None):
+    animation = read_animation(rom, pAnim)
+    # the whole palette is written to every image
+    inputs = hashlib.sha1(repr((RENDER_VERSION, animated)).encode() + bytes(pal))
+
+    if not animated:
+        duplicate_spritemaps = set()
+        for (i, (spritemapAddr, count, duration)) in enumerate(animation):
             if spritemapAddr not in duplicate_spritemaps:
-                frame_image = to_image(canvas, -max_width(canvas), -max_height(canvas), max_width(canvas), max_height(canvas))
-                frame_image.putpalette(pal, 'RGBA')
-                frame_image.save(f"{fileName[:-4]}_Frame{len(canvases)}{fileName[-4:]}")
                 duplicate_spritemaps.add(spritemapAddr)
+                frameFileName = f"{fileName[:-4]}_Frame{i}{fileName[-4:]}"
+                frame_inputs = inputs.copy()
+                frame_inputs.update(frames.digest(rom, spritemapAddr, count).encode())
+                if manifest is not None and manifest.up_to_date(frameFileName, frame_inputs.hexdigest()):
+                    continue
 
-        canvases.append(canvas)
+                canvas = frames.render(rom, spritemapAddr, count)
+                frame_image = to_image(canvas, -max_width(canvas), -max_height(canvas), max_width(canvas), max_height(canvas))
+                frame_image.putpalette(pal, 'RGBA')
+                with profiling.stage('PNG encoding', frames.name):
+                    frame_image.save(frameFileName)
+                if manifest is not None:
+                    manifest.record(frameFileName, frame_inputs.hexdigest())
+        return
 
-        if max_width(canvas) > width:
-            width = max_width(canvas)
-        if max_height(canvas) > height:
-            height = max_height(canvas)
+    if len(animation) == 0:
+        return
 
-    if not animated or len(canvases) == 0:
+    for (spritemapAddr, count, duration) in animation:
+        inputs.update(f'{frames.digest(rom, spritemapAddr, count)} {duration}'.encode())
+    if manifest is not None and manifest.up_to_date(fileName, inputs.hexdigest()):
         return
 
-    images = []
-    for canvas in canvases:
-        image = to_image(canvas, -width, -height, width, height)
-        image.putpalette(pal, 'RGBA')
-        images.append(image)
-
-    images[0].save(fileName, save_all=True, n_frames=len(images), default_image=False, append_images=images[1:], duration=durations)
-    
-    return images[0]
-
-labelsFile = open("mzm_us.map")
-allAnimations = {}
-lastpGfx = 0
-lastpPal = 0
-particleAnimations = []
-
-line = labelsFile.readline()
-while line != '':
-    line = line.splitlines()[0]
-    if line.startswith("                0x08"):
-        split = line.split()
-        if len(split) == 2:
-            if int(split[0], 16) < 0x082b28a8: # sMorphBallGfx
-                line = labelsFile.readline()
-                continue
-            if int(split[0], 16) > 0x08326c98 and int(split[0], 16) < 0x08326d40: # sEscapeGateOam_Opened sBombOam_Slow
-                line = labelsFile.readline()
-                continue
-            if int(split[0], 16) > 0x0832b9f8 and int(split[0], 16) < 0x08339aa8: # sParticleSamusReflectionOam_Unused sParticleShootingBeamHorizontalOam_Frame0
-                line = labelsFile.readline()
-                continue
-            if int(split[0], 16) > 0x0833bcfc: # sSpriteDebrisOAM_Unused
-                break
-            if ("Oam" in split[1] or "OAM" in split[1]) and "MultiOam" not in split[1] and split[1] != "sDragonFireballOamRotation":
-                if int(split[0], 16) >= 0x08326d40:
-                    particleAnimations.append((int(split[0], 16), split[1]))
-                else:
-                    if (lastpGfx, lastpPal) in allAnimations:
-                        allAnimations[(lastpGfx, lastpPal)].append((int(split[0], 16), split[1]))
-                    else:
-                        allAnimations[(lastpGfx, lastpPal)] = [(int(split[0], 16), split[1])]
-            if "Gfx" in split[1] and not ("sRuinsTestGfx" in split[1] and split[1] != "sRuinsTestGfx") and not ("MechaRidley" in split[1] and split[1] != "sMechaRidleyGfx"):
-                lastpGfx = int(split[0], 16)
-            if "Pal" in split[1] and not ("MechaRidley" in split[1] and split[1] != "sMechaRidleyPal"):
-                lastpPal = int(split[0], 16)
-    line = labelsFile.readline()
-
-labelsFile.close()
-
-rom = open("mzm.gba", 'rb')
-
-if not os.access("animations", os.W_OK):
-    os.mkdir("animations")
-
-'''
-for ((pGfx, pPal), pAnims) in allAnimations.items():
-    romSeek(pPal)
-    palette555 = [romRead(2) for i in range(8*16)]
-
-    paletteRgba = [0]*(4*256)
-    for i in range(8*16):
-        paletteRgba[(i+0x80)*4] = (palette555[i] & 0x1F) << 3
-        paletteRgba[(i+0x80)*4+1] = (palette555[i] >> 5 & 0x1F) << 3
-        paletteRgba[(i+0x80)*4+2] = (palette555[i] >> 10 & 0x1F) << 3
-        paletteRgba[(i+0x80)*4+3] = 255
-
-    gfx, _ = decomp_lz77(rom, pGfx & 0x1FFFFFF)
-    gfx = bytearray(b'\0'*(0x20*0x200)+gfx+ b'\0'*(0x20*0x200-len(gfx)))
-
-    for (pAnim, name) in pAnims:
-        if os.access(f'animations/{name}.png', os.F_OK):
+    # size every frame from the tiles it uses before drawing any of them
+    width = 0
+    height = 0
+    for (spritemapAddr, count, duration) in animation:
+        (frame_width, frame_height) = frames.extent(rom, spritemapAddr, count)
+        width = max(width, frame_width)
+        height = max(height, frame_height)
+
+    # a spritemap repeated in a row is one longer frame
+    merged = []
+    for (spritemapAddr, count, duration) in animation:
+        if merged and merged[-1][0] == spritemapAddr:
+            merged[-1][2] += duration
+        else:
+            merged.append([spritemapAddr, count, duration])
+
+    def render():
+        for (spritemapAddr, count, duration) in merged:
+            yield (crop(frames.render(rom, spritemapAddr, count), -width, -height, width, height), duration)
+
+    # includes rendering, and waiting for frames compressed on the pool
+    with profiling.stage('APNG encoding', frames.name), ApngWriter(fileName, 2*width, 2*height, pal, len(merged), pool) as apng:
+        for (pixels, duration) in render():
+            apng.write_frame(pixels, duration)
+    if manifest is not None:
+        manifest.record(fileName, inputs.hexdigest())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Renders ZM sprite animations to animations/ and their frames to animation_frames/')
+    parser.add_argument('--profile', nargs='?', const='', default=None, metavar='TRACE',
+                        help='print time per stage and counters per graphics, and write a Chrome trace to TRACE if given')
+    parser.add_argument('--enemies', action='store_true', help='also render the enemy animations, not only the particles')
+    args = parser.parse_args()
+    if args.profile is not None:
+        profiling.enable()
+
+    allAnimations = {}
+    lastpGfx = 0
+    lastpPal = 0
+    particleAnimations = []
+
+    symbols = load_symbols()
+    for (address, name) in symbols.range(0x082b28a8, 0x0833bcfc+1): # sMorphBallGfx sSpriteDebrisOAM_Unused
+        if 0x08326c98 < address < 0x08326d40: # sEscapeGateOam_Opened sBombOam_Slow
             continue
-
-        exportAnimation(gfx, paletteRgba, pAnim, f'animations/{name}.png')
-        exportAnimation(gfx, paletteRgba, pAnim, f'animation_frames/{name}.png', animated=False)
-'''
-
-romSeek(0x0832ba08) # sCommonSpritesPal
-palette555 = [romRead(2) for i in range(8*16)]
-
-paletteRgba = [0]*(4*256)
-for i in range(6*16):
-    paletteRgba[(i+0x20)*4] = (palette555[i] & 0x1F) << 3
-    paletteRgba[(i+0x20)*4+1] = (palette555[i] >> 5 & 0x1F) << 3
-    paletteRgba[(i+0x20)*4+2] = (palette555[i] >> 10 & 0x1F) << 3
-    paletteRgba[(i+0x20)*4+3] = 255
-
-gfx = [0]*(0x20*0x40)
-romSeek(0x0832bac8) # sCommonSpritesGfx
-gfx += [romRead() for j in range(0x20*0x40*8)]
-gfx += [0]*(0x20*0x200)
-
-lastBeam = ''
-lastMissile = ''
-for (pAnim, name) in particleAnimations:
-    #if os.access(f'animations/{name}.png', os.F_OK):
-    #    continue
-
-    if 'NormalBeam' in name:
-        currentBeam = 'NormalBeam'
-    elif 'LongBeam' in name:
-        currentBeam = 'LongBeam'
-    elif 'IceBeam' in name:
-        currentBeam = 'IceBeam'
-    elif 'WaveBeam' in name:
-        currentBeam = 'WaveBeam'
-    elif 'PlasmaBeam' in name or 'FullBeam' in name:
-        currentBeam = 'PlasmaBeam'
-    elif 'Pistol' in name:
-        currentBeam = 'Pistol'
-    else:
-        currentBeam = 'NormalBeam'
-
-    if currentBeam != lastBeam:
-        lastBeam = currentBeam
-        if currentBeam == 'NormalBeam':
-            beamPGfx = 0x083271a8 # sNormalBeamGfx_Top
-            beamPPal = 0x083270e8
-        elif currentBeam == 'LongBeam':
-            beamPGfx = 0x08327b90 # sLongBeamGfx_Top
-            beamPPal = 0x083270e8+0x20
-        elif currentBeam == 'IceBeam':
-            beamPGfx = 0x08328500 # sIceBeamGfx_Top
-            beamPPal = 0x083270e8+0x40
-        elif currentBeam == 'WaveBeam':
-            beamPGfx = 0x08328f34 # sWaveBeamGfx_Top
-            beamPPal = 0x083270e8+0x60
-        elif currentBeam == 'PlasmaBeam':
-            beamPGfx = 0x08329ed4 # sPlasmaBeamGfx_Top
-            beamPPal = 0x083270e8+0x80
-        elif currentBeam == 'Pistol':
-            beamPGfx = 0x0832b078 # sPistolGfx_Top
-            beamPPal = 0x083270e8+0xA0
-
-        romSeek(beamPPal)
-        palette555 = [romRead(2) for i in range(5)]
-
-        for i in range(5):
-            paletteRgba[(i+0x20)*4] = (palette555[i] & 0x1F) << 3
-            paletteRgba[(i+0x20)*4+1] = (palette555[i] >> 5 & 0x1F) << 3
-            paletteRgba[(i+0x20)*4+2] = (palette555[i] >> 10 & 0x1F) << 3
-            paletteRgba[(i+0x20)*4+3] = 255
-
-        romSeek(beamPGfx)
-        gfx[0x80*0x20:0x90*0x20] = [romRead() for j in range(0x20*0x10)]
-        gfx[0xA0*0x20:0xB0*0x20] = [romRead() for j in range(0x20*0x10)]
-        gfx[0xC0*0x20:0xD0*0x20] = [romRead() for j in range(0x20*0x10)]
-        gfx[0xE0*0x20:0xF0*0x20] = [romRead() for j in range(0x20*0x10)]
-
-    #exportAnimation(gfx, paletteRgba, pAnim, f'animations/{name}.png')
-    exportAnimation(gfx, paletteRgba, pAnim, f'animation_frames/{name}.png', False)
+        if 0x0832b9f8 < address < 0x08339aa8: # sParticleSamusReflectionOam_Unused sParticleShootingBeamHorizontalOam_Frame0
+            continue
+        if ("Oam" in name or "OAM" in name) and "MultiOam" not in name and name != "sDragonFireballOamRotation":
+            if address >= 0x08326d40:
+                particleAnimations.append((address, name))
+            else:
+                if (lastpGfx, lastpPal) in allAnimations:
+                    allAnimations[(lastpGfx, lastpPal)].append((address, name))
+                else:
+                    allAnimations[(lastpGfx, lastpPal)] = [(address, name)]
+        if "Gfx" in name and not ("sRuinsTestGfx" in name and name != "sRuinsTestGfx") and not ("MechaRidley" in name and name != "sMechaRidleyGfx"):
+            lastpGfx = address
+        if "Pal" in name and not ("MechaRidley" in name and name != "sMechaRidleyPal"):
+            lastpPal = address
+
+    rom = Rom("mzm.gba")
+
+    for directory in ("animations", "animation_frames"):
+        if not os.access(directory, os.W_OK):
+            os.mkdir(directory)
+
+    manifest = BuildManifest(os.path.join(CACHE_DIR, 'animations.manifest.json'))
+    frameCaches = []
+    encodePool = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+    if args.enemies:
+        for ((pGfx, pPal), pAnims) in allAnimations.items():
+            paletteRgba = np.zeros((256, 4), dtype=np.uint8)
+            paletteRgba[0x80:0x100, :3] = bgr555_to_rgb(rom.u16(pPal, 8*16))
+            paletteRgba[0x80:0x100, 3] = 255
+            paletteRgba = paletteRgba.ravel().tolist()
+
+            gfx, _ = decomp_lz77_cached(rom, gba2hex(pGfx), default_cache)
+            gfx = bytearray(b'\0'*(0x20*0x200)+gfx+ b'\0'*(0x20*0x200-len(gfx)))
+            frames = FrameCache(decode_4bpp_gba(gfx), symbols.get(pGfx, hex(pGfx)))
+            frameCaches.append(frames)
+
+            for (pAnim, name) in pAnims:
+                exportAnimation(rom, frames, paletteRgba, pAnim, f'animations/{name}.png', pool=encodePool, manifest=manifest)
+                exportAnimation(rom, frames, paletteRgba, pAnim, f'animation_frames/{name}.png', animated=False, manifest=manifest)
+            frames.release()
+
+    paletteRgba = np.zeros((256, 4), dtype=np.uint8)
+    paletteRgba[0x20:0x80, :3] = bgr555_to_rgb(rom.u16(0x0832ba08, 6*16)) # sCommonSpritesPal
+    paletteRgba[0x20:0x80, 3] = 255
+
+    gfx = bytearray(0x20*0x40)
+    gfx += rom.view(0x0832bac8, 0x20*0x40*8) # sCommonSpritesGfx
+    gfx += bytearray(0x20*0x200)
+
+    lastBeam = ''
+    lastMissile = ''
+    beamFrames = {}
+    particleBeams = [particle_beam(name) for (pAnim, name) in particleAnimations]
+    # each beam's canvases are dropped after its last animation
+    lastAnimation = {beam: i for (i, beam) in enumerate(particleBeams)}
+    for (i, ((pAnim, name), currentBeam)) in enumerate(zip(particleAnimations, particleBeams)):
+        if currentBeam != lastBeam:
+            lastBeam = currentBeam
+            if currentBeam == 'NormalBeam':
+                beamPGfx = 0x083271a8 # sNormalBeamGfx_Top
+                beamPPal = 0x083270e8
+            elif currentBeam == 'LongBeam':
+                beamPGfx = 0x08327b90 # sLongBeamGfx_Top
+                beamPPal = 0x083270e8+0x20
+            elif currentBeam == 'IceBeam':
+                beamPGfx = 0x08328500 # sIceBeamGfx_Top
+                beamPPal = 0x083270e8+0x40
+            elif currentBeam == 'WaveBeam':
+                beamPGfx = 0x08328f34 # sWaveBeamGfx_Top
+                beamPPal = 0x083270e8+0x60
+            elif currentBeam == 'PlasmaBeam':
+                beamPGfx = 0x08329ed4 # sPlasmaBeamGfx_Top
+                beamPPal = 0x083270e8+0x80
+            elif currentBeam == 'Pistol':
+                beamPGfx = 0x0832b078 # sPistolGfx_Top
+                beamPPal = 0x083270e8+0xA0
+
+            paletteRgba[0x20:0x25, :3] = bgr555_to_rgb(rom.u16(beamPPal, 5))
+
+            if currentBeam not in beamFrames:
+                gfx[0x80*0x20:0x90*0x20] = rom.view(beamPGfx, 0x20*0x10)
+                gfx[0xA0*0x20:0xB0*0x20] = rom.view(beamPGfx+0x20*0x10, 0x20*0x10)
+                gfx[0xC0*0x20:0xD0*0x20] = rom.view(beamPGfx+0x20*0x20, 0x20*0x10)
+                gfx[0xE0*0x20:0xF0*0x20] = rom.view(beamPGfx+0x20*0x30, 0x20*0x10)
+                beamFrames[currentBeam] = FrameCache(decode_4bpp_gba(gfx), f'sCommonSpritesGfx ({currentBeam})')
+                frameCaches.append(beamFrames[currentBeam])
+            frames = beamFrames[currentBeam]
+
+        #exportAnimation(rom, frames, paletteRgba.ravel().tolist(), pAnim, f'animations/{name}.png', pool=encodePool, manifest=manifest)
+        exportAnimation(rom, frames, paletteRgba.ravel().tolist(), pAnim, f'animation_frames/{name}.png', False, manifest=manifest)
+        if lastAnimation[currentBeam] == i:
+            frames.release()
+
+    encodePool.shutdown()
+    manifest.save()
+    print_frame_cache_stats(frameCaches)
+    print(f"{manifest.built} outputs built, {manifest.skipped} up to date")
+    if args.profile is not None:
+        profiling.report(args.profile)
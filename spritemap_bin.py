@@ -0,0 +1,209 @@
+''' Binary container for spritemap editor JSON: the palette as BGR555, the raw 4bpp gfx and the spritemaps in SNES format, readable in place through mmap '''
+
+import argparse, base64, json, mmap, struct
+import numpy as np
+from oam import SPRITEMAP_DTYPE, spritemap_entries
+from rom import bgr555_to_rgb, rgb_to_bgr555
+
+MAGIC = b'SMSP'
+VERSION = 1
+# magic, version, reserved, then (offset, size) of the palette, gfx, frame index, spritemaps and metadata
+HEADER = struct.Struct('<4sHH10I')
+SECTIONS = ('palette', 'gfx', 'index', 'spritemaps', 'metadata')
+
+# a spritemap is a u16 count followed by count of these, as in SM's ROM
+SNES_ENTRY_DTYPE = np.dtype([('x', '<u2'), ('y', 'i1'), ('attributes', '<u2')])
+
+ENTRY_KEYS = ('x', 'y', 'tile', 'palette', 'bg_priority', 'h_flip', 'v_flip', 'big')
+FIELD_RANGES = {'x': (-0x100, 0xFF), 'y': (-0x80, 0x7F), 'tile': (0, 0x1FF), 'palette': (0, 7), 'bg_priority': (0, 3)}
+
+def encode_snes_spritemap(entries, name=''):
+    '''Encodes the JSON entries of a spritemap in SNES format, raising ValueError for ones it can't hold'''
+    for entry in entries:
+        if sorted(entry) != sorted(ENTRY_KEYS):
+            raise ValueError(f'{name}: entry keys are {", ".join(entry)}, expected {", ".join(ENTRY_KEYS)}')
+        for (field, (low, high)) in FIELD_RANGES.items():
+            if type(entry[field]) is not int or not low <= entry[field] <= high:
+                raise ValueError(f'{name}: {field} {entry[field]!r} is not an integer from {low} to {high}')
+        for field in ('h_flip', 'v_flip', 'big'):
+            if type(entry[field]) is not bool:
+                raise ValueError(f'{name}: {field} {entry[field]!r} is not a boolean')
+
+    encoded = np.empty(len(entries), dtype=SNES_ENTRY_DTYPE)
+    encoded['x'] = [entry['x'] & 0x1FF | entry['big'] << 15 for entry in entries]
+    encoded['y'] = [entry['y'] for entry in entries]
+    encoded['attributes'] = [entry['tile'] | entry['palette'] << 9 | entry['bg_priority'] << 12 | entry['h_flip'] << 14 | entry['v_flip'] << 15 for entry in entries]
+    return struct.pack('<H', len(entries)) + encoded.tobytes()
+
+def decode_snes_spritemap(buffer, offset=0):
+    '''Decodes the SNES spritemap at offset to a SPRITEMAP_DTYPE record array'''
+    (count,) = struct.unpack_from('<H', buffer, offset)
+    encoded = np.frombuffer(buffer, dtype=SNES_ENTRY_DTYPE, count=count, offset=offset + 2)
+    (x, attributes) = (encoded['x'].astype(np.int32), encoded['attributes'].astype(np.int32))
+
+    entries = np.empty(count, dtype=SPRITEMAP_DTYPE)
+    entries['x'] = (x & 0x1FF ^ 0x100) - 0x100
+    entries['y'] = encoded['y']
+    entries['tile'] = attributes & 0x1FF
+    entries['palette'] = attributes >> 9 & 7
+    entries['bg_priority'] = attributes >> 12 & 3
+    entries['h_flip'] = attributes & 0x4000 != 0
+    entries['v_flip'] = attributes & 0x8000 != 0
+    entries['big'] = x & 0x8000 != 0
+    return entries
+
+def encode_palette(palette):
+    '''Converts the ARGB palette of the JSON to BGR555, raising ValueError if that loses anything'''
+    argb = np.array(palette, dtype=np.int64)
+    rgb = np.stack([argb >> 16 & 0xFF, argb >> 8 & 0xFF, argb & 0xFF], axis=1)
+    palette555 = rgb_to_bgr555(rgb)
+    if np.any(argb >> 24 != 0xFF) or np.any(decode_palette(palette555) != argb):
+        raise ValueError('palette has colours that are not opaque BGR555')
+    return palette555
+
+def decode_palette(palette555):
+    rgb = bgr555_to_rgb(palette555).astype(np.int64)
+    return 0xFF000000 | rgb[:, 0] << 16 | rgb[:, 1] << 8 | rgb[:, 2]
+
+def align(data):
+    return data + bytes(-len(data) % 4)
+
+def key_orders(entries):
+    '''Returns [[index, keys]] of the entries whose keys aren't in ENTRY_KEYS order, or None if there are none'''
+    orders = [[i, list(entry)] for (i, entry) in enumerate(entries) if tuple(entry) != ENTRY_KEYS]
+    return orders or None
+
+def json_to_binary(data):
+    '''Returns the container bytes of spritemap editor JSON, raising ValueError if it wouldn't convert back the same'''
+    gfx = base64.b64decode(data['gfx'])
+    if str(base64.b64encode(gfx), 'utf8') != data['gfx']:
+        raise ValueError('gfx is not plain base64')
+
+    spritemaps = b''
+    index = []
+    for spritemap in data['spritemaps']:
+        index.append(len(spritemaps))
+        spritemaps += encode_snes_spritemap(spritemap['spritemap'], spritemap['name'])
+
+    # everything else, in the same places, with None for what is stored in the other sections. The
+    # editor doesn't always write entry keys in the same order, so other orders are kept instead of None
+    metadata = dict(data, gfx=None, palette=None, spritemaps=[dict(spritemap, spritemap=key_orders(spritemap['spritemap'])) for spritemap in data['spritemaps']])
+    sections = [encode_palette(data['palette']).astype('<u2').tobytes(), gfx, np.array(index, dtype='<u4').tobytes(),
+                spritemaps, json.dumps(metadata, separators=(',', ':')).encode()]
+
+    offsets = []
+    body = b''
+    for section in sections:
+        offsets += [HEADER.size + len(body), len(section)]
+        body += align(section)
+    return HEADER.pack(MAGIC, VERSION, 0, *offsets) + body
+
+def read_sections(buffer):
+    '''Returns {section name: (offset, size)} from the header of a container'''
+    if len(buffer) < HEADER.size:
+        raise ValueError('too short for a spritemap container')
+    (magic, version, reserved, *offsets) = HEADER.unpack_from(buffer)
+    if magic != MAGIC:
+        raise ValueError('not a spritemap container')
+    if version != VERSION:
+        raise ValueError(f'container version {version}, expected {VERSION}')
+    sections = dict(zip(SECTIONS, zip(offsets[0::2], offsets[1::2])))
+    for (name, (offset, size)) in sections.items():
+        if offset + size > len(buffer):
+            raise ValueError(f'{name} runs past the end of the container')
+    return sections
+
+class SpritemapFile:
+    '''A read-only memory-mapped container
+
+    The palette, gfx and frame index are views into the map; spritemaps are decoded on request.'''
+
+    def __init__(self, fp):
+        with open(fp, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.data = memoryview(self.mmap)
+        self.sections = read_sections(self.data)
+        self._metadata = None
+
+        (offset, size) = self.sections['palette']
+        self.palette = np.frombuffer(self.mmap, dtype='<u2', count=size//2, offset=offset)
+        (offset, size) = self.sections['gfx']
+        self.gfx = self.data[offset:offset + size]
+        (offset, size) = self.sections['index']
+        self.index = np.frombuffer(self.mmap, dtype='<u4', count=size//4, offset=offset)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        try:
+            self.gfx.release()
+            self.data.release()
+            self.mmap.close()
+        except BufferError:
+            # palette and index still point into the map, it gets closed once they are freed
+            pass
+
+    @property
+    def metadata(self):
+        '''The JSON without its palette, gfx and spritemap entries'''
+        if self._metadata is None:
+            (offset, size) = self.sections['metadata']
+            self._metadata = json.loads(bytes(self.data[offset:offset + size]))
+        return self._metadata
+
+    def spritemap(self, i):
+        '''Returns frame i as a SPRITEMAP_DTYPE record array'''
+        return decode_snes_spritemap(self.mmap, self.sections['spritemaps'][0] + int(self.index[i]))
+
+    def to_json(self):
+        return binary_to_json(self.data)
+
+def binary_to_json(buffer):
+    '''Returns the spritemap editor JSON a container was made from'''
+    sections = read_sections(buffer)
+    (offset, size) = sections['metadata']
+    data = json.loads(bytes(buffer[offset:offset + size]))
+
+    (offset, size) = sections['palette']
+    data['palette'] = decode_palette(np.frombuffer(buffer, dtype='<u2', count=size//2, offset=offset)).tolist()
+    (offset, size) = sections['gfx']
+    data['gfx'] = str(base64.b64encode(buffer[offset:offset + size]), 'utf8')
+
+    (offset, size) = sections['index']
+    index = np.frombuffer(buffer, dtype='<u4', count=size//4, offset=offset).tolist()
+    if len(index) != len(data['spritemaps']):
+        raise ValueError(f"{len(index)} frames in the index, {len(data['spritemaps'])} in the metadata")
+    start = sections['spritemaps'][0]
+    for (spritemap, frame) in zip(data['spritemaps'], index):
+        entries = [entry._asdict() for entry in spritemap_entries(decode_snes_spritemap(buffer, start + frame))]
+        for (i, keys) in spritemap['spritemap'] or []:
+            entries[i] = {key: entries[i][key] for key in keys}
+        spritemap['spritemap'] = entries
+    return data
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Converts spritemap editor JSON to a binary container and back, by file extension')
+    parser.add_argument('files', nargs='+', help='.json files to convert to .bin, or .bin files to convert to .json')
+    args = parser.parse_args()
+
+    # not at the top, as the converter imports this module
+    from oam_gba_2_snes import write_atomic
+
+    for fp in args.files:
+        if fp.endswith('.json'):
+            with open(fp) as f:
+                binary = json_to_binary(json.load(f))
+            write_atomic(fp[:-len('.json')] + '.bin', binary)
+        elif fp.endswith('.bin'):
+            with open(fp, 'rb') as f:
+                data = binary_to_json(f.read())
+            write_atomic(fp[:-len('.bin')] + '.json', json.dumps(data, indent=1))
+        else:
+            parser.error(f'{fp} is neither .json nor .bin')
@@ -0,0 +1,277 @@
+''' Builds a synthetic ROM and linker map laid out like the parts of ZM these scripts read, for benchmarking without a copyrighted ROM '''
+
+import argparse, os, random, struct
+import numpy as np
+from PIL import Image
+from decompressor import MAX_MATCH_SIZE, MAX_WINDOW_SIZE, MIN_MATCH_SIZE
+from oam import tile_dimensions
+from rom import gba2hex
+
+# bump when the fixture changes, so benchmark baselines made from an older one are not compared
+FIXTURE_VERSION = 1
+ROM_SIZE = 0x800000
+
+# enemies of enemies.txt, with the spritemap start given for the ones that need it there
+ENEMIES = {
+    0x12: 'zoomer', 0x14: 'zeela', 0x16: 'ripper', 0x18: 'zeb', 0x1F: 'skree', 0x21: 'morph_ball', 0x34: 'multiviola',
+    0x37: 'geruta', 0x38: 'squeept', 0x3B: 'dragon', 0x3F: 'reo', 0x45: 'skultera', 0x46: 'dessgeega', 0x48: 'waver',
+    0x50: 'elevator', 0x57: 'gamet', 0x5B: 'zebbo', 0x60: 'piston', 0x64: 'metroid', 0x66: 'rinka', 0x67: 'polyp',
+    0x68: 'viola', 0x6B: 'holtz', 0x71: 'ripper2', 0x72: 'mella', 0x79: 'sidehopper', 0x7A: 'geega', 0x93: 'baristute'
+}
+EXPLICIT_STARTS = {0x16, 0x18, 0x1F, 0x3F, 0x5B, 0x64, 0x66, 0x68, 0x7A}
+
+def compress_lz77(data):
+    '''Compresses data in the GBA BIOS LZ77 format, finding matches through hash chains of 3 bytes'''
+    out = bytearray([0x10]) + len(data).to_bytes(3, 'little')
+    chains = {}
+    hashed = 0
+    i = 0
+    while i < len(data):
+        flag_index = len(out)
+        out.append(0)
+        for bit in range(8):
+            if i >= len(data):
+                break
+            while hashed < i:
+                chains.setdefault(bytes(data[hashed:hashed + MIN_MATCH_SIZE]), []).append(hashed)
+                hashed += 1
+
+            (best_length, best_window) = (0, 0)
+            for start in reversed(chains.get(bytes(data[i:i + MIN_MATCH_SIZE]), [])[-64:]):
+                window = i - start
+                if window > MAX_WINDOW_SIZE:
+                    break
+                length = 0
+                while length < MAX_MATCH_SIZE and i + length < len(data) and data[i + length] == data[i + length - window]:
+                    length += 1
+                if length > best_length:
+                    (best_length, best_window) = (length, window)
+                    if length == MAX_MATCH_SIZE:
+                        break
+
+            if best_length >= MIN_MATCH_SIZE:
+                out[flag_index] |= 0x80 >> bit
+                out += bytes(((best_length - MIN_MATCH_SIZE) << 4 | (best_window - 1) >> 8, (best_window - 1) & 0xFF))
+                i += best_length
+            else:
+                out.append(data[i])
+                i += 1
+
+    return bytes(out + bytes(-len(out) % 4))
+
+def compress_rle(data):
+    '''Compresses data in ZM's RLE format: even bytes, then odd bytes, each as runs with 1-byte lengths'''
+    if len(data) % 2:
+        raise ValueError('RLE data must be an even number of bytes')
+    out = bytearray()
+    for half in (data[0::2], data[1::2]):
+        out.append(1)
+        i = 0
+        while i < len(half):
+            run = 1
+            while run < 0x7F and i + run < len(half) and half[i + run] == half[i]:
+                run += 1
+            if run >= 3:
+                out += bytes((0x80 | run, half[i]))
+                i += run
+                continue
+            # literals up to the next run of 3
+            end = i
+            while end < len(half) and end - i < 0x7F and not (end + 2 < len(half) and half[end] == half[end + 1] == half[end + 2]):
+                end += 1
+            out.append(end - i)
+            out += half[i:end]
+            i = end
+        out.append(0)
+    return bytes(out)
+
+def encode_4bpp_gba(tiles):
+    '''Converts an (N, 8, 8) array of pixels to GBA 4bpp tile data'''
+    pixels = np.asarray(tiles, dtype=np.uint8).reshape(-1, 0x20, 2)
+    return (pixels[:, :, 0] | pixels[:, :, 1] << 4).tobytes()
+
+class RomBuilder:
+    '''A ROM image filled in at GBA addresses, with the symbols for its linker map'''
+
+    def __init__(self, seed):
+        self.rng = random.Random(seed)
+        self.data = bytearray(ROM_SIZE)
+        self.labels = []
+
+    def put(self, address, data, label=None):
+        self.data[gba2hex(address):gba2hex(address) + len(data)] = data
+        if label is not None:
+            self.labels.append((address, label))
+        return address + len(data)
+
+    def random_tile(self):
+        if self.rng.random() < 0.1:
+            return np.zeros((8, 8), dtype=np.uint8)
+        return np.array([self.rng.randrange(16) if self.rng.random() < 0.7 else 0 for _ in range(64)], dtype=np.uint8).reshape(8, 8)
+
+    def random_palette(self, colours):
+        return b''.join(struct.pack('<H', self.rng.randrange(0x8000)) for _ in range(colours))
+
+    def random_frames(self, rows, count):
+        '''Returns spritemaps of random OAM attribute triples within a sheet of rows palette rows'''
+        frames = []
+        for _ in range(count):
+            entries = []
+            for _ in range(self.rng.randrange(1, 6)):
+                while True:
+                    (shape, size) = (self.rng.randrange(3), self.rng.randrange(3 if rows > 1 else 2))
+                    (width, height) = (dimension // 8 for dimension in tile_dimensions[shape][size])
+                    if height <= rows*2:
+                        break
+                tile = 0x200 + self.rng.randrange(rows*2 - height + 1)*32 + self.rng.randrange(32 - width + 1)
+                x = self.rng.randrange(-40, 40) & 0x1FF
+                y = self.rng.randrange(-40, 40) & 0xFF
+                (h_flip, v_flip) = (self.rng.random() < 0.3, self.rng.random() < 0.2)
+                palette = 8 + self.rng.randrange(rows)
+                entries.append((y | shape << 14, x | h_flip << 12 | v_flip << 13 | size << 14, tile | self.rng.randrange(4) << 10 | palette << 12))
+            frames.append(entries)
+        return frames
+
+    def put_frames(self, address, frames):
+        '''Writes spritemaps one after another, returning (their addresses, the address after them)'''
+        addresses = []
+        for entries in frames:
+            addresses.append(address)
+            address = self.put(address, struct.pack('<H', len(entries)) + b''.join(struct.pack('<3H', *entry) for entry in entries))
+        return (addresses, address)
+
+def snes_sheet(rng, tiles, rows):
+    '''Returns a hand-made-looking SNES sheet of a GBA sheet: some 16x16 regions and tiles, some of them flipped'''
+    quads = []
+    for y in range(0, rows*2 - 1, 2):
+        for x in range(0, 31, 2):
+            if rng.random() < 0.6:
+                quad = [tiles[y*32 + x], tiles[y*32 + x + 1], tiles[(y + 1)*32 + x], tiles[(y + 1)*32 + x + 1]]
+                flip = rng.random()
+                if flip < 0.2:
+                    quad = [quad[1][:, ::-1], quad[0][:, ::-1], quad[3][:, ::-1], quad[2][:, ::-1]]
+                elif flip < 0.3:
+                    quad = [quad[2][::-1], quad[3][::-1], quad[0][::-1], quad[1][::-1]]
+                quads.append(quad)
+
+    rows = max(2, (len(quads) + 7) // 8 * 2 + 2)
+    pixels = np.zeros((rows*8, 128), dtype=np.uint8)
+    for (i, quad) in enumerate(quads):
+        for (k, tile) in enumerate(quad):
+            (y, x) = (i // 8 * 2 + k // 2, i % 8 * 2 + k % 2)
+            pixels[y*8:y*8 + 8, x*8:x*8 + 8] = tile
+
+    first_row = (len(quads) + 7) // 8 * 2
+    singles = [tile if rng.random() < 0.7 else tile[:, ::-1] for tile in rng.sample(tiles, min(32, len(tiles)))]
+    for (i, tile) in enumerate(singles):
+        (y, x) = (first_row + i // 16, i % 16)
+        if y < rows:
+            pixels[y*8:y*8 + 8, x*8:x*8 + 8] = tile
+
+    image = Image.fromarray(pixels, 'P')
+    image.putpalette([rng.randrange(256) for _ in range(48)])
+    return image
+
+def build(seed=1234):
+    '''Returns (RomBuilder, {sprite_id: (name, SNES sheet, spritemap start or None)})'''
+    rom = RomBuilder(seed)
+    rng = rom.rng
+    enemies = {}
+
+    address = 0x82B3000
+    for sprite_id in range(0x12, 0xC6):
+        name = ENEMIES.get(sprite_id, f'sprite{sprite_id:02x}')
+        label = ''.join(part.capitalize() for part in name.split('_'))
+        rows = rng.randrange(1, 3) if sprite_id in ENEMIES else 1
+
+        tiles = [rom.random_tile() for _ in range(rows*64)]
+        for i in range(len(tiles)):
+            if rng.random() < 0.15:
+                tile = tiles[rng.randrange(len(tiles))]
+                tiles[i] = (tile[:, ::-1] if rng.random() < 0.5 else tile[::-1, ::-1]).copy()
+
+        gfx = address
+        address = rom.put(gfx, compress_lz77(encode_4bpp_gba(tiles)), f's{label}Gfx')
+        address = (address + 3) // 4 * 4
+        palette = address
+        address = rom.put(palette, rom.random_palette(16*rows), f's{label}Pal')
+        struct.pack_into('<I', rom.data, gba2hex(0x875EBF8 + (sprite_id - 0x10)*4), gfx)
+        struct.pack_into('<I', rom.data, gba2hex(0x875EEF0 + (sprite_id - 0x10)*4), palette)
+        if sprite_id not in ENEMIES:
+            continue
+
+        # the enemies given a start in enemies.txt have something between their palette and spritemaps
+        if sprite_id in EXPLICIT_STARTS:
+            address += 0x10
+        start = address
+        (frames, address) = rom.put_frames(address, rom.random_frames(rows, rng.randrange(2, 8)))
+        address = (address + 3) // 4 * 4
+        for i in range(rng.randrange(1, 4)):
+            table = b''.join(struct.pack('<II', rng.choice(frames), rng.randrange(1, 20)) for _ in range(rng.randrange(1, 5)))
+            address = rom.put(address, table + bytes(8), f's{label}Oam_Anim{i}')
+        address = rom.put(address, struct.pack('<I', 0x12345))
+        enemies[sprite_id] = (name, snes_sheet(rng, tiles, rows), start if sprite_id in EXPLICIT_STARTS else None)
+        address = (address + 0x20 + 3) // 4 * 4
+
+    if address >= 0x8326C98:
+        raise ValueError(f'Enemy data runs into the beam graphics at {address:#x}')
+
+    # common sprites and beams, at the addresses of tiles.txt and sprite_oam_to_apng.py
+    rom.put(0x832BA08, rom.random_palette(0x60), 'sCommonSpritesPal')
+    rom.put(0x832BAC8, encode_4bpp_gba([rom.random_tile() for _ in range(0x200)]), 'sCommonSpritesGfx')
+    for (gfx, beam) in [(0x83271A8, 'Normal'), (0x8327B90, 'Long'), (0x8328500, 'Ice'), (0x8328F34, 'Wave'), (0x8329ED4, 'Plasma'), (0x832B078, 'Pistol')]:
+        rom.put(gfx, encode_4bpp_gba([rom.random_tile() for _ in range(0x40)]), f's{beam}BeamGfx_Top')
+    rom.put(0x83270E8, rom.random_palette(0x60))
+
+    particle_frames = []
+    for _ in range(12):
+        entries = []
+        for _ in range(rng.randrange(1, 5)):
+            (shape, size) = (rng.randrange(3), rng.randrange(2))
+            tile = rng.randrange(0x40, 0x1C0) & ~0x21
+            entries.append(((rng.randrange(-20, 20) & 0xFF) | shape << 14, (rng.randrange(-20, 20) & 0x1FF) | (rng.random() < 0.3) << 12 | (rng.random() < 0.3) << 13 | size << 14, tile | (2 + rng.randrange(5)) << 12))
+        particle_frames.append(entries)
+    (particle_frames, address) = rom.put_frames(0x8339AA8, particle_frames)
+    address = (address + 3) // 4 * 4
+    for name in ['sParticleNormalBeamOam', 'sParticleChargingLongBeamOam', 'sParticleIceBeamOam', 'sParticleExplosionOam', 'sParticleFullBeamOam', 'sParticlePistolOam', 'sParticleWaveBeamOam']:
+        table = b''.join(struct.pack('<II', rng.choice(particle_frames), rng.randrange(1, 10)) for _ in range(rng.randrange(1, 5)))
+        address = rom.put(address, table + bytes(8), name)
+    rom.labels.append((0x833BD00, 'sSpriteDebrisOAM_After'))
+
+    # RLE data, as used for room tilemaps, past everything else
+    address = 0x8400000
+    for i in range(8):
+        tilemap = np.repeat(np.array([rng.randrange(0x400) for _ in range(0x80)], dtype='<u2'), [rng.randrange(1, 12) for _ in range(0x80)])
+        address = rom.put(address, compress_rle(tilemap.tobytes()), f'sSyntheticTilemap{i}Rle')
+        address = (address + 3) // 4 * 4
+
+    return (rom, enemies)
+
+def linker_map(labels):
+    '''Returns the text of a linker map defining labels, in the layout parse_map reads'''
+    lines = ['Memory map', '', ' .bss           0x0000000003000000     0x100 src/x.o', '                0x03000010                gSomething',
+             ' .rodata        0x00000000082b0000  0x100000 src/data.o']
+    lines += [f'                0x{address:08x}                {name}' for (address, name) in sorted(labels)]
+    return '\n'.join(lines) + '\n'
+
+def write_fixture(directory, seed=1234):
+    '''Writes mzm.gba, mzm_us.map, enemies.txt and the SNES sheets of sprites/ to directory'''
+    (rom, enemies) = build(seed)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, 'mzm.gba'), 'wb') as f:
+        f.write(rom.data)
+    with open(os.path.join(directory, 'mzm_us.map'), 'w') as f:
+        f.write(linker_map(rom.labels))
+
+    with open(os.path.join(directory, 'enemies.txt'), 'w') as f:
+        for (sprite_id, (name, sheet, start)) in enemies.items():
+            os.makedirs(os.path.join(directory, 'sprites', name), exist_ok=True)
+            sheet.save(os.path.join(directory, 'sprites', name, f'0x{sprite_id:02x}_sm.png'))
+            f.write(f'{sprite_id:#x} {name} {start:#x}\n' if start is not None else f'{sprite_id:#x} {name}\n')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Writes a synthetic ROM, linker map, enemy manifest and SNES sheets to a directory')
+    parser.add_argument('directory')
+    parser.add_argument('--seed', type=int, default=1234)
+    args = parser.parse_args()
+    write_fixture(args.directory, args.seed)
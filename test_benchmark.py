@@ -0,0 +1,19 @@
+''' pytest-benchmark suite of the hot paths on the synthetic ROM, run by benchmark.py to save and compare baselines '''
+
+import os
+import pytest
+from benchmark import CASES, DEFAULT_FIXTURE, DEFAULT_SEED, load_cases
+
+pytest.importorskip('pytest_benchmark')
+
+@pytest.fixture(scope='module')
+def cases():
+    cwd = os.getcwd()
+    try:
+        yield load_cases(os.environ.get('BENCHMARK_FIXTURE', DEFAULT_FIXTURE), int(os.environ.get('BENCHMARK_SEED', DEFAULT_SEED)))
+    finally:
+        os.chdir(cwd)
+
+@pytest.mark.parametrize('name', CASES)
+def test_benchmark(benchmark, cases, name):
+    benchmark.pedantic(cases[name], rounds=int(os.environ.get('BENCHMARK_ROUNDS', 5)))
@@ -0,0 +1,83 @@
+''' Round trips of the whole-sheet 4bpp codecs against the per-tile functions they replaced '''
+
+import random
+import numpy as np
+import pytest
+from PIL import Image
+from gfx_4bpp import convert_to_4bpp, decode_4bpp_gba, decode_4bpp_snes, encode_4bpp_snes, image_to_tiles, tiles_to_pixels
+
+# the old encoder reads tiles with getdata, kept as it was
+pytestmark = pytest.mark.filterwarnings('ignore:Image.Image.getdata:DeprecationWarning')
+
+# the per-tile versions, as they were in misc_tiles.py, sprite_tiles.py, sprite_oam_to_apng.py and oam_gba_2_snes.py
+
+def convert_4bpp_tile_gba(raw_tile, palette):
+    tile = np.zeros(64, dtype=np.uint8)
+
+    for i in range(32):
+        tile[i*2] = raw_tile[i] & 0xF | palette
+        tile[i*2+1] = raw_tile[i] >> 4 | palette
+
+    return tile.reshape(8, 8)
+
+def image_from_raw_data(raw, width=0x20):
+    raveled = np.concatenate([np.concatenate([convert_4bpp_tile_gba(raw[(i+j)*0x20:(i+j+1)*0x20], 0) for i in range(width)], 1) for j in range(0, len(raw)//0x20, width)], 0)
+    return Image.fromarray(raveled, 'P')
+
+def old_convert_to_4bpp(image: Image):
+    output = bytearray()
+
+    for y in range(0, image.height, 8):
+        for x in range(0, image.width, 8):
+            tile = image.crop([x, y, x+8, y+8])
+            output.extend(convert_indexed_tile_to_bitplanes(tile.getdata()))
+
+    return output
+
+def convert_indexed_tile_to_bitplanes(indexed_tile):
+    fixed_bits = np.array(indexed_tile, dtype=np.uint8).reshape(8, 8, 1)
+    tile_bits = np.unpackbits(fixed_bits, axis=2, bitorder='little')
+    tile = np.packbits(tile_bits, axis=1, bitorder='big')
+
+    low_bitplanes = np.ravel(tile[:, 0, 0:2])
+    high_bitplanes = np.ravel(tile[:, 0, 2:4])
+    return np.append(low_bitplanes, high_bitplanes)
+
+def random_sheet(rng, tiles):
+    return bytes(rng.randrange(0x100) for _ in range(0x20*tiles))
+
+def random_image(rng, width, height, mode='P'):
+    image = Image.fromarray(np.array([rng.randrange(16) for _ in range(width*height)], dtype=np.uint8).reshape(height, width), 'P')
+    return image.convert('PA') if mode == 'PA' else image
+
+@pytest.mark.parametrize('palette', [0, 0x80])
+def test_decode_4bpp_gba(palette):
+    raw = random_sheet(random.Random(1), 96)
+    tiles = decode_4bpp_gba(raw, palette)
+    assert tiles.shape == (96, 8, 8)
+    for i in range(96):
+        assert np.array_equal(tiles[i], convert_4bpp_tile_gba(raw[i*0x20:(i+1)*0x20], palette))
+
+def test_decode_4bpp_gba_sheet():
+    raw = random_sheet(random.Random(2), 0x40)
+    assert np.array_equal(tiles_to_pixels(decode_4bpp_gba(raw), 0x10), np.asarray(image_from_raw_data(raw, 0x10)))
+
+@pytest.mark.parametrize(('width', 'height', 'mode'), [(128, 64, 'P'), (256, 16, 'P'), (100, 37, 'P'), (13, 5, 'P'), (64, 32, 'PA'), (36, 20, 'PA')])
+def test_convert_to_4bpp(width, height, mode):
+    image = random_image(random.Random(width*height), width, height, mode)
+    expected = old_convert_to_4bpp(image.getchannel('P') if mode == 'PA' else image)
+    assert convert_to_4bpp(image) == expected
+
+def test_convert_to_4bpp_rejects_other_modes():
+    with pytest.raises(AssertionError):
+        convert_to_4bpp(Image.new('RGB', (8, 8)))
+
+def test_snes_round_trip():
+    image = random_image(random.Random(3), 100, 37)
+    tiles = image_to_tiles(image)
+    encoded = encode_4bpp_snes(tiles)
+    assert np.array_equal(decode_4bpp_snes(encoded), tiles)
+    # the old encoder's output decodes to the same pixels
+    assert np.array_equal(decode_4bpp_snes(old_convert_to_4bpp(image)), tiles)
+    for i in range(len(tiles)):
+        assert bytes(encoded[i*0x20:(i+1)*0x20]) == bytes(convert_indexed_tile_to_bitplanes(tiles[i].ravel()))
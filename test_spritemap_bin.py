@@ -0,0 +1,30 @@
+''' The binary container converts back to the checked-in spritemap editor JSON it was made from '''
+
+import glob, json, os
+import pytest
+from spritemap_bin import SpritemapFile, binary_to_json, encode_snes_spritemap, json_to_binary
+
+SPRITES = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sprites', '*', '*.json')))
+
+@pytest.mark.parametrize('fp', SPRITES, ids=[os.path.basename(fp) for fp in SPRITES])
+def test_round_trip(fp, tmp_path):
+    with open(fp) as f:
+        data = json.load(f)
+    binary = json_to_binary(data)
+    assert binary_to_json(binary) == data
+    # the same text, key order included, once written the way the converter writes it
+    assert json.dumps(binary_to_json(binary), indent=1) == json.dumps(data, indent=1)
+
+    (tmp_path / 'sprite.bin').write_bytes(binary)
+    with SpritemapFile(tmp_path / 'sprite.bin') as container:
+        assert len(container) == len(data['spritemaps'])
+        assert container.to_json() == data
+
+def test_sprites_found():
+    assert SPRITES
+
+@pytest.mark.parametrize(('field', 'value'), [('palette', -1), ('palette', 8), ('tile', 0x200), ('x', 0x100), ('y', -0x81)])
+def test_out_of_range(field, value):
+    entry = {'x': 0, 'y': 0, 'tile': 0, 'palette': 0, 'bg_priority': 0, 'h_flip': False, 'v_flip': False, 'big': False}
+    with pytest.raises(ValueError):
+        encode_snes_spritemap([dict(entry, **{field: value})], 'frame')
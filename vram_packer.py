@@ -0,0 +1,190 @@
+''' Repacks the SNES sheet of a converted enemy into the fewest tiles its spritemaps need '''
+
+import argparse, base64, glob, json, os
+import numpy as np
+from gfx_4bpp import decode_4bpp_snes, encode_4bpp_snes, tiles_to_image
+from oam_gba_2_snes import H_FLIP, V_FLIP, entry_flip, flip_tile, write_atomic
+
+SHEET_WIDTH = 0x10
+# one SNES sprite name table
+MAX_TILES = 0x100
+
+def canonical_tile(tile):
+    '''Returns (the smallest flip of a tile, the flip that gives it back the tile)'''
+    return min((flip_tile(tile, flip), flip) for flip in (0, H_FLIP, V_FLIP, H_FLIP | V_FLIP))
+
+def flip_block(block, flip):
+    '''Flips a block of tiles given as a tuple of rows, unused tiles being None'''
+    rows = [[None if tile is None else flip_tile(tile, flip) for tile in row] for row in block]
+    if flip & H_FLIP:
+        rows = [row[::-1] for row in rows]
+    if flip & V_FLIP:
+        rows.reverse()
+    return tuple(tuple(row) for row in rows)
+
+def canonical_block(block):
+    # None sorts as b'' so blocks with the same tiles in different places differ
+    return min((tuple(tuple(b'' if tile is None else tile for tile in row) for row in flip_block(block, flip)), flip) for flip in (0, H_FLIP, V_FLIP, H_FLIP | V_FLIP))
+
+def quad_slots(slot):
+    return (slot, slot + 1, slot + SHEET_WIDTH, slot + SHEET_WIDTH + 1)
+
+def quad_blocks(quads, sheet):
+    '''Groups 16x16 regions that share tiles in the sheet
+
+    Returns (top left slot, block) for each group, the block being the rows of tiles of its bounding
+    box with None where no region is.'''
+    parent = {idx: idx for idx in quads}
+    def find(idx):
+        while parent[idx] != idx:
+            parent[idx] = parent[parent[idx]]
+            idx = parent[idx]
+        return idx
+
+    owner = {}
+    for idx in quads:
+        for slot in quad_slots(idx):
+            if slot in owner:
+                parent[find(idx)] = find(owner[slot])
+            owner[slot] = idx
+
+    groups = {}
+    for idx in quads:
+        groups.setdefault(find(idx), []).append(idx)
+
+    blocks = {}
+    for group in groups.values():
+        slots = {slot for idx in group for slot in quad_slots(idx)}
+        top = min(slot // SHEET_WIDTH for slot in slots)
+        left = min(slot % SHEET_WIDTH for slot in slots)
+        bottom = max(slot // SHEET_WIDTH for slot in slots) + 1
+        right = max(slot % SHEET_WIDTH for slot in slots) + 1
+        block = tuple(tuple(sheet[row*SHEET_WIDTH + column] if row*SHEET_WIDTH + column in slots else None
+                            for column in range(left, right)) for row in range(top, bottom))
+        for idx in group:
+            blocks[idx] = (top*SHEET_WIDTH + left, block)
+    return blocks
+
+def pack_spritemaps(spritemaps, sheet, gfx_offset):
+    '''Lays out the tiles used by spritemaps in as few sheet rows as possible
+
+    sheet is a list of 64-byte tiles. 16x16 regions that overlap are kept together as one block,
+    and blocks are placed largest first at the first position they fit (first fit decreasing). 8x8
+    tiles then reuse a tile of a placed block if one matches, otherwise they fill the gaps in order.
+    Blocks and tiles equal up to flipping are stored once.
+    Returns (new sheet, {(old tile, big): (new tile, flip to XOR into the entry)}).'''
+    quads = []
+    tiles = {}
+    for spritemap in spritemaps:
+        for entry in spritemap['spritemap']:
+            idx = entry['tile'] - gfx_offset
+            if not 0 <= idx < len(sheet) - (SHEET_WIDTH + 1 if entry['big'] else 0) or (entry['big'] and idx % SHEET_WIDTH == SHEET_WIDTH - 1):
+                raise ValueError(f"{spritemap['name']}: tile {entry['tile']:#x} is outside the sheet")
+            if entry['big']:
+                if idx not in quads:
+                    quads.append(idx)
+            else:
+                tiles.setdefault(idx, canonical_tile(sheet[idx]))
+
+    blocks = quad_blocks(quads, sheet)
+    canonical = {}
+    for (origin, block) in blocks.values():
+        canonical.setdefault(block, canonical_block(block))
+
+    # slot -> tile, canonical block -> slot, and canonical tile -> (slot, flip of the slot's tile from the canonical one)
+    new_sheet = {}
+    placed_blocks = {}
+    placed_tiles = {}
+
+    by_size = sorted({block for (block, flip) in canonical.values()}, key=lambda block: (len(block), len(block[0])), reverse=True)
+    for block in by_size:
+        used = [(row*SHEET_WIDTH + column, tile) for (row, tiles_row) in enumerate(block) for (column, tile) in enumerate(tiles_row) if tile != b'']
+        position = 0
+        while position % SHEET_WIDTH + len(block[0]) > SHEET_WIDTH or any(position + offset in new_sheet for (offset, tile) in used):
+            position += 1
+        placed_blocks[block] = position
+        for (offset, tile) in used:
+            new_sheet[position + offset] = tile
+            (canonical_form, tile_flip) = canonical_tile(tile)
+            placed_tiles.setdefault(canonical_form, (position + offset, tile_flip))
+
+    free_slot = 0
+    for (tile, flip) in tiles.values():
+        if tile in placed_tiles:
+            continue
+        while free_slot in new_sheet:
+            free_slot += 1
+        new_sheet[free_slot] = tile
+        placed_tiles[tile] = (free_slot, 0)
+
+    size = -(-(max(new_sheet) + 1) // SHEET_WIDTH) * SHEET_WIDTH if new_sheet else 0
+    if size > MAX_TILES:
+        raise ValueError(f'{size:#x} tiles do not fit in a name table')
+    blank = bytes(0x40)
+
+    # the entry shows flip(old, entry flip) where old = flip(canonical, flip), so flip(canonical, flip ^ entry flip)
+    remap = {}
+    for idx in quads:
+        (origin, block) = blocks[idx]
+        (stored, flip) = canonical[block]
+        (row, column) = (idx // SHEET_WIDTH - origin // SHEET_WIDTH, idx % SHEET_WIDTH - origin % SHEET_WIDTH)
+        if flip & H_FLIP:
+            column = len(block[0]) - 2 - column
+        if flip & V_FLIP:
+            row = len(block) - 2 - row
+        remap[(idx, True)] = (placed_blocks[stored] + row*SHEET_WIDTH + column + gfx_offset, flip)
+    for (idx, (tile, flip)) in tiles.items():
+        (slot, slot_flip) = placed_tiles[tile]
+        remap[(idx, False)] = (slot + gfx_offset, flip ^ slot_flip)
+
+    return ([new_sheet.get(i, blank) for i in range(size)], remap)
+
+def pack_enemy(data):
+    '''Returns a copy of spritemap editor data with its gfx repacked, and the new sheet as tiles'''
+    gfx_offset = data['gfx_offset']
+    sheet = [tile.tobytes() for tile in decode_4bpp_snes(base64.b64decode(data['gfx']))]
+    (new_sheet, remap) = pack_spritemaps(data['spritemaps'], sheet, gfx_offset)
+
+    spritemaps = []
+    for spritemap in data['spritemaps']:
+        entries = []
+        for entry in spritemap['spritemap']:
+            (tile, flip) = remap[(entry['tile'] - gfx_offset, entry['big'])]
+            flip ^= entry_flip(entry)
+            entries.append(dict(entry, tile=tile, h_flip=flip & H_FLIP != 0, v_flip=flip & V_FLIP != 0))
+        spritemaps.append(dict(spritemap, spritemap=entries))
+
+    tiles = np.frombuffer(b''.join(new_sheet), dtype=np.uint8).reshape(-1, 8, 8)
+    packed = dict(data, gfx=str(base64.b64encode(encode_4bpp_snes(tiles)), 'utf8'), spritemaps=spritemaps)
+    return (packed, tiles)
+
+def sheet_palette(data):
+    '''Returns the first palette row of spritemap editor data as RGB for a PNG'''
+    return [channel for argb in data['palette'][:16] for channel in (argb >> 16 & 0xFF, argb >> 8 & 0xFF, argb & 0xFF)]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Repacks the SNES tile sheet of converted enemies into as few rows as possible')
+    parser.add_argument('names', nargs='+', help='enemies in sprites/')
+    parser.add_argument('--in-place', action='store_true', help='overwrite <name>.json and the 0x??_sm.png sheet instead of writing *_packed files')
+    args = parser.parse_args()
+
+    for name in args.names:
+        json_fp = f'sprites/{name}/{name}.json'
+        with open(json_fp) as f:
+            data = json.load(f)
+        (packed, tiles) = pack_enemy(data)
+
+        sheets = sorted(glob.glob(f'sprites/{name}/0x*_sm.png'))
+        sheet_fp = sheets[0] if sheets else f'sprites/{name}/{name}_sm.png'
+        if not args.in_place:
+            json_fp = json_fp[:-len('.json')] + '_packed.json'
+            sheet_fp = sheet_fp[:-len('.png')] + '_packed.png'
+
+        image = tiles_to_image(tiles if len(tiles) else np.zeros((SHEET_WIDTH, 8, 8), dtype=np.uint8), SHEET_WIDTH)
+        image.putpalette(sheet_palette(data), 'RGB')
+        image.save(sheet_fp + '.tmp', format='PNG')
+        os.replace(sheet_fp + '.tmp', sheet_fp)
+        write_atomic(json_fp, json.dumps(packed, indent=1))
+
+        before = len(base64.b64decode(data['gfx'])) // 0x20
+        print(f'{name}: {before:#x} -> {len(tiles):#x} tiles ({len(tiles)*0x20:#x} bytes of VRAM)')
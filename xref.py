@@ -0,0 +1,145 @@
+''' Reverse index of every ROM pointer in the ROM, and the OAM frame tables and animation lists found from it '''
+
+import argparse, time
+import numpy as np
+from rom import gba2hex
+
+ROM_START = 0x8000000
+# the most entries read_animation accepts in a spritemap
+MAX_SPRITEMAP_ENTRIES = 128
+
+def runs(mask):
+    '''Returns (starts, ends) of the runs of True in a boolean array, ends exclusive'''
+    edges = np.flatnonzero(np.diff(np.concatenate([[False], mask, [False]]).astype(np.int8)))
+    return (edges[0::2], edges[1::2])
+
+class PointerIndex:
+    '''Every aligned u32 in the ROM that points into the ROM, sorted by what it points to
+
+    Frame tables are runs of (spritemap pointer, timer) ending with a null pointer; animation lists
+    are runs of two or more pointers to frame tables.'''
+
+    def __init__(self, rom):
+        self.rom = rom
+        self.words = rom.u32(ROM_START, len(rom) // 4)
+        halfwords = rom.u16(ROM_START, len(rom) // 2)
+
+        is_pointer = (self.words >= ROM_START) & (self.words < ROM_START + len(rom))
+        locations = np.flatnonzero(is_pointer)
+        targets = self.words[locations]
+        order = np.argsort(targets, kind='stable')
+        self.targets = targets[order]
+        self.locations = (locations[order]*4 + ROM_START).astype(np.uint32)
+
+        # (spritemap pointer, timer) entries: a halfword aligned pointer to a plausible count, and a timer of a byte
+        pointer = np.zeros(len(self.words), dtype=bool)
+        pointer[:-1] = is_pointer[:-1] & (self.words[:-1] % 2 == 0)
+        count = np.zeros(len(self.words), dtype=np.int64)
+        count[pointer] = halfwords[(self.words[pointer] - ROM_START) // 2]
+        timer = np.zeros(len(self.words), dtype=bool)
+        timer[:-1] = (self.words[1:] >= 1) & (self.words[1:] <= 0xFF)
+        entry = pointer & timer & (count >= 1) & (count <= MAX_SPRITEMAP_ENTRIES)
+        null = np.zeros(len(self.words), dtype=bool)
+        null[:-1] = (self.words[:-1] == 0) & (self.words[1:] == 0)
+
+        # entries are 8 bytes, so a table is a run in the words of one parity
+        starts = []
+        lengths = []
+        for parity in (0, 1):
+            (run_starts, run_ends) = runs(entry[parity::2])
+            ended = run_ends < len(null[parity::2])
+            ended[ended] = null[parity::2][run_ends[ended]]
+            starts.append(run_starts[ended]*2 + parity)
+            lengths.append((run_ends - run_starts)[ended])
+        starts = np.concatenate(starts)
+        order = np.argsort(starts)
+        # GBA address of each frame table -> number of frames
+        self.frame_tables = dict(zip((starts[order]*4 + ROM_START).tolist(), np.concatenate(lengths)[order].tolist()))
+        self.table_starts = np.array(sorted(self.frame_tables), dtype=np.uint32)
+
+        (list_starts, list_ends) = runs(np.isin(self.words, self.table_starts))
+        keep = list_ends - list_starts >= 2
+        # GBA address of each animation list -> number of frame tables
+        self.animation_lists = dict(zip((list_starts[keep]*4 + ROM_START).tolist(), (list_ends - list_starts)[keep].tolist()))
+
+    def references(self, target):
+        '''Returns the GBA addresses of the words pointing to target'''
+        (i, j) = np.searchsorted(self.targets, [target, target + 1])
+        return self.locations[i:j].tolist()
+
+    def frames(self, table):
+        '''Returns the spritemap pointers of a frame table'''
+        start = gba2hex(table) // 4
+        return self.words[start:start + 2*self.frame_tables[table]:2].tolist()
+
+    def spritemap_start(self, after):
+        '''Returns where the spritemaps of an enemy start, given where its palette ends, or None
+
+        The first spritemap a frame table points to before the enemy's first frame table may follow
+        frames no table uses, so the start is the lowest address whose chain of spritemaps reaches it.'''
+        i = np.searchsorted(self.table_starts, after, side='left')
+        if i == len(self.table_starts):
+            return None
+        end = int(self.table_starts[i])
+
+        # pointers into [after, end) from the frame table entries
+        (i, j) = np.searchsorted(self.targets, [after, end])
+        first = next((target for (target, location) in zip(self.targets[i:j].tolist(), self.locations[i:j].tolist()) if self.is_frame_entry(location)), None)
+        if first is None:
+            return None
+
+        # reaches[k]: the spritemaps from after + 2*k chain to first
+        counts = self.rom.u16(after - after % 2, (first - after + 1) // 2).astype(np.int64)
+        reaches = np.zeros(len(counts) + 1, dtype=bool)
+        reaches[-1] = True
+        for k in range(len(counts) - 1, -1, -1):
+            step = 1 + 3*counts[k]
+            reaches[k] = 1 <= counts[k] <= MAX_SPRITEMAP_ENTRIES and k + step < len(reaches) and reaches[k + step]
+        return after - after % 2 + 2*int(np.argmax(reaches))
+
+    def is_frame_entry(self, location):
+        '''Whether the word at a GBA address is the spritemap pointer of a frame table entry'''
+        i = np.searchsorted(self.table_starts, location, side='right') - 1
+        if i < 0:
+            return False
+        table = int(self.table_starts[i])
+        return (location - table) % 8 == 0 and location < table + 8*self.frame_tables[table]
+
+indexes = {}
+
+def pointer_index(rom):
+    '''Returns the PointerIndex of a Rom, built on first use'''
+    if rom.digest not in indexes:
+        indexes[rom.digest] = PointerIndex(rom)
+    return indexes[rom.digest]
+
+def release_index(rom):
+    '''Drops the PointerIndex built from a Rom, which holds the Rom and arrays into its mapping'''
+    for digest in [digest for (digest, index) in indexes.items() if index.rom is rom]:
+        del indexes[digest]
+
+if __name__ == "__main__":
+    from decompressor import lz77_size
+    from oam_gba_2_snes import read_manifest
+    from rom import Rom
+
+    parser = argparse.ArgumentParser(description='Finds pointers to addresses, and the spritemap starts of enemies')
+    parser.add_argument('addresses', nargs='*', type=lambda address: int(address, 16), help='print the words pointing to these')
+    parser.add_argument('--rom', default='mzm.gba')
+    parser.add_argument('--manifest', default='enemies.txt', help='compare the spritemap starts found with the ones given here')
+    args = parser.parse_args()
+
+    rom = Rom(args.rom)
+    start = time.perf_counter()
+    index = pointer_index(rom)
+    print(f'{len(index.targets)} pointers, {len(index.frame_tables)} frame tables, {len(index.animation_lists)} animation lists in {(time.perf_counter() - start)*1000:.1f} ms')
+
+    for address in args.addresses:
+        print(f'{address:#x}: ' + ' '.join(f'{location:#x}' for location in index.references(address)))
+
+    if not args.addresses:
+        for (sprite_id, name, spritemap_start, done) in read_manifest(args.manifest):
+            row_count = lz77_size(rom, gba2hex(rom.read(4, 0x875EBF8 + (sprite_id - 0x10)*4))) // 0x800
+            found = index.spritemap_start(rom.read(4, 0x875EEF0 + (sprite_id - 0x10)*4) + 0x20*row_count)
+            expected = '' if spritemap_start is None else (' (matches enemies.txt)' if found == spritemap_start else f' (enemies.txt has {spritemap_start:#x})')
+            print(f'{sprite_id:#04x} {name}: ' + ('not found' if found is None else f'{found:#x}') + expected)